@@ -1,16 +1,21 @@
 #Name:Abhijit Nimbalkar
+import sys
 import os
 import json
 import csv
+import hashlib
 import argparse
 import subprocess
-import progressbar
-from datetime import datetime
-import fhirclient.models.bundle as b
-import fhirclient.models.claim  as c
+from bisect import bisect_left
+from decimal import Decimal
+from itertools import islice
+from functools import partial
+from datetime import date, datetime
+from instrumentation import STATS
+from fhir_stream import iter_bundle_entries, load_bundle_json, map_bundle_files
 
 
-def parse_claims_into_csv(bundle_path, output_path, claims_file_name):
+def parse_claims_into_csv(bundle_path, output_path, claims_file_name, workers=1, chunk_size=1, parse_mode='filtered', incremental=False):
     """Reads a directory of fhir bundles, parses fhir bundles into
     fhirclient bundle objects, parses out claims data, writes claims data to a
     csv file.
@@ -25,6 +30,15 @@ def parse_claims_into_csv(bundle_path, output_path, claims_file_name):
         bundle_path {String} -- path to the fhir data directory for this assignment e.g. ~/assignments/data/fhir
         output_path {String} -- path to the output directory for this assignment e.g. ~/assignments/out
         claims_file_name {String} -- claims file name e.g. claims.csv
+
+    Keyword Arguments:
+        workers {int} -- number of worker processes parsing the bundles, 1 parses in this process (default: {1})
+        chunk_size {int} -- number of bundle files sent to a worker at a time (default: {1})
+        parse_mode {String} -- 'bundle' builds the whole fhirclient bundle, 'filtered' builds
+        fhirclient objects for the Claim entries only, 'dict' reads the claim fields
+        straight from the json without fhirclient (default: {'filtered'})
+        incremental {Boolean} -- only parse bundles that are new or changed since the
+        run recorded in the manifest next to the csv file (default: {False})
     """
     fhir_dir=os.path.abspath(bundle_path)                 #getting absolute path of fhir file directory 
     if not os.path.exists(fhir_dir):                      #Checking if that file already exist
@@ -39,36 +53,347 @@ def parse_claims_into_csv(bundle_path, output_path, claims_file_name):
             print("Output directory can not be created.")
 
     try:
-        list_of_all_files=[file for file in os.listdir(fhir_dir) if os.path.isfile(os.path.join(fhir_dir,file))]    #listing out all files from directory
+        list_of_all_files=[os.path.join(fhir_dir,file) for file in sorted(os.listdir(fhir_dir)) if os.path.isfile(os.path.join(fhir_dir,file))]    #listing out all files from directory in a fixed order
     except:
         print("There are no files in existing directory. Please try running program again.")
         return
 
-    claims=[]
-    for file in list_of_all_files:
-        bundle=parse_bundle_for_file(os.path.join(fhir_dir,file))   #creating bundle object of each file
-        claims.append(get_claims_from_bundle(bundle))               #appending each bundle in the claim list
+    manifest_path=get_manifest_path(output_dir,claims_file_name)
+    csv_path=os.path.join(output_dir,claims_file_name)
+    if incremental and os.path.exists(manifest_path) and os.path.exists(csv_path):
+        return update_claims_csv(fhir_dir,list_of_all_files,output_dir,claims_file_name,workers,chunk_size,parse_mode)
+
+    get_bundle_record=partial(get_bundle_record_from_file,fhir_dir=fhir_dir,parse_mode=parse_mode)
+    bundle_records=map_bundle_files(get_bundle_record,list_of_all_files,workers,chunk_size)   #csv rows of the claims in each bundle
+
+    manifest_bundles=[]
+    rollup=dict()
+    flattened_rows=get_rows_from_records(bundle_records,manifest_bundles)  #flattening lazily so only one batch of rows is held in memory
+    flattened_rows=get_rows_into_rollup(flattened_rows,rollup)
 
-    flattened_claims=[obj for claim in claims for obj in claim]     #as claim list was not one dimentional. creating 1d list of bundle objects
+    header_rows=1 if os.path.exists(csv_path) else 0    #write_csv_rows writes the header only when it replaces a file
+    output=write_csv_rows(flattened_rows,output_dir,claims_file_name,new_file=True)  
 
-    output=write_claims_to_csv(flattened_claims,output_dir,claims_file_name,new_file=True)  
+    if output:
+        write_manifest(manifest_path,{'header_rows':header_rows,'bundles':manifest_bundles})
+        write_claims_rollup(get_rollup_path(output_dir,claims_file_name),rollup)
 
     return output
 
-def parse_bundle_for_file(fhir_bundle_path):
+
+def update_claims_csv(fhir_dir, list_of_all_files, output_dir, claims_file_name, workers=1, chunk_size=1, parse_mode='filtered'):
+    """Brings an existing claims csv file up to date with the bundle directory
+    using the manifest written by the previous run. Only new and changed
+    bundles are parsed. If no bundle was changed or removed their claims are
+    appended, otherwise the csv file is rewritten from the rows of the
+    unchanged bundles already in it followed by the new rows. The claims
+    rollup is updated with the appended rows, or rebuilt from the rows
+    written when the csv file is rewritten.
+
+    Arguments:
+        fhir_dir {String} -- absolute path to the fhir data directory
+        list_of_all_files {list} -- bundle file paths in fhir_dir
+        output_dir {String} -- absolute path to the output directory
+        claims_file_name {String} -- claims file name e.g. claims.csv
+
+    Keyword Arguments:
+        workers, chunk_size, parse_mode -- see parse_claims_into_csv
+
+    Returns:
+        int -- 1 if the csv file was updated, 0 otherwise
+    """
+    manifest_path=get_manifest_path(output_dir,claims_file_name)
+    manifest=load_manifest(manifest_path)
+    current_files={os.path.relpath(file,fhir_dir):file for file in list_of_all_files}
+
+    kept_bundles=[]
+    rebuild=False
+    for bundle in manifest['bundles']:
+        bundle.pop('rollup',None)                       #per bundle rollups of earlier versions are not kept
+        file=current_files.get(bundle['path'])
+        if file is None or is_bundle_changed(bundle,file):  #removed or changed bundles have rows to drop
+            rebuild=True
+        else:
+            kept_bundles.append(bundle)
+
+    kept_paths={bundle['path'] for bundle in kept_bundles}
+    files_to_parse=[file for path, file in current_files.items() if path not in kept_paths]
+
+    get_bundle_record=partial(get_bundle_record_from_file,fhir_dir=fhir_dir,parse_mode=parse_mode)
+    bundle_records=map_bundle_files(get_bundle_record,files_to_parse,workers,chunk_size)
+    manifest_bundles=list(kept_bundles)
+    new_rows=get_rows_from_records(bundle_records,manifest_bundles)
+    csv_path=os.path.join(output_dir,claims_file_name)
+    rollup_path=get_rollup_path(output_dir,claims_file_name)
+
+    if rebuild:
+        rollup=dict()
+        output=rebuild_claims_csv(csv_path,manifest,kept_paths,get_rows_into_rollup(new_rows,rollup),rollup=rollup)
+    else:
+        if os.path.exists(rollup_path):
+            rollup=load_claims_rollup(rollup_path)
+        else:                                           #csv file written before rollups were kept
+            rollup=get_claims_rollup_from_csv(csv_path,manifest['header_rows'])
+        output=write_csv_rows(get_rows_into_rollup(new_rows,rollup),output_dir,claims_file_name,new_file=False)
+
+    if output:
+        write_manifest(manifest_path,{'header_rows':manifest['header_rows'],'bundles':manifest_bundles})
+        write_claims_rollup(rollup_path,rollup)
+    return output
+
+
+def rebuild_claims_csv(csv_path, manifest, kept_paths, new_rows, batch_size=1000, rollup=None):
+    """Rewrites the claims csv file keeping the header and the rows of the
+    bundles in kept_paths, then writes new_rows. The rows of a bundle are
+    located with the per bundle row counts of the manifest.
+
+    Arguments:
+        csv_path {String} -- path of the claims csv file
+        manifest {dict} -- manifest of the csv file as it is now
+        kept_paths {set} -- manifest paths of the bundles whose rows are kept
+        new_rows {iterable} -- rows to write after the kept rows
+
+    Keyword Arguments:
+        batch_size {int} -- number of new rows written at a time (default: {1000})
+        rollup {dict} -- claims rollup the kept rows are added to (default: {None})
+
+    Returns:
+        int -- 1 once the csv file is replaced
+    """
+    temp_path=csv_path+'.tmp'
+    with open(csv_path,mode='r',newline='') as old, open(temp_path,mode='w',newline='') as f:
+        reader=csv.reader(old)
+        writer=csv.writer(f, delimiter=',')
+        writer.writerows(islice(reader,manifest['header_rows']))
+        for bundle in manifest['bundles']:
+            rows=islice(reader,bundle['rows'])          #rows of one bundle are consecutive in the csv file
+            if bundle['path'] in kept_paths:
+                writer.writerows(rows if rollup is None else get_rows_into_rollup(rows,rollup))
+            else:
+                for row in rows:
+                    pass
+        write_rows_in_batches(f,writer,new_rows,batch_size)
+    os.replace(temp_path,csv_path)                      #old file stays complete until the new one is
+    return 1
+
+
+def get_bundle_record_from_file(fhir_bundle_path, fhir_dir, parse_mode='filtered'):
+    """Parses a single fhir bundle file and returns its manifest record
+    together with the csv rows of its claims
+
+    Arguments:
+        fhir_bundle_path {String} -- path to a fhir bundle
+        fhir_dir {String} -- directory the manifest paths are relative to
+
+    Keyword Arguments:
+        parse_mode {String} -- see parse_claims_into_csv (default: {'filtered'})
+
+    Returns:
+        tuple -- (manifest record dict, list of csv rows)
+    """
+    stat=os.stat(fhir_bundle_path)
+    rows=get_csv_values_from_file(fhir_bundle_path,parse_mode)
+    record={'path':os.path.relpath(fhir_bundle_path,fhir_dir),'size':stat.st_size,'mtime':stat.st_mtime,
+            'sha256':get_file_hash(fhir_bundle_path),'rows':len(rows)}
+    return record, rows
+
+
+def get_rows_from_records(bundle_records, manifest_bundles):
+    """Yields the csv rows of every (record, rows) pair and appends the record
+    to manifest_bundles, keeping the manifest in csv row order"""
+    for record, rows in bundle_records:
+        manifest_bundles.append(record)
+        yield from rows
+
+
+def is_bundle_changed(bundle, fhir_bundle_path):
+    """Compares a bundle file with its manifest record. The content hash is
+    only computed when the size or modification time differ."""
+    stat=os.stat(fhir_bundle_path)
+    if stat.st_size==bundle['size'] and stat.st_mtime==bundle['mtime']:
+        return False
+    if stat.st_size==bundle['size'] and get_file_hash(fhir_bundle_path)==bundle['sha256']:
+        bundle['mtime']=stat.st_mtime                   #touched but not changed
+        return False
+    return True
+
+
+def get_file_hash(file_path):
+    sha256=hashlib.sha256()
+    with open(file_path,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+ROLLUP_BUCKETS=[0.0]+[float(Decimal(m).scaleb(k)) for k in range(-2,8) for m in (1,2,5)]  #histogram upper bounds, 0.01 to 50,000,000, larger totals go to inf
+
+
+def get_claims_rollup(rows, rollup=None):
+    """Aggregates claim rows by (status, use, currency, billing month) where the
+    billing month is the year-month of billable_period_start. Every group
+    keeps the claim count and the count, sum, min, max and a histogram of
+    the total values. All of them are updated by adding or comparing, so
+    rows can be added to a rollup in any order and in any number of steps.
+    Sums are kept as exact decimals so they do not depend on that order.
+
+    Arguments:
+        rows {iterable} -- rows as returned by get_csv_value_from_claim or read back from the csv file
+
+    Keyword Arguments:
+        rollup {dict} -- rollup the rows are added to, a new one when None (default: {None})
+
+    Returns:
+        dict -- aggregate dict per (status, use, currency, month) key
+    """
+    rollup=dict() if rollup is None else rollup
+    for status, use, start, end, value, currency in rows:
+        key=(status or None,use or None,currency or None,start[:7] if start else None)     #iso dates start with YYYY-MM, the csv file reads None as ''
+        group=rollup.get(key)
+        if group is None:
+            group=rollup[key]={'claims':0,'count':0,'sum':Decimal(0),'min':None,'max':None,'histogram':dict()}
+        group['claims']+=1
+        if value is None or value=='':
+            continue
+        value=float(value)
+        group['count']+=1
+        group['sum']+=Decimal(repr(value))          #repr gives the shortest repr of a float, so 853.48 stays 853.48
+        group['min']=value if group['min'] is None else min(group['min'],value)
+        group['max']=value if group['max'] is None else max(group['max'],value)
+        bucket=get_rollup_bucket(value)
+        group['histogram'][bucket]=group['histogram'].get(bucket,0)+1
+    return rollup
+
+
+def get_rows_into_rollup(rows, rollup):
+    """Yields rows unchanged while adding them to rollup, so the rollup is
+    built in the same pass that writes the csv file"""
+    for row in rows:
+        get_claims_rollup((row,),rollup)
+        yield row
+
+
+def get_claims_rollup_from_csv(csv_path, header_rows):
+    """Rollup of the rows of an existing claims csv file"""
+    with open(csv_path,mode='r',newline='') as f:
+        reader=csv.reader(f)
+        for row in islice(reader,header_rows):
+            pass
+        return get_claims_rollup(reader)
+
+
+def get_rollup_bucket(value):
+    """Returns the histogram bucket of a total value, the smallest bound of
+    ROLLUP_BUCKETS not below it as a string, or 'inf'"""
+    index=bisect_left(ROLLUP_BUCKETS,value)
+    return '%g'%ROLLUP_BUCKETS[index] if index<len(ROLLUP_BUCKETS) else 'inf'
+
+
+def export_claims_rollup(rollup):
+    """Turns a rollup into a json serializable list of groups sorted by key.
+    Sums are written as decimal strings so that they load back exactly.
+
+    Arguments:
+        rollup {dict} -- rollup as returned by get_claims_rollup
+
+    Returns:
+        list -- one dict per group
+    """
+    groups=[]
+    for key in sorted(rollup,key=lambda key: tuple('' if part is None else part for part in key)):
+        group=rollup[key]
+        histogram={bucket:group['histogram'][bucket] for bucket in sorted(group['histogram'],key=float)}   #float('inf') sorts last
+        groups.append({'status':key[0],'use':key[1],'currency':key[2],'month':key[3],'claims':group['claims'],'count':group['count'],
+                       'sum':str(group['sum']),'min':group['min'],'max':group['max'],'histogram':histogram})
+    return groups
+
+
+def load_claims_rollup(rollup_path):
+    """Reads a rollup file written by write_claims_rollup back into a rollup"""
+    with open(rollup_path,'r') as f:
+        groups=json.load(f)['groups']
+    rollup=dict()
+    for group in groups:
+        rollup[(group['status'],group['use'],group['currency'],group['month'])]={'claims':group['claims'],'count':group['count'],
+            'sum':Decimal(group['sum']),'min':group['min'],'max':group['max'],'histogram':dict(group['histogram'])}
+    return rollup
+
+
+def write_claims_rollup(rollup_path, rollup):
+    """Writes the claims rollup next to the csv file, so totals by status, use,
+    currency and billing month never need the csv rows
+
+    Arguments:
+        rollup_path {String} -- path of the rollup json file
+        rollup {dict} -- rollup as returned by get_claims_rollup
+    """
+    temp_path=rollup_path+'.tmp'
+    with open(temp_path,'w') as f:
+        json.dump({'buckets':['%g'%bound for bound in ROLLUP_BUCKETS]+['inf'],'groups':export_claims_rollup(rollup)},f,separators=(',',':'))
+    os.replace(temp_path,rollup_path)
+
+
+def get_rollup_path(output_dir, claims_file_name):
+    return os.path.join(output_dir,claims_file_name+'.rollup.json')
+
+
+def get_manifest_path(output_dir, claims_file_name):
+    return os.path.join(output_dir,claims_file_name+'.manifest.json')
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path,'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_path, manifest):
+    temp_path=manifest_path+'.tmp'
+    with open(temp_path,'w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(temp_path,manifest_path)
+
+
+def get_csv_values_from_file(fhir_bundle_path, parse_mode='filtered'):
+    """Parses a single fhir bundle file and returns the csv rows of its claims
+
+    Arguments:
+        fhir_bundle_path {String} -- path to a fhir bundle
+
+    Keyword Arguments:
+        parse_mode {String} -- 'bundle', 'filtered' or 'dict', see parse_claims_into_csv (default: {'filtered'})
+
+    Returns:
+        list -- list of csv rows, see get_csv_values_from_claim
+    """
+    if parse_mode=='dict':                              #no fhirclient objects at all, only the claim json
+        rows=[get_csv_value_from_claim_json(entry['resource']) for entry in iter_bundle_entries(fhir_bundle_path,['Claim'])]
+        STATS.keep('Claim',len(rows))
+        return rows
+    object_names=None if parse_mode=='bundle' else ['Claim']
+    bundle=parse_bundle_for_file(fhir_bundle_path,object_names)      #creating bundle object of the file
+    if not bundle:
+        return []
+    return get_csv_values_from_claim(get_claims_from_bundle(bundle))
+
+def parse_bundle_for_file(fhir_bundle_path, object_names=None):
     """Reads a fhir bundle file and returns a fhir bundle class object
     
     Arguments:
         fhir_bundle_path {String} -- path to a fhir bundle
+
+    Keyword Arguments:
+        object_names {list} -- only entries of these resource types are turned into
+        fhirclient objects, all entries are when None (default: {None})
     
     Returns:
         fhirclient.models.bundle.Bundle -- fhir bundle class object for the
         fhir bundle file passed into the function
     """
-    with open(fhir_bundle_path,'r') as f:
-        fhir_object=json.load(f)            #loading bundle object
+    import fhirclient.models.bundle as b
+    fhir_object=load_bundle_json(fhir_bundle_path,object_names)
     try:
-        bundle=b.Bundle(fhir_object)        #initiating bundle object
+        with STATS.timer('bundle'):
+            bundle=b.Bundle(fhir_object)    #initiating bundle object
         return bundle
     except:
         print("There are no fhir format files in the provided directory. Please try again.")
@@ -86,26 +411,44 @@ def get_claims_from_bundle(bundle):
         list -- list of all fhir fhirclient.models.claim.Claim resources 
         contained within a single fhir bundle
     """
-    claims=[entry.resource for entry in bundle.entry if entry.request.url=='Claim']   #parsing claim objects from bundle objects
+    with STATS.timer('filter'):
+        claims=[entry.resource for entry in bundle.entry or [] if entry.request.url=='Claim']   #parsing claim objects from bundle objects
+    STATS.keep('Claim',len(claims))
     return(claims)
 
 
 def write_claims_to_csv(claims, output_path, claims_file_name, new_file=True):
-    """Writes information contained within a list of claims to a csv file
-    at the specified path
+    """Writes information contained within an iterable of claims to a csv file
+    at the specified path. Claims are consumed one at a time, so a generator
+    can be passed without building the full list.
 
     Ex: must match exact format with no spaces between fields
     status,use,billable_period_start,billable_period_end,total,currency
 
     Arguments:
-        claims {list} -- List of fhirclient.models.claim.Claim objects
+        claims {iterable} -- iterable of fhirclient.models.claim.Claim objects
         output_path {String} -- path to the output directory for this assignment e.g. ~/assignments/out
         claims_file_name {String} -- claims file name e.g. claims.csv
         new_file {Boolean} -- indicates if a csv file should be created or updated
     """
 
+    csv_data=(get_csv_value_from_claim(obj) for obj in claims)
+    return write_csv_rows(csv_data,output_path,claims_file_name,new_file)
+
+
+def write_csv_rows(csv_data, output_path, claims_file_name, new_file=True, batch_size=1000):
+    """Writes already extracted claim rows to a csv file at the specified path
+
+    Arguments:
+        csv_data {iterable} -- rows as returned by get_csv_value_from_claim
+        output_path {String} -- path to the output directory for this assignment e.g. ~/assignments/out
+        claims_file_name {String} -- claims file name e.g. claims.csv
+        new_file {Boolean} -- indicates if a csv file should be created or updated
+
+    Keyword Arguments:
+        batch_size {int} -- number of rows written and flushed at a time (default: {1000})
+    """
     header=["status","use","billable_period_start","billable_period_end","total","currency"] #defining header for csv file
-    csv_data=get_csv_values_from_claim(claims)
     
     if(new_file):               #if user wants to create new file
         if os.path.exists(os.path.join(output_path,claims_file_name)):    #eventhough user wants to create new, there is same file exist in directory then confirm with user if he/she wants to replace it with new file
@@ -114,8 +457,7 @@ def write_claims_to_csv(claims, output_path, claims_file_name, new_file=True):
                 with open(os.path.join(output_path,claims_file_name),mode='w',newline='') as f:
                     writer = csv.writer(f, delimiter=',')
                     writer.writerow(header)
-                    for row in csv_data:
-                        writer.writerow(row)
+                    write_rows_in_batches(f,writer,csv_data,batch_size)
                 return 1
             else:
                 print("File already exist and based on your input program can not proceed further.")
@@ -123,21 +465,38 @@ def write_claims_to_csv(claims, output_path, claims_file_name, new_file=True):
         else:
             with open(os.path.join(output_path,claims_file_name),mode='w',newline='') as f:     #creating new file
                 writer = csv.writer(f, delimiter=',')
-                for row in csv_data:
-                    writer.writerow(row)
+                write_rows_in_batches(f,writer,csv_data,batch_size)
             return 1
     else:                                                                                       #if user wants to update existing file
         if os.path.exists(os.path.join(output_path,claims_file_name)):
             with open(os.path.join(output_path,claims_file_name),mode='a',newline='') as f:
                 writer = csv.writer(f, delimiter=',')
-                for row in csv_data:
-                    writer.writerow(row)
+                write_rows_in_batches(f,writer,csv_data,batch_size)
             return 1
         else:
             print("There is not existing file to update. Therefore can not proceed.")
             return 0
 
 
+def write_rows_in_batches(f, writer, csv_data, batch_size=1000):
+    """Pulls rows from csv_data batch_size at a time, writes them and flushes
+    the file so that memory stays flat however many rows are written
+
+    Arguments:
+        f {file} -- open csv file
+        writer {csv.writer} -- writer of the open csv file
+        csv_data {iterable} -- rows to write
+    """
+    rows=iter(csv_data)
+    batch=list(islice(rows,batch_size))
+    while batch:
+        with STATS.timer('write'):
+            writer.writerows(batch)
+            f.flush()
+        STATS.count('rows_written',len(batch))
+        batch=list(islice(rows,batch_size))
+
+
 def get_csv_values_from_claim(claims):
     """Takes a fhirclient.models.claim.Claim object and returns a list of 
     strings for the following attributes
@@ -158,11 +517,104 @@ def get_csv_values_from_claim(claims):
     Returns:
         list -- list of String values
     """
-    ## parsing attributes from claim object
-    csv_data=[[obj.status,obj.use,(obj.billablePeriod.start.date).isoformat(),(obj.billablePeriod.end.date).isoformat(),obj.total.value,obj.total.code] for obj in claims]
+    csv_data=[get_csv_value_from_claim(obj) for obj in claims]
     return(csv_data)
 
 
+def get_csv_value_from_claim(obj):
+    """Returns the csv row of a single fhirclient.models.claim.Claim object,
+    see get_csv_values_from_claim for the format
+
+    Arguments:
+        obj {fhirclient.models.claim.Claim} -- fhir Claim object
+
+    Returns:
+        list -- list of String values
+    """
+    ## parsing attributes from claim object
+    return [obj.status,obj.use,(obj.billablePeriod.start.date).isoformat(),(obj.billablePeriod.end.date).isoformat(),obj.total.value,obj.total.code]
+
+
+def get_csv_value_from_claim_json(claim):
+    """Returns the same csv row as get_csv_value_from_claim, read straight
+    from the claim json without building a fhirclient object
+
+    Arguments:
+        claim {dict} -- claim resource json
+
+    Returns:
+        list -- list of String values
+    """
+    billable_period=claim['billablePeriod']
+    return [claim.get('status'),claim.get('use'),get_iso_date(billable_period['start']),get_iso_date(billable_period['end']),claim['total'].get('value'),claim['total'].get('code')]
+
+
+def get_iso_date(value):
+    """Normalizes a fhir date or dateTime string the same way
+    fhirclient.models.fhirdate.FHIRDate(value).date.isoformat() does
+    """
+    if 'T' in value:
+        return datetime.fromisoformat(value).isoformat()
+    return date.fromisoformat(value).isoformat()
+
+
+def add_extended_arguments(parser):
+    """Adds the options that the entry point below this file's marker does
+    not know about. They have no defaults here so that
+    is_extended_command_line can tell whether any of them was given."""
+    parser.add_argument("-w", "--workers", type=int, help="number of worker processes used to parse the fhir bundles")
+    parser.add_argument("--chunk-size", type=int, help="number of fhir bundles handed to a worker process at a time")
+    parser.add_argument("--incremental", action="store_true", help="only parse fhir bundles added or changed since the last run and update the csv file")
+    parser.add_argument("--stats", help="record counters, stage timers and peak memory and write them as JSON to this file ('-' prints them)")
+    parser.add_argument("--profile-stage", choices=['read','json_load','bundle','filter','write'], help="run cProfile over this stage only, needs --stats")
+    parser.add_argument("--parse-mode", choices=['bundle','filtered','dict'], help="how much of each fhir bundle is turned into fhirclient objects")
+
+
+def is_extended_command_line(argv):
+    """True when argv asks for help or uses any option of add_extended_arguments,
+    a plain -f/-o command line is left to the original entry point"""
+    if '-h' in argv or '--help' in argv:
+        return True
+    parser=argparse.ArgumentParser(add_help=False,argument_default=argparse.SUPPRESS)
+    add_extended_arguments(parser)
+    return bool(vars(parser.parse_known_args(argv)[0]))
+
+
+def get_extended_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--fhir", default="data/fhir/", help="path to the fhir data directory for this assignment e.g. ~/assignments/data/fhir")
+    parser.add_argument("-o", "--output", default="out/", help="path to the output directory for this assignment e.g. ~/assignments/out")
+    add_extended_arguments(parser)
+    parser.set_defaults(workers=1,chunk_size=1,incremental=False,parse_mode='filtered')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of the command line with worker processes, incremental
+    runs, stats and parse modes, see get_extended_args
+
+    Keyword Arguments:
+        argv {list} -- command line arguments, sys.argv[1:] when None (default: {None})
+
+    Returns:
+        int -- 1 if the csv file was written, 0 otherwise
+    """
+    parsed_args = get_extended_args(argv)
+    if parsed_args.stats:
+        STATS.enable(parsed_args.stats, parsed_args.profile_stage)
+    claims = parse_claims_into_csv(parsed_args.fhir, parsed_args.output, 'claims.csv', parsed_args.workers, parsed_args.chunk_size, parsed_args.parse_mode, parsed_args.incremental)
+    if(claims):     #execute if all operations are executed successfully
+        print(f"The output csv file is created at folder path {parsed_args.output}")
+    else:
+        print("Due to above error, program was halted.")
+    return claims
+
+
+if __name__ == "__main__" and is_extended_command_line(sys.argv[1:]):
+    main()
+    sys.exit(0)
+
+
  #DO NOT MODIFY BELOW THIS LINE
 def get_parsed_args():
     parser = argparse.ArgumentParser()
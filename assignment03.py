@@ -1,6 +1,28 @@
+import io
+import mmap
 import json
+import gzip
+import zlib
 import csv
 import os
+import sqlite3
+import multiprocessing
+from functools import partial
+from datetime import datetime, timedelta
+from collections import deque
+from array import array
+from collections.abc import Mapping
+
+
+class PatientDictionary(dict):
+    """Dictionary of patients as returned by create_patient_dictionary. Besides
+    the patients it carries encounter_medications, the index from (patient
+    Id, encounter Id) to {medication CODE: medication DESCRIPTION} that
+    add_medications_to_patients fills and problem2 reads."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encounter_medications=dict()
 
 
 def create_patient_dictionary(patient_file_name):
@@ -22,7 +44,7 @@ def create_patient_dictionary(patient_file_name):
         [dict] -- dictionary of all patients in the patients.csv
     """
     #creating patient dictionary to save each patient details
-    patient_dict=dict()
+    patient_dict=PatientDictionary()
     if(os.path.exists(patient_file_name)):
         with open(patient_file_name, mode="r") as f:   
             patient=csv.DictReader(f)
@@ -35,7 +57,7 @@ def create_patient_dictionary(patient_file_name):
         return 0
         
 
-def add_encounters_to_patients(patients, encounters_file_name, resource_name='ENCOUNTERS'):
+def add_encounters_to_patients(patients, encounters_file_name, resource_name='ENCOUNTERS', workers=1):
     """
     Parses a synthea generated encounters file and appends encounters to the
     appropriate patient based on the patient Id. A new key identified by the
@@ -56,28 +78,29 @@ def add_encounters_to_patients(patients, encounters_file_name, resource_name='EN
     
     Keyword Arguments:
         resource_name {str} -- [description] (default: {'ENCOUNTERS'})
+        workers {int} -- processes parsing the file, see read_csv_rows (default: {1})
     """
-    #creating encounters and patients dictionary to save each record
-    encounters_dict=dict()
-    patient_record_dict=dict()
+    if isinstance(patients,PatientStore) and os.path.exists(encounters_file_name):
+        patients.add_resource_rows(encounters_file_name,resource_name,ENCOUNTER_FIELDS,'Id',grouped=False,workers=workers)
+        return(patients)
+    if isinstance(patients,PatientDatabase) and os.path.exists(encounters_file_name):
+        patients.add_resource_rows(encounters_file_name,resource_name,'encounters',ENCOUNTER_FIELDS,workers=workers)
+        return(patients)
     if(os.path.exists(encounters_file_name)):
-        with open(encounters_file_name, mode="r") as f:
-            encounters=csv.DictReader(f)
-            for row in encounters:  #traversing through each encounter record
-                if row['PATIENT'] in patients.keys():   #if we found the patient key in encounter record
-                    patient_record_dict=patients[row['PATIENT']]    #ectract the patient record for temporary purpose
-                    #create encounter dictionary record with required values
-                    encounters_dict[row['Id']]={'Id':row['Id'],'START':row['START'],'STOP':row['STOP'],'CODE':row['CODE'],'DESCRIPTION':row['DESCRIPTION'].strip(' ')}
-                    #add this record to temporary patient record
-                    patient_record_dict[resource_name]=encounters_dict
-                    patients[row['PATIENT']]=patient_record_dict          #finally add temporary record to patient dictionary
+        for patient_id, encounter_id, start, stop, code, description in read_csv_rows(encounters_file_name,ENCOUNTER_FIELDS,workers):   #traversing through each encounter record
+            patient_record_dict=patients.get(patient_id)     #hash lookup of the patient of this encounter
+            if patient_record_dict is not None:
+                #each patient gets its own encounter dictionary, created on its first encounter
+                encounters_dict=patient_record_dict.setdefault(resource_name,dict())
+                #create encounter dictionary record with required values
+                encounters_dict[encounter_id]={'Id':encounter_id,'START':start,'STOP':stop,'CODE':code,'DESCRIPTION':description}
         return(patients)
     else:
         print("Encounters directory path you have provided is wrong! Please provide correct file path.")
         return 0
     
 
-def add_medications_to_patients(patients, medications_file_name, resource_name='MEDICATIONS'):
+def add_medications_to_patients(patients, medications_file_name, resource_name='MEDICATIONS', workers=1):
     """Parses a synthea generated medications file and appends medications to the
     appropriate patient based on the patient Id. A new key identified by the
     resource_name is added to the patient dictionary as a key. The value of the
@@ -95,34 +118,581 @@ def add_medications_to_patients(patients, medications_file_name, resource_name='
     
     Keyword Arguments:
         resource_name {str} -- [description] (default: {'MEDICATIONS'})
+        workers {int} -- processes parsing the file, see read_csv_rows (default: {1})
     """
-    medications_list=[]
-    temp_medication_lists=[]
-    patient_record_dict=dict()
+    if isinstance(patients,PatientStore) and os.path.exists(medications_file_name):
+        patients.add_resource_rows(medications_file_name,resource_name,MEDICATION_FIELDS,'CODE',grouped=True,workers=workers)
+        return(patients)
+    if isinstance(patients,PatientDatabase) and os.path.exists(medications_file_name):
+        patients.add_resource_rows(medications_file_name,resource_name,'medications',MEDICATION_FIELDS,workers=workers)
+        return(patients)
+    #encounter to medication index used by problem2, only kept for the default resource name problem2 reads
+    encounter_medications=getattr(patients,'encounter_medications',None) if resource_name=='MEDICATIONS' else None
     #check if file path exist
     if(os.path.exists(medications_file_name)):
-        with open(medications_file_name, mode="r") as f:
-            medications=csv.DictReader(f)
-            for row in medications: #traverse through each medication record
-                if row['PATIENT'] in patients.keys(): #finding out the patient id in medication record
-                    patient_record_dict=patients[row['PATIENT']] #extracting patient record for temporary purpose
-                    #creating medication record with required values
-                    medications_list=[{'ENCOUNTER':row['ENCOUNTER'],'START':row['START'],'STOP':row['STOP'],'CODE':row['CODE'],'DESCRIPTION':row['DESCRIPTION'].strip(' ')}]
-                    if resource_name in patients[row['PATIENT']].keys():    #if medication key already exist
-                        if row['CODE'] in patients[row['PATIENT']][resource_name].keys():   #if medication code already exist
-                            temp_medication_lists=patients[row['PATIENT']][resource_name][row['CODE']]
-                            temp_medication_lists.append(medications_list[0])   #attaching dictionary from above created list
-                            patient_record_dict[resource_name][row['CODE']]=temp_medication_lists
-                        else:
-                            patient_record_dict[resource_name][row['CODE']]=medications_list
-                    else:
-                        patient_record_dict[resource_name]={row['CODE']:medications_list}
-                    patients[row['PATIENT']]=patient_record_dict       #finally attaching updated temporary patient record to patient  
+        for patient_id, encounter_id, start, stop, code, description in read_csv_rows(medications_file_name,MEDICATION_FIELDS,workers): #traverse through each medication record
+            patient_record_dict=patients.get(patient_id)    #finding out the patient id in medication record
+            if patient_record_dict is None:
+                continue
+            if encounter_medications is not None:   #first description seen for a code in an encounter, as problem2 reports
+                encounter_medications.setdefault((patient_id,encounter_id),dict()).setdefault(code,description)
+            #creating medication record with required values and attaching it to the list of its code
+            medication={'ENCOUNTER':encounter_id,'START':start,'STOP':stop,'CODE':code,'DESCRIPTION':description}
+            patient_record_dict.setdefault(resource_name,dict()).setdefault(code,[]).append(medication)
         return(patients)
     else:
         print("Medications directory path you have provided is wrong! Please provide correct file path.")
         return 0
 
+PATIENT_FIELDS=['Id','BIRTHDATE','FIRST','LAST','GENDER']
+ENCOUNTER_FIELDS=['Id','START','STOP','CODE','DESCRIPTION']
+MEDICATION_FIELDS=['ENCOUNTER','START','STOP','CODE','DESCRIPTION']
+
+
+def read_csv_rows(file_name, fields, workers=1, range_size=16*1024*1024):
+    """Yields [PATIENT]+fields of every row of a synthea csv file as plain
+    lists, with DESCRIPTION stripped of spaces. No dictionary is built per
+    row. With one worker the rows come out in file order.
+
+    With more than one worker the rows are decoded from the partial groupings
+    of read_csv_groups, range by range in file order and, within a range,
+    patient by patient. The rows of a patient therefore keep their file
+    order whatever the number of workers.
+
+    Arguments:
+        file_name {str} -- path to a synthea csv file with a PATIENT column
+        fields {list} -- names of the columns to return after PATIENT
+
+    Keyword Arguments:
+        workers {int} -- number of worker processes, None for one per cpu (default: {1})
+        range_size {int} -- bytes parsed by a worker at a time (default: {16MB})
+    """
+    if workers is not None and workers<=1:
+        positions, description_position=get_csv_positions(file_name,fields)
+        with open(file_name, mode="r") as f:
+            reader=csv.reader(f)
+            next(reader)
+            for row in reader:
+                row=[row[position] for position in positions]
+                if description_position is not None:
+                    row[description_position]=row[description_position].strip(' ')
+                yield row
+        return
+
+    number_of_fields=len(fields)
+    for strings, groups in read_csv_groups(file_name,fields,workers,range_size):
+        for patient_id, codes in groups.items():
+            for start in range(0,len(codes),number_of_fields):
+                yield [patient_id]+[strings[code] for code in codes[start:start+number_of_fields]]
+
+
+def read_csv_groups(file_name, fields, workers=1, range_size=16*1024*1024):
+    """Yields the partial groupings of read_csv_range for the byte ranges of a
+    synthea csv file, in file order. The file is split into ranges that start
+    at line starts and, with more than one worker, the ranges are parsed by a
+    process pool. Workers send back only the distinct strings of their range
+    and integer codes grouped by patient, and the results are read back in
+    range order, so merging them in the order they are yielded gives the
+    same result whatever the number of workers. Fields must not hold line
+    breaks, which is the case for synthea exports.
+
+    Arguments:
+        file_name {str} -- path to a synthea csv file with a PATIENT column
+        fields {list} -- names of the columns to return after PATIENT
+
+    Keyword Arguments:
+        workers {int} -- number of worker processes, None for one per cpu (default: {1})
+        range_size {int} -- bytes parsed by a worker at a time (default: {16MB})
+    """
+    positions, description_position=get_csv_positions(file_name,fields)
+    read_range=partial(read_csv_range,file_name=file_name,positions=positions,description_position=description_position)
+    if workers is not None and workers<=1:
+        for byte_range in get_csv_ranges(file_name,range_size):
+            yield read_range(byte_range)
+        return
+
+    workers=workers or os.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        pending=deque()
+        for byte_range in get_csv_ranges(file_name,range_size):
+            pending.append(pool.apply_async(read_range,(byte_range,)))
+            if len(pending)>=2*workers:             #parsed ranges wait in memory, keep only a few of them ahead
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def get_csv_positions(file_name, fields):
+    """Returns the column positions of PATIENT and fields and the position of
+    DESCRIPTION among them, None when it is not one of the fields"""
+    with open(file_name, mode="r") as f:
+        header=next(csv.reader(f))
+    positions=[header.index('PATIENT')]+[header.index(field) for field in fields]
+    description_position=positions.index(header.index('DESCRIPTION')) if 'DESCRIPTION' in fields else None
+    return positions, description_position
+
+
+def get_csv_ranges(file_name, range_size):
+    """Splits the rows of a csv file into (start, end) byte ranges of about
+    range_size bytes, each starting at the start of a line"""
+    size=os.path.getsize(file_name)
+    with open(file_name, mode="rb") as f:
+        f.readline()                                #header line
+        boundaries=[f.tell()]
+        while boundaries[-1]<size:
+            f.seek(min(boundaries[-1]+range_size,size))
+            f.readline()                            #moving on to the start of the next line
+            boundaries.append(min(f.tell(),size))
+    return list(zip(boundaries[:-1],boundaries[1:]))
+
+
+def read_csv_range(byte_range, file_name, positions, description_position):
+    """Parses the rows of one byte range of a csv file into a partial grouping:
+    the distinct strings of the range in the order they were first seen and,
+    for every patient Id, an array('i') of the codes of its rows into those
+    strings, one code per field after PATIENT, rows in file order
+
+    Returns:
+        tuple -- (list of strings, dict of patient Id to array of codes)
+    """
+    start, end=byte_range
+    with open(file_name, mode="rb") as f:
+        f.seek(start)
+        data=f.read(end-start)
+    strings=StringPool()
+    encode=strings.encode
+    groups=dict()
+    for row in csv.reader(io.TextIOWrapper(io.BytesIO(data))):     #decoded like open() in text mode does
+        row=[row[position] for position in positions]
+        if description_position is not None:
+            row[description_position]=row[description_position].strip(' ')
+        codes=groups.get(row[0])
+        if codes is None:
+            codes=groups[row[0]]=array('i')
+        codes.extend(encode(value) for value in row[1:])
+    return strings.values, groups
+
+
+class StringPool:
+    """Dictionary encodes strings: every distinct string is stored once and
+    referred to by its integer code"""
+
+    def __init__(self):
+        self.codes=dict()
+        self.values=[]
+
+    def encode(self, value):
+        code=self.codes.get(value)
+        if code is None:
+            code=len(self.values)
+            self.codes[value]=code
+            self.values.append(value)
+        return code
+
+
+class StringColumn:
+    """Values of one field as an integer array of codes into a StringPool
+    shared by the columns of a store, for fields with few distinct values
+    such as codes and descriptions"""
+
+    def __init__(self, strings):
+        self.strings=strings
+        self.codes=array('i')
+
+    def append(self, value):
+        self.codes.append(self.strings.encode(value))
+
+    def extend(self, values):
+        self.codes.extend(map(self.strings.encode,values))
+
+    def decode(self, rows):
+        values=self.strings.values
+        codes=self.codes
+        return [values[codes[row]] for row in rows]
+
+
+class UuidColumn:
+    """Values of a field of Ids that are nearly all distinct, e.g. encounter
+    Ids, stored as 16 bytes per row instead of one string object per Id. A
+    value that is not a lowercase canonical UUID is kept as it is in others."""
+
+    def __init__(self, strings=None):
+        self.values=bytearray()
+        self.others=dict()                          #row -> value that does not round trip through 16 bytes
+        self.rows=0
+
+    def append(self, value):
+        try:
+            raw=bytes.fromhex(value.replace('-',''))
+        except ValueError:
+            raw=b''
+        if len(raw)!=16 or format_uuid(raw)!=value:
+            self.others[self.rows]=value
+            raw=bytes(16)
+        self.values+=raw
+        self.rows+=1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def decode(self, rows):
+        values=self.values
+        decoded=[format_uuid(values[16*row:16*row+16]) for row in rows]
+        if self.others:
+            decoded=[self.others.get(row,value) for row, value in zip(rows,decoded)]
+        return decoded
+
+
+def format_uuid(raw):
+    text=raw.hex()
+    return text[:8]+'-'+text[8:12]+'-'+text[12:16]+'-'+text[16:20]+'-'+text[20:]
+
+
+class TimestampColumn:
+    """Values of a timestamp field such as START or STOP, YYYY-MM-DDTHH:MM:SS
+    followed by a zone suffix like Z or -05:00, stored as one int64 per row:
+    the seconds since FIRST_TIMESTAMP times ZONE_SLOTS plus the number of
+    the suffix in zones. '' is stored as EMPTY, any value that would not be
+    written back the same way as OTHER and kept in others."""
+    ZONE_SLOTS=64
+    EMPTY=-1
+    OTHER=-2
+
+    def __init__(self, strings=None):
+        self.values=array('q')
+        self.zones=dict()                           #suffix -> number, in the order first seen
+        self.zone_names=[]
+        self.others=dict()
+
+    def append(self, value):
+        encoded=self.OTHER
+        try:
+            timestamp=datetime.fromisoformat(value[:19])
+        except ValueError:
+            timestamp=None
+        if timestamp is not None and timestamp.isoformat()==value[:19]:    #e.g. no dates without leading zeros
+            zone=self.zones.get(value[19:])
+            if zone is None and len(self.zone_names)<self.ZONE_SLOTS:
+                zone=self.zones[value[19:]]=len(self.zone_names)
+                self.zone_names.append(value[19:])
+            if zone is not None:
+                encoded=(timestamp-FIRST_TIMESTAMP)//ONE_SECOND*self.ZONE_SLOTS+zone
+        elif value=='':
+            encoded=self.EMPTY
+        if encoded==self.OTHER:
+            self.others[len(self.values)]=value
+        self.values.append(encoded)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def decode(self, rows):
+        decoded=[]
+        for row in rows:
+            encoded=self.values[row]
+            if encoded<0:
+                decoded.append('' if encoded==self.EMPTY else self.others[row])
+            else:
+                seconds, zone=divmod(encoded,self.ZONE_SLOTS)
+                decoded.append((FIRST_TIMESTAMP+ONE_SECOND*seconds).isoformat()+self.zone_names[zone])
+        return decoded
+
+
+FIRST_TIMESTAMP=datetime(1,1,1)
+ONE_SECOND=timedelta(seconds=1)
+
+
+#columns of the resource fields whose values are nearly all distinct, all other fields are StringColumn
+FIELD_COLUMNS={'Id':UuidColumn,'ENCOUNTER':UuidColumn,'START':TimestampColumn,'STOP':TimestampColumn}
+
+
+class ResourceColumns:
+    """Rows of one resource (encounters or medications) stored as one column
+    per field, see FIELD_COLUMNS. Rows are grouped by the integer key of
+    their patient.
+
+    Arguments:
+        fields {list} -- names of the stored fields
+        key_field {str} -- field used as key of the per patient dictionary
+        grouped {bool} -- if True the value of a key is the list of all rows
+        with that key (medications), otherwise the single row (encounters)
+        strings {StringPool} -- pool of the StringColumn fields
+    """
+
+    def __init__(self, fields, key_field, grouped, strings):
+        self.fields=fields
+        self.key_field=key_field
+        self.grouped=grouped
+        self.patient=array('i')
+        self.columns={field:FIELD_COLUMNS.get(field,StringColumn)(strings) for field in fields}
+        self.offsets=None
+        self.rows=None
+
+    def append(self, patient, values):
+        self.patient.append(patient)
+        for field, value in zip(self.fields,values):
+            self.columns[field].append(value)
+        self.offsets=None                           #grouping has to be rebuilt
+
+    def extend(self, patient, values):
+        """Appends the rows of one patient given as their values one row after the other"""
+        number_of_fields=len(self.fields)
+        self.patient.extend([patient]*(len(values)//number_of_fields))
+        for position, field in enumerate(self.fields):
+            self.columns[field].extend(values[position::number_of_fields])
+        self.offsets=None
+
+    def group_by_patient(self, number_of_patients):
+        """Counting sort of the row numbers by patient, rows of patient p are
+        rows[offsets[p]:offsets[p+1]] in file order"""
+        counts=[0]*(number_of_patients+1)
+        for patient in self.patient:
+            counts[patient+1]+=1
+        for i in range(number_of_patients):
+            counts[i+1]+=counts[i]
+        position=counts[:-1]
+        rows=array('i',bytes(4*len(self.patient)))
+        for row, patient in enumerate(self.patient):
+            rows[position[patient]]=row
+            position[patient]+=1
+        self.offsets=array('i',counts)
+        self.rows=rows
+
+    def patient_rows(self, patient, number_of_patients):
+        if self.offsets is None:
+            self.group_by_patient(number_of_patients)
+        return self.rows[self.offsets[patient]:self.offsets[patient+1]]
+
+
+class PatientStore(Mapping):
+    """Columnar, memory compact alternative to the nested patient dictionary
+    built by create_patient_dictionary, add_encounters_to_patients and
+    add_medications_to_patients.
+
+    Patient fields, codes and descriptions are integer arrays of codes into
+    a single StringPool, so repeated values are kept once. Encounter Ids are
+    kept as 16 bytes and timestamps as int64 per row, see FIELD_COLUMNS,
+    and patients are referred to by integer keys. The store is a read only
+    Mapping from patient Id to the same dictionary the nested version holds,
+    built on access, so problem1, problem2 and write_ndjson run against it
+    unchanged.
+    """
+
+    def __init__(self):
+        self.strings=StringPool()
+        self.patient_index=dict()                   #patient Id -> integer patient key
+        self.patient_columns={field:array('i') for field in PATIENT_FIELDS}
+        self.resources=dict()                       #resource name -> ResourceColumns
+        self.last_patient=(None,None)               #problem2 reads the same patient many times in a row
+
+    def add_patient(self, row):
+        patient=self.patient_index.get(row['Id'])
+        if patient is not None:                     #a repeated Id keeps its position and takes the last values, as in the dictionary
+            for field in PATIENT_FIELDS:
+                self.patient_columns[field][patient]=self.strings.encode(row[field])
+            self.last_patient=(None,None)
+            return
+        self.patient_index[row['Id']]=len(self.patient_index)
+        for field in PATIENT_FIELDS:
+            self.patient_columns[field].append(self.strings.encode(row[field]))
+
+    def add_resource_rows(self, file_name, resource_name, fields, key_field, grouped, workers=1):
+        resource=self.resources.get(resource_name)
+        if resource is None:
+            resource=self.resources[resource_name]=ResourceColumns(fields,key_field,grouped,self.strings)
+        if workers is not None and workers<=1:
+            for row in read_csv_rows(file_name,fields,workers):    #plain list rows, no dictionary per row
+                patient=self.patient_index.get(row[0])
+                if patient is None:
+                    continue
+                resource.append(patient,row[1:])
+        else:
+            for strings, groups in read_csv_groups(file_name,fields,workers):     #rows already grouped by the workers
+                for patient_id, codes in groups.items():
+                    patient=self.patient_index.get(patient_id)
+                    if patient is not None:
+                        resource.extend(patient,[strings[code] for code in codes])
+        self.last_patient=(None,None)
+
+    def get_patient(self, patient):
+        values=self.strings.values
+        record={field:values[self.patient_columns[field][patient]] for field in PATIENT_FIELDS}
+        for resource_name, resource in self.resources.items():
+            rows=resource.patient_rows(patient,len(self.patient_index))
+            if not rows:
+                continue
+            columns=[resource.columns[field].decode(rows) for field in resource.fields]
+            items=dict()
+            for row_values in zip(*columns):
+                item=dict(zip(resource.fields,row_values))
+                if resource.grouped:
+                    items.setdefault(item[resource.key_field],[]).append(item)
+                else:
+                    items[item[resource.key_field]]=item
+            record[resource_name]=items
+        return record
+
+    def __getitem__(self, patient_id):
+        if self.last_patient[0]==patient_id:
+            return self.last_patient[1]
+        record=self.get_patient(self.patient_index[patient_id])
+        self.last_patient=(patient_id,record)
+        return record
+
+    def __iter__(self):
+        return iter(self.patient_index)
+
+    def __len__(self):
+        return len(self.patient_index)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.patient_index
+
+
+def create_patient_store(patient_file_name):
+    """Same as create_patient_dictionary but returns a PatientStore.
+    add_encounters_to_patients and add_medications_to_patients accept the
+    store in place of the patient dictionary.
+
+    Arguments:
+        patient_file_name {str} -- file path including name to a synthea 
+        patients.csv file
+
+    Returns:
+        PatientStore -- columnar store of all patients in the patients.csv
+    """
+    store=PatientStore()
+    if(os.path.exists(patient_file_name)):
+        with open(patient_file_name, mode="r") as f:
+            for row in csv.DictReader(f):
+                store.add_patient(row)
+        return(store)
+    else:
+        print("Patients directory path you have provided is wrong! Please provide correct file path.")
+        return 0
+
+
+class PatientDatabase(Mapping):
+    """SQLite backed, out of core alternative to the nested patient dictionary.
+    patients.csv, encounters.csv and medications.csv are bulk loaded into a
+    database file with indexes on the patient, encounter and code columns,
+    so memory use does not grow with the size of the export.
+
+    Like PatientStore it is a read only Mapping from patient Id to the same
+    dictionary the nested version holds, built on access with indexed
+    queries, so write_ndjson streams the patients straight from the
+    database. problem1 and problem2 run as queries.
+
+    Arguments:
+        database_file_name {str} -- SQLite database file, created when it does not exist
+    """
+
+    def __init__(self, database_file_name):
+        self.database_file_name=database_file_name
+        self.connection=sqlite3.connect(database_file_name)
+        self.connection.execute("PRAGMA journal_mode=OFF")     #the database is rebuilt from the csv files, no need for a rollback journal
+        self.connection.execute("PRAGMA synchronous=OFF")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS patients (Id TEXT PRIMARY KEY, BIRTHDATE TEXT, FIRST TEXT, LAST TEXT, GENDER TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS encounters (RESOURCE TEXT, PATIENT TEXT, Id TEXT, START TEXT, STOP TEXT, CODE TEXT, DESCRIPTION TEXT)")
+            self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS encounters_patient ON encounters (PATIENT, RESOURCE, Id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS medications (RESOURCE TEXT, PATIENT TEXT, ENCOUNTER TEXT, START TEXT, STOP TEXT, CODE TEXT, DESCRIPTION TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS resources (RESOURCE TEXT PRIMARY KEY, TABLE_NAME TEXT)")
+        self.resources=self.connection.execute("SELECT RESOURCE, TABLE_NAME FROM resources ORDER BY rowid").fetchall()
+
+    def add_patients(self, file_name):
+        with open(file_name, mode="r") as f, self.connection:
+            rows=([row[field] for field in PATIENT_FIELDS] for row in csv.DictReader(f))
+            #a repeated Id keeps its first position and its last values, as in the dictionary
+            self.connection.executemany("INSERT INTO patients VALUES (?,?,?,?,?) ON CONFLICT(Id) DO UPDATE SET "
+                                        "BIRTHDATE=excluded.BIRTHDATE, FIRST=excluded.FIRST, LAST=excluded.LAST, GENDER=excluded.GENDER",rows)
+
+    def add_resource_rows(self, file_name, resource_name, table_name, fields, workers=1):
+        with self.connection:
+            rows=([resource_name]+row+[row[0]] for row in read_csv_rows(file_name,fields,workers))
+            insert="INSERT INTO %s (RESOURCE, PATIENT, %s) SELECT %s WHERE EXISTS (SELECT 1 FROM patients WHERE Id=?)"%(table_name,', '.join(fields),','.join('?'*(len(fields)+2)))
+            if table_name=='encounters':    #a repeated encounter Id of a patient keeps its first position and its last values
+                insert+=" ON CONFLICT(PATIENT, RESOURCE, Id) DO UPDATE SET "+", ".join("%s=excluded.%s"%(field,field) for field in fields[1:])
+            self.connection.executemany(insert,rows)            #rows are streamed from the file, only patients of patients.csv are kept
+            self.connection.execute("INSERT OR IGNORE INTO resources VALUES (?,?)",(resource_name,table_name))
+            if table_name=='medications':   #built once the rows are in, faster than keeping them up to date while loading
+                self.connection.execute("CREATE INDEX IF NOT EXISTS medications_patient ON medications (PATIENT, RESOURCE)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS medications_encounter ON medications (RESOURCE, ENCOUNTER, CODE)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS medications_code ON medications (RESOURCE, CODE)")
+        self.resources=self.connection.execute("SELECT RESOURCE, TABLE_NAME FROM resources ORDER BY rowid").fetchall()
+
+    def get_medication_codes(self, resource_name='MEDICATIONS'):
+        return [code for (code,) in self.connection.execute("SELECT DISTINCT CODE FROM medications WHERE RESOURCE=?",(resource_name,))]
+
+    def get_encounter_medication_descriptions(self):
+        """Distinct (encounter description, medication description) of the
+        MEDICATIONS documented in an ENCOUNTERS encounter of the same patient,
+        with the first description of a code within an encounter"""
+        query='''SELECT DISTINCT e.DESCRIPTION, m.DESCRIPTION
+                 FROM (SELECT PATIENT, ENCOUNTER, DESCRIPTION, MIN(rowid) FROM medications WHERE RESOURCE='MEDICATIONS' GROUP BY PATIENT, ENCOUNTER, CODE) m
+                 JOIN encounters e ON e.PATIENT=m.PATIENT AND e.RESOURCE='ENCOUNTERS' AND e.Id=m.ENCOUNTER'''
+        return self.connection.execute(query).fetchall()    #bare columns of a MIN() aggregate come from the row with the minimum
+
+    def __getitem__(self, patient_id):
+        row=self.connection.execute("SELECT %s FROM patients WHERE Id=?"%', '.join(PATIENT_FIELDS),(patient_id,)).fetchone()
+        if row is None:
+            raise KeyError(patient_id)
+        record=dict(zip(PATIENT_FIELDS,row))
+        for resource_name, table_name in self.resources:
+            fields=ENCOUNTER_FIELDS if table_name=='encounters' else MEDICATION_FIELDS
+            rows=self.connection.execute("SELECT %s FROM %s WHERE PATIENT=? AND RESOURCE=? ORDER BY rowid"%(', '.join(fields),table_name),(patient_id,resource_name))
+            items=dict()
+            for row in rows:
+                item=dict(zip(fields,row))
+                if table_name=='encounters':
+                    items[item['Id']]=item
+                else:
+                    items.setdefault(item['CODE'],[]).append(item)
+            if items:
+                record[resource_name]=items
+        return record
+
+    def __iter__(self):
+        for (patient_id,) in self.connection.execute("SELECT Id FROM patients ORDER BY rowid"):     #cursor is read as it goes, the Ids are never all in memory
+            yield patient_id
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def __contains__(self, patient_id):
+        return self.connection.execute("SELECT 1 FROM patients WHERE Id=?",(patient_id,)).fetchone() is not None
+
+
+def create_patient_database(patient_file_name, database_file_name=None):
+    """Same as create_patient_dictionary but loads the patients into a new
+    PatientDatabase. add_encounters_to_patients and add_medications_to_patients
+    accept the database in place of the patient dictionary.
+
+    Arguments:
+        patient_file_name {str} -- file path including name to a synthea 
+        patients.csv file
+
+    Keyword Arguments:
+        database_file_name {str} -- database file, replaced if it exists, assignment03.sqlite3
+        next to patients.csv when None (default: {None})
+
+    Returns:
+        PatientDatabase -- database of all patients in the patients.csv
+    """
+    if(os.path.exists(patient_file_name)):
+        database_file_name=database_file_name or os.path.join(os.path.dirname(os.path.abspath(patient_file_name)),"assignment03.sqlite3")
+        if os.path.exists(database_file_name):
+            os.remove(database_file_name)
+        database=PatientDatabase(database_file_name)
+        database.add_patients(patient_file_name)
+        return(database)
+    else:
+        print("Patients directory path you have provided is wrong! Please provide correct file path.")
+        return 0
+
+
 def problem1(patients):
     """Returns a list of distinct medication codes across all patients
     
@@ -133,6 +703,8 @@ def problem1(patients):
         list -- list of distinct medication codes
     """
     resource_name='MEDICATIONS'
+    if isinstance(patients,PatientDatabase):    #distinct codes straight from the code index
+        return patients.get_medication_codes(resource_name)
     unique_codes=set()
     set_of_unique_codes=set()
     #traversing through each patient id
@@ -155,26 +727,303 @@ def problem2(patients):
         tuples
     """
     resource_name1='ENCOUNTERS'
-    resource_name2='MEDICATIONS'
     description_key='DESCRIPTION'
+    if isinstance(patients,PatientDatabase):
+        return patients.get_encounter_medication_descriptions()
     set_of_description=set()
-    encounterid_list,medication_encounter_id_list=[],[]
-    for row in patients:    #traversing through each patient
-        if resource_name1 in patients[row].keys() and resource_name2 in patients[row].keys(): #check if ENCOUNTERS and MEDICATIONS key exist
-            encounterid_list=patients[row][resource_name1].keys() #extract all encounter id keys into list
-            for medication_id in patients[row][resource_name2].keys():  #traverse through each medication id from MEDICATION item in dictionary
-                lenth_of_medication_list=len(patients[row][resource_name2][medication_id]) #calculate the length of each list of MEDICATION item
-                #extract all encounter id from medication item
-                medication_encounter_id_list=[patients[row][resource_name2][medication_id][i]['ENCOUNTER'] for i in range(lenth_of_medication_list)]
-                #traverse through each encounter id extracted in above list
-                for medication_encounter_id in medication_encounter_id_list:
-                    if medication_encounter_id in encounterid_list:  #if encounter id found in medication code exist in ENCOUNTER item 
-                        encounter_description=patients[row][resource_name1][medication_encounter_id][description_key] #description of encounter
-                        list_to_medications=patients[row][resource_name2][medication_id]  #description of medication
-                        medication_description=[description[description_key] for description in list_to_medications if description['ENCOUNTER']==medication_encounter_id][0]
-                        set_of_description.update([(encounter_description,medication_description)]) #creating set of each medication and encounter description
+    encounter_medications=getattr(patients,'encounter_medications',None)
+    if not encounter_medications:           #index was not built while loading, build it in one pass
+        encounter_medications=get_encounter_medications(patients)
+    for (patient_id, encounter_id), medication_descriptions in encounter_medications.items():
+        patient=patients.get(patient_id)
+        if patient is None:                 #patient was removed after its medications were indexed
+            continue
+        encounters=patient.get(resource_name1)
+        if encounters and encounter_id in encounters:   #only encounters where medications were documented
+            encounter_description=encounters[encounter_id][description_key]
+            set_of_description.update((encounter_description,medication_description) for medication_description in medication_descriptions.values())
     return (list(set_of_description))
 
+def get_encounter_medications(patients, resource_name='MEDICATIONS'):
+    """Builds the index from (patient Id, encounter Id) to {medication CODE:
+    medication DESCRIPTION} from the MEDICATIONS of every patient. The first
+    description of a code within an encounter is kept. The patient is part
+    of the key because problem2 only pairs a medication with an encounter
+    of its own patient.
+
+    Arguments:
+        patients {dict} -- dictionary of patients
+
+    Returns:
+        dict -- (patient Id, encounter Id) to dict of medication descriptions
+    """
+    encounter_medications=dict()
+    for patient_id in patients:
+        for code, medications_list in patients[patient_id].get(resource_name,{}).items():
+            for medication in medications_list:
+                encounter_medications.setdefault((patient_id,medication['ENCOUNTER']),dict()).setdefault(code,medication['DESCRIPTION'])
+    return encounter_medications
+
+def write_ndjson_files(file_name, patients, workers=1, batch_size=1000, compress=False, shards=1, index=False):
+    """write_ndjson for large cohorts. Patients are serialized in batches and
+    every batch is written with a single write. Batches are written in
+    patient order, so the output does not depend on the number of workers.
+    Without compression and sharding file_name is byte for byte what
+    write_ndjson writes.
+
+    With more than one worker the batches are serialized, compressed and
+    split into shards by a process pool. Workers are only sent the position
+    range of a batch in the patient order and read the patients from their
+    own copy of patients. Where the platform forks processes the copy is
+    inherited, so the patient records are never pickled; where it spawns
+    them (Windows, macOS) patients is pickled once per worker. A
+    PatientDatabase is never pickled or shared, every worker opens its file
+    again. Only the finished texts come back.
+
+    With compress every batch is gzip compressed on its own and the members
+    are appended, which gzip.open, zcat and other gzip readers read as one
+    stream. With shards the patients go to shards files by a stable hash of
+    the patient Id. With index a sidecar index of the byte offset of every
+    patient is written next to the files, see NdjsonIndex.
+
+    Arguments:
+        file_name {str} -- output file, shard numbers and .gz are added to it when needed
+        patients {dict} -- dictionary of patients, a PatientStore or a PatientDatabase
+
+    Keyword Arguments:
+        workers {int} -- processes serializing and compressing the batches, None for one per cpu (default: {1})
+        batch_size {int} -- patients serialized and written at a time (default: {1000})
+        compress {bool} -- write gzip compressed files (default: {False})
+        shards {int} -- number of output files (default: {1})
+        index {bool} -- also write the index file get_ndjson_index_name(file_name), needs uncompressed files (default: {False})
+
+    Returns:
+        list -- names of the written files
+    """
+    if index and compress:
+        raise ValueError("The byte offset index can only be written for uncompressed files")
+    file_names=get_ndjson_file_names(file_name,compress,shards)
+    outputs=[open(name,'wb' if compress else 'w') for name in file_names]
+    if index:
+        outputs.append(open_ndjson_index(get_ndjson_index_name(file_name),file_names))
+    write_ndjson_batch=partial(write_ndjson_lines,outputs,offsets=[0]*shards if index else None)
+    serialize=partial(serialize_patients,shards=shards,compress=compress)
+    try:
+        if workers is not None and workers<=1:
+            for batch in get_patient_batches(patients,batch_size):
+                write_ndjson_batch(serialize(batch))
+        else:
+            workers=workers or os.cpu_count()
+            patient_ids=list(patients)
+            context=multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+            source=patients.database_file_name if isinstance(patients,PatientDatabase) else patients     #sqlite connections can not be pickled or shared
+            with context.Pool(workers,initializer=set_ndjson_worker_patients,initargs=(source,patient_ids)) as pool:
+                pending=deque()
+                for start in range(0,len(patient_ids),batch_size):
+                    pending.append(pool.apply_async(serialize_patient_range,((start,start+batch_size),shards,compress)))
+                    if len(pending)>=2*workers:     #serialized batches wait in memory, keep only a few of them ahead
+                        write_ndjson_batch(pending.popleft().get())
+                while pending:
+                    write_ndjson_batch(pending.popleft().get())
+    finally:
+        for output in outputs:
+            output.close()
+    return file_names
+
+
+def get_ndjson_file_names(file_name, compress=False, shards=1):
+    if compress and not file_name.endswith('.gz'):
+        file_name+='.gz'
+    if shards==1:
+        return [file_name]
+    stem, extension=(file_name[:-3],'.gz') if compress else (file_name,'')
+    stem, ndjson_extension=os.path.splitext(stem)
+    return ["%s-%05d-of-%05d%s%s"%(stem,shard,shards,ndjson_extension,extension) for shard in range(shards)]
+
+
+def get_patient_batches(patients, batch_size):
+    batch=[]
+    for patient_id in patients:
+        batch.append((patient_id,patients[patient_id]))
+        if len(batch)==batch_size:
+            yield batch
+            batch=[]
+    if batch:
+        yield batch
+
+
+def get_patient_shard(patient_id, shards):
+    return zlib.crc32(patient_id.encode())%shards      #same shard in every run, unlike hash()
+
+
+NDJSON_WORKER_PATIENTS=None       #(patients, patient Ids in write order) of a write_ndjson_files worker process
+
+
+def set_ndjson_worker_patients(patients, patient_ids):
+    """Initializer of the write_ndjson_files workers, patients is the file
+    name of a PatientDatabase, which every worker opens on its own"""
+    global NDJSON_WORKER_PATIENTS
+    if isinstance(patients,str):
+        patients=PatientDatabase(patients)
+    NDJSON_WORKER_PATIENTS=(patients,patient_ids)
+
+
+def serialize_patient_range(patient_range, shards=1, compress=False):
+    """serialize_patients for the patients at positions start to stop of the
+    patient order, read from the patients of this worker process"""
+    patients, patient_ids=NDJSON_WORKER_PATIENTS
+    start, stop=patient_range
+    return serialize_patients([(patient_id,patients[patient_id]) for patient_id in patient_ids[start:stop]],shards,compress)
+
+
+def serialize_patients(batch, shards=1, compress=False):
+    """Serializes a batch of (patient Id, patient) into one NDJSON text per
+    shard, gzip compressed bytes with compress. Also returns the (patient Id,
+    line length without the line break) of every line of every shard."""
+    lines=[[] for shard in range(shards)]
+    line_lengths=[[] for shard in range(shards)]
+    for patient_id, patient in batch:
+        shard=get_patient_shard(patient_id,shards) if shards>1 else 0
+        line=json.dumps(patient, separators=(',', ':'))
+        lines[shard].append(line + "\n")
+        line_lengths[shard].append((patient_id,len(line)))     #json.dumps escapes non ascii characters, characters are bytes
+    texts=["".join(shard_lines) for shard_lines in lines]
+    if compress:
+        texts=[gzip.compress(text.encode(),compresslevel=6,mtime=0) if text else b"" for text in texts]   #no timestamp, same bytes in every run
+    return texts, line_lengths
+
+
+def write_ndjson_lines(outputs, serialized, offsets=None):
+    """Writes the texts of serialize_patients to the shard files and, when
+    offsets (the current size of every shard) is given, their index entries
+    to the index file that follows the shard files in outputs"""
+    texts, line_lengths=serialized
+    for shard, text in enumerate(texts):
+        if text:
+            outputs[shard].write(text)
+        if offsets is not None:
+            for patient_id, length in line_lengths[shard]:
+                outputs[-1].write("%s\t%d\t%d\t%d\n"%(patient_id,shard,offsets[shard],length))
+                offsets[shard]+=length+len(os.linesep)     #text mode writes os.linesep for every \n
+
+
+def get_ndjson_index_name(file_name):
+    if file_name.endswith('.gz'):
+        file_name=file_name[:-3]
+    return file_name+".index"
+
+
+def open_ndjson_index(index_file_name, file_names):
+    """Creates an index file, its first line lists the indexed files relative to it"""
+    index=open(index_file_name,'w')
+    index_dir=os.path.dirname(os.path.abspath(index_file_name))
+    index.write("\t".join(["#ndjson-index"]+[os.path.relpath(os.path.abspath(name),index_dir) for name in file_names])+"\n")
+    return index
+
+
+def build_ndjson_index(file_names, index_file_name=None):
+    """Indexes NDJSON files that were written without an index, e.g. by
+    write_ndjson, with one sequential read of every file
+
+    Arguments:
+        file_names {str or list} -- NDJSON file or the shard files in shard order
+
+    Keyword Arguments:
+        index_file_name {str} -- index file, get_ndjson_index_name of the first file when None (default: {None})
+
+    Returns:
+        str -- name of the index file
+    """
+    if isinstance(file_names,str):
+        file_names=[file_names]
+    index_file_name=index_file_name or get_ndjson_index_name(file_names[0])
+    decoder=json.JSONDecoder()
+    with open_ndjson_index(index_file_name,file_names) as index:
+        for shard, file_name in enumerate(file_names):
+            offset=0
+            with open(file_name,'rb') as f:
+                for line in f:
+                    length=len(line.rstrip(b"\r\n"))
+                    if line.startswith(b'{"Id":'):      #write_ndjson writes the Id first, only its value is decoded
+                        patient_id=decoder.raw_decode(line[:512].decode(errors='ignore'),6)[0]
+                    else:
+                        patient_id=json.loads(line)['Id']
+                    index.write("%s\t%d\t%d\t%d\n"%(patient_id,shard,offset,length))
+                    offset+=len(line)
+    return index_file_name
+
+
+class NdjsonIndex:
+    """Random access to the patients of NDJSON files through their index file.
+    The index is read once. A patient is then read with a single positioned
+    read, and batches of patients through a memory map of each file in
+    offset order.
+
+    Arguments:
+        index_file_name {str} -- index written by write_ndjson_files or build_ndjson_index
+    """
+
+    def __init__(self, index_file_name):
+        index_dir=os.path.dirname(os.path.abspath(index_file_name))
+        self.entries=dict()                     #patient Id -> (shard, offset, length)
+        with open(index_file_name) as index:
+            header=index.readline().rstrip("\n").split("\t")
+            if header[0]!="#ndjson-index":
+                raise ValueError("%s is not an NDJSON index file"%index_file_name)
+            self.file_names=[os.path.join(index_dir,name) for name in header[1:]]
+            for line in index:
+                patient_id, shard, offset, length=line.rstrip("\n").split("\t")
+                self.entries[patient_id]=(int(shard),int(offset),int(length))
+        self.files=[None]*len(self.file_names)
+
+    def get_file(self, shard):
+        if self.files[shard] is None:
+            self.files[shard]=open(self.file_names[shard],'rb')
+        return self.files[shard]
+
+    def get_patient(self, patient_id):
+        """Returns the patient dictionary of patient_id, KeyError when it is not indexed"""
+        shard, offset, length=self.entries[patient_id]
+        f=self.get_file(shard)
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+    def get_patients(self, patient_ids):
+        """Returns {patient Id: patient dictionary} of the indexed ones of patient_ids"""
+        found=sorted((self.entries[patient_id],patient_id) for patient_id in set(patient_ids) if patient_id in self.entries)
+        patients=dict()
+        shard_map=(None,None)
+        try:
+            for (shard, offset, length), patient_id in found:
+                if shard_map[0]!=shard:
+                    if shard_map[1] is not None:
+                        shard_map[1].close()
+                    shard_map=(shard,mmap.mmap(self.get_file(shard).fileno(),0,access=mmap.ACCESS_READ))
+                patients[patient_id]=json.loads(shard_map[1][offset:offset+length])
+        finally:
+            if shard_map[1] is not None:
+                shard_map[1].close()
+        return patients
+
+    def close(self):
+        for f in self.files:
+            if f is not None:
+                f.close()
+        self.files=[None]*len(self.file_names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, patient_id):
+        return patient_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
 # do not modify below this line
 
 def write_ndjson(file_name, patients):
@@ -2,20 +2,23 @@
 
 import sys
 import os
+import argparse
+import re
 import json
-import numpy as np
-import pandas as pd
-from datetime import date
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import fhirclient.models.bundle as b
-import seaborn as sns
+import errno
+import shutil
+import hashlib
+import multiprocessing
+from functools import partial, lru_cache
+from datetime import date, datetime, timezone
 from textwrap import wrap
+from instrumentation import STATS
+from fhir_stream import iter_bundle_entries, load_bundle_json, map_bundle_files
 
 
 
 
-def get_fhir_object_list(bundle_path,object_name='Patient'):
+def get_fhir_file_list(bundle_path):
     fhir_dir=os.path.abspath(bundle_path)       #getting absolute path of fhir file directory 
     
     if not os.path.exists(fhir_dir):            #Checking if that file already exist
@@ -23,26 +26,370 @@ def get_fhir_object_list(bundle_path,object_name='Patient'):
         return 0    
     
     try:
-        list_of_all_files=[file for file in os.listdir(fhir_dir) if os.path.isfile(os.path.join(fhir_dir,file))]    #listing out all files from directory
+        list_of_all_files=[os.path.join(fhir_dir,file) for file in sorted(os.listdir(fhir_dir)) if os.path.isfile(os.path.join(fhir_dir,file))]    #listing out all files from directory in a fixed order
     except:
         print("There are no files in existing directory. Please try running program again.")
         return 0
+    return list_of_all_files
 
-    fhir_objects=[]
-    
-    for file in list_of_all_files:
-        bundle=parse_bundle_for_file(os.path.join(fhir_dir,file))           #creating bundle object of each file
-        fhir_objects.append(get_objects_from_bundle(bundle,object_name))    #appending each bundle in the claim list
+
+def get_objects_from_file(fhir_bundle_path, object_name='Patient'):
+    bundle=parse_bundle_for_file(fhir_bundle_path,[object_name])    #creating objects only for the required entries of the file
+    if not bundle:
+        return []
+    return get_objects_from_bundle(bundle,object_name)
+
+
+def get_fhir_object_list(bundle_path,object_name='Patient',workers=1,chunk_size=1):
+    if isinstance(bundle_path,(FhirCorpus,FhirColumnStore)):    #corpus was already parsed, no need to read the bundles again
+        return bundle_path.get_objects(object_name)
+
+    list_of_all_files=get_fhir_file_list(bundle_path)
+    if not list_of_all_files:
+        return 0
+
+    get_objects=partial(get_objects_from_file,object_name=object_name)
+    fhir_objects=map_bundle_files(get_objects,list_of_all_files,workers,chunk_size)   #list of objects for each bundle
     
     flattened_objects=[obj for fhir_obj in fhir_objects for obj in fhir_obj]     #as resource object was not one dimentional. creating 1d list of bundle objects
     return flattened_objects
 
 
-def parse_bundle_for_file(fhir_bundle_path):
-    with open(fhir_bundle_path,'r', encoding="utf8") as f:
-        fhir_object=json.load(f)            #loading bundle object
+def get_fhir_json_list(bundle_path,object_name='Patient',fields=None,workers=1,chunk_size=1):
+    """Lighter version of get_fhir_object_list that never builds fhirclient
+    objects. Returns the resource json of every object_name entry, projected
+    to the top level fields when fields is given.
+
+    Arguments:
+        bundle_path {str} -- path to Synthea generated FHIR bundles
+
+    Keyword Arguments:
+        object_name {str} -- resource type to return (default: {'Patient'})
+        fields {list} -- top level resource fields to keep, whole resource when None (default: {None})
+        workers {int} -- number of worker processes (default: {1})
+        chunk_size {int} -- number of files sent to a worker at a time (default: {1})
+    """
+    list_of_all_files=get_fhir_file_list(bundle_path)
+    if not list_of_all_files:
+        return 0
+
+    get_json=partial(get_json_from_file,object_name=object_name,fields=fields)
+    fhir_objects=map_bundle_files(get_json,list_of_all_files,workers,chunk_size)
+    return [obj for fhir_obj in fhir_objects for obj in fhir_obj]
+
+
+def get_json_from_file(fhir_bundle_path, object_name='Patient', fields=None):
+    resources=(entry['resource'] for entry in iter_bundle_entries(fhir_bundle_path,[object_name]))
+    if fields is not None:
+        resources=({field:resource[field] for field in fields if field in resource} for resource in resources)    #keeping only the needed fields of each entry
+    resources=list(resources)
+    STATS.keep(object_name,len(resources))
+    return resources
+
+
+class FhirCorpus:
+    """Parses a directory of fhir bundles once and keeps the resources indexed
+    by their resource type (Patient, Condition, Observation, Claim, ...), so
+    that every plot can be drawn from the same parsed data.
+
+    A corpus can be passed to get_fhir_object_list and to every plot_*
+    function in place of the bundle_path.
+
+    Arguments:
+        bundle_path {str} -- path to Synthea generated FHIR bundles
+
+    Keyword Arguments:
+        object_names {list} -- resource types to keep, all types are kept when None (default: {None})
+        workers {int} -- number of worker processes used to parse the bundles (default: {1})
+        chunk_size {int} -- number of files sent to a worker at a time (default: {1})
+    """
+
+    def __init__(self, bundle_path, object_names=None, workers=1, chunk_size=1):
+        self.bundle_path=bundle_path
+        self.resources={}
+        list_of_all_files=get_fhir_file_list(bundle_path)
+        if not list_of_all_files:
+            return
+        get_resources=partial(get_resources_from_file,object_names=object_names)
+        for bundle_resources in map_bundle_files(get_resources,list_of_all_files,workers,chunk_size):   #each bundle is parsed only once for all resource types
+            for object_name, objects in bundle_resources.items():
+                self.resources.setdefault(object_name,[]).extend(objects)
+
+    def get_objects(self, object_name='Patient'):
+        return self.resources.get(object_name,[])
+
+
+def get_resources_from_file(fhir_bundle_path, object_names=None):
+    bundle=parse_bundle_for_file(fhir_bundle_path,object_names)
+    resources={}
+    if not bundle:
+        return resources
+    with STATS.timer('filter'):
+        for entry in bundle.entry or []:
+            object_name=entry.request.url
+            if object_names is None or object_name in object_names:
+                resources.setdefault(object_name,[]).append(entry.resource) #grouping resources of the bundle by their type
+    for object_name, objects in resources.items():
+        STATS.keep(object_name,len(objects))
+    return resources
+
+
+#resource types and columns kept by the column store: column name, kind, attribute path
+#of the fhirclient objects the column stands for and json path it is read from.
+#category columns are dictionary encoded int32 codes, date columns datetime64[D],
+#datetime columns datetime64[s] in UTC and float columns float64 with NaN when absent
+STORE_COLUMNS={
+    'Patient':[('gender','category','gender','gender'),
+               ('birth_date','date','birthDate.date','birthDate'),
+               ('deceased_date','date','deceasedDateTime.date.date()','deceasedDateTime'),
+               ('race','category','extension[0].extension[0].valueCoding.display','extension[0].extension[0].valueCoding.display'),
+               ('birth_country','category','extension[4].valueAddress.country','extension[4].valueAddress.country'),
+               ('marital_status','category','maritalStatus.coding[0].display','maritalStatus.coding[0].display')],
+    'Condition':[('patient','category','subject.reference','subject.reference'),
+                 ('code','category','code.coding[0].code','code.coding[0].code'),
+                 ('display','category','code.coding[0].display','code.coding[0].display'),
+                 ('onset','datetime','onsetDateTime.date','onsetDateTime')],
+    'Observation':[('patient','category','subject.reference','subject.reference'),
+                   ('code','category','code.coding[0].code','code.coding[0].code'),
+                   ('value','float','valueQuantity.value','valueQuantity.value'),
+                   ('component_value','float','component[0].valueQuantity.value','component[0].valueQuantity.value'),
+                   ('effective','datetime','effectiveDateTime.date','effectiveDateTime')]}
+STORE_VERSION=1
+DEFAULT_STORE_ROOT=os.path.join(os.path.expanduser("~"),".cache","fhir_column_store")
+
+
+class FhirColumnStore:
+    """Memory mapped columnar store of a fhir bundle directory, written by
+    compile_fhir_store. Like a FhirCorpus it can be passed to
+    get_fhir_object_list and to every plot_* function in place of the
+    bundle_path; the resources of a type are then a FhirColumnTable.
+
+    Arguments:
+        store_dir {str} -- directory written by compile_fhir_store
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir=store_dir
+        with open(os.path.join(store_dir,"manifest.json")) as f:
+            self.manifest=json.load(f)
+        self.bundle_path=self.manifest['bundle_path']
+        self.tables={}
+
+    def get_objects(self, object_name='Patient'):
+        if object_name not in self.manifest['tables']:
+            raise KeyError(f"{object_name} resources are not kept in the column store, see STORE_COLUMNS")
+        if object_name not in self.tables:
+            self.tables[object_name]=FhirColumnTable(os.path.join(self.store_dir,object_name),object_name,self.manifest['tables'][object_name])
+        return self.tables[object_name]
+
+
+class FhirColumnTable:
+    """Columns of one resource type of a FhirColumnStore, one row per
+    resource in bundle order. Works in place of the list of fhirclient
+    objects for get_resource_data, get_observation_resource_data and
+    get_condition_comorbidity_matrix.
+
+    Arguments:
+        table_dir {str} -- directory of the .npy column files
+        object_name {str} -- resource type
+        table {dict} -- rows and columns of the table from the store manifest
+    """
+
+    def __init__(self, table_dir, object_name, table):
+        self.table_dir=table_dir
+        self.object_name=object_name
+        self.rows=table['rows']
+        self.columns=table['columns']
+        self.paths={column['path']:name for name, column in self.columns.items()}
+        self.arrays={}
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        """Returns the memory mapped array of a column, category columns hold
+        codes into dictionary(name), -1 for None and -2 for an absent path"""
+        import numpy as np
+        if name not in self.arrays:
+            self.arrays[name]=np.load(os.path.join(self.table_dir,name+".npy"),mmap_mode='r')
+        return self.arrays[name]
+
+    def dictionary(self, name):
+        return self.columns[name]['dictionary']
+
+    def decode(self, path):
+        """Returns the value at an attribute path for every resource, as the
+        fhirclient accessor of that path would, with MISSING for an absent path
+
+        Arguments:
+            path {str} -- attribute path of a STORE_COLUMNS column
+        """
+        if path not in self.paths:
+            raise KeyError(f"'{path}' of {self.object_name} is not kept in the column store, see STORE_COLUMNS")
+        name=self.paths[path]
+        kind=self.columns[name]['kind']
+        values=self.column(name).tolist()
+        if kind=='category':
+            lookup=self.columns[name]['dictionary']+[MISSING,None]     #code -2 reads MISSING and -1 None
+            return [lookup[code] for code in values]
+        if kind=='float':
+            return [value if value==value else MISSING for value in values]     #NaN is the only float not equal to itself
+        if kind=='datetime':
+            return [value.replace(tzinfo=timezone.utc) if value is not None else MISSING for value in values]
+        return [value if value is not None else MISSING for value in values]
+
+
+def get_fhir_store_dir(bundle_path):
+    fhir_dir=os.path.abspath(bundle_path)
+    return os.path.join(DEFAULT_STORE_ROOT,hashlib.sha256(fhir_dir.encode()).hexdigest()[:16])     #one store per bundle directory
+
+
+def get_fhir_store_signature(list_of_all_files):
+    """Hash of the names, sizes and modification times of the bundle files and
+    of the store layout, any change of the directory changes it"""
+    files=[]
+    for file in list_of_all_files:
+        stat=os.stat(file)
+        files.append([os.path.basename(file),stat.st_size,stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps([STORE_VERSION,STORE_COLUMNS,files]).encode()).hexdigest()
+
+
+def compile_fhir_store(bundle_path, store_dir=None, workers=1, chunk_size=1):
+    """Compiles a directory of fhir bundles into a FhirColumnStore holding the
+    STORE_COLUMNS of every resource. An existing store is reused as long as
+    no bundle file was added, removed or changed, otherwise it is rebuilt.
+    The bundles are read as plain json, no fhirclient objects are built.
+
+    Arguments:
+        bundle_path {str} -- path to Synthea generated FHIR bundles
+
+    Keyword Arguments:
+        store_dir {str} -- directory of the store, one per bundle directory under DEFAULT_STORE_ROOT when None (default: {None})
+        workers {int} -- number of worker processes reading the bundles (default: {1})
+        chunk_size {int} -- number of files sent to a worker at a time (default: {1})
+
+    Returns:
+        FhirColumnStore -- the memory mapped store, 0 when there are no bundles
+    """
+    list_of_all_files=get_fhir_file_list(bundle_path)
+    if not list_of_all_files:
+        return 0
+    store_dir=store_dir or get_fhir_store_dir(bundle_path)
+    signature=get_fhir_store_signature(list_of_all_files)
+    if os.path.exists(os.path.join(store_dir,"manifest.json")):
+        store=FhirColumnStore(store_dir)
+        if store.manifest.get('signature')==signature:
+            return store
+
+    build_dir=store_dir+".build%d"%os.getpid()
+    shutil.rmtree(build_dir,ignore_errors=True)
+    manifest={'version':STORE_VERSION,'bundle_path':os.path.abspath(bundle_path),'signature':signature}
+    write_fhir_store(list_of_all_files,build_dir,manifest,workers,chunk_size)
+    old_dir=store_dir+".old%d"%os.getpid()
+    while True:
+        shutil.rmtree(old_dir,ignore_errors=True)
+        try:
+            os.replace(store_dir,old_dir)       #previous store moved aside, never deleted in place
+        except FileNotFoundError:
+            pass
+        try:
+            os.replace(build_dir,store_dir)     #a directory is only ever renamed into place complete
+            break
+        except OSError as error:
+            if error.errno not in (errno.ENOTEMPTY,errno.EEXIST):
+                raise
+            try:                                #a concurrent compile moved its store in first
+                same_store=FhirColumnStore(store_dir).manifest.get('signature')==signature
+            except OSError:
+                same_store=False
+            if same_store:
+                shutil.rmtree(build_dir,ignore_errors=True)
+                break
+    shutil.rmtree(old_dir,ignore_errors=True)
+    return FhirColumnStore(store_dir)
+
+
+def write_fhir_store(list_of_all_files, store_dir, manifest, workers=1, chunk_size=1):
+    """Writes the column files of the bundles and then the manifest, with the
+    rows and columns of every table added to manifest"""
+    import numpy as np
+    values={object_name:{column[0]:[] for column in columns} for object_name, columns in STORE_COLUMNS.items()}
+    for file_values in map_bundle_files(get_column_values_from_file,list_of_all_files,workers,chunk_size):
+        for object_name, columns in file_values.items():
+            for name, column_values in columns.items():
+                values[object_name][name].extend(column_values)
+
+    manifest['tables']={}
+    for object_name, columns in STORE_COLUMNS.items():
+        os.makedirs(os.path.join(store_dir,object_name))
+        table=manifest['tables'][object_name]={'rows':0,'columns':{}}
+        for name, kind, path, json_path in columns:
+            column_values=values[object_name].pop(name)
+            column={'kind':kind,'path':path}
+            if kind=='category':
+                codes={}                                            #dictionary encoding in order of first appearance
+                array=np.array([codes.setdefault(value,len(codes)) if isinstance(value,str) else value for value in column_values],dtype=np.int32)
+                column['dictionary']=list(codes)
+            elif kind=='date':
+                array=np.array(column_values,dtype='datetime64[D]')
+            elif kind=='datetime':
+                nat=np.iinfo(np.int64).min
+                array=np.array([nat if value is None else value for value in column_values],dtype=np.int64).view('datetime64[s]')
+            else:
+                array=np.array(column_values,dtype=np.float64)
+            np.save(os.path.join(store_dir,object_name,name+".npy"),array)
+            table['rows']=len(array)
+            table['columns'][name]=column
+    with open(os.path.join(store_dir,"manifest.json"),"w") as f:
+        json.dump(manifest,f)
+
+
+def get_column_values_from_file(fhir_bundle_path):
+    """Reads the STORE_COLUMNS of every resource of a bundle file as picklable
+    values: strings with -1 for None and -2 for an absent path for category
+    columns, YYYY-MM-DD or None for dates, UTC epoch seconds or None for
+    datetimes and NaN for absent numbers"""
+    accessors={object_name:[(name,kind,compile_attribute_path(json_path,True)) for name, kind, path, json_path in columns]
+               for object_name, columns in STORE_COLUMNS.items()}
+    values={}
+    for entry in iter_bundle_entries(fhir_bundle_path,list(STORE_COLUMNS)):
+        object_name=entry['request']['url']
+        resource=entry['resource']
+        columns=values.get(object_name)
+        if columns is None:
+            columns=values[object_name]={name:[] for name, kind, accessor in accessors[object_name]}
+        for name, kind, accessor in accessors[object_name]:
+            try:
+                value=accessor(resource)
+            except MissingAttributeError:
+                value=MISSING
+            if kind=='category':
+                value=value if isinstance(value,str) else -2 if value is MISSING else -1
+            elif kind=='date':
+                value=value[:10] if isinstance(value,str) else None
+            elif kind=='datetime':
+                value=get_epoch_seconds(value) if isinstance(value,str) else None
+            else:
+                value=float(value) if isinstance(value,(int,float)) and not isinstance(value,bool) else float('nan')
+            columns[name].append(value)
+    for object_name, columns in values.items():
+        STATS.keep(object_name,len(next(iter(columns.values()))))
+    return values
+
+
+def get_epoch_seconds(value):
+    timestamp=datetime.fromisoformat(value.replace('Z','+00:00'))
+    if timestamp.tzinfo is None:                #dates without time or zone are taken as UTC
+        timestamp=timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def parse_bundle_for_file(fhir_bundle_path, object_names=None):
+    import fhirclient.models.bundle as b
+    fhir_object=load_bundle_json(fhir_bundle_path,object_names)
     try:
-        bundle=b.Bundle(fhir_object)        #initiating bundle object
+        with STATS.timer('bundle'):
+            bundle=b.Bundle(fhir_object)    #initiating bundle object
         return bundle
     except:
         print("There are no fhir format files in the provided directory. Please try again.")
@@ -50,7 +397,9 @@ def parse_bundle_for_file(fhir_bundle_path):
 
 
 def get_objects_from_bundle(bundle, object_name="Patient"):
-    objects=[entry.resource for entry in bundle.entry if entry.request.url==object_name]   #parsing required object with given name
+    with STATS.timer('filter'):
+        objects=[entry.resource for entry in bundle.entry or [] if entry.request.url==object_name]   #parsing required object with given name
+    STATS.keep(object_name,len(objects))
     return(objects)
 
 def get_age(birth_date):                  #function to get age with given date
@@ -59,73 +408,324 @@ def get_age(birth_date):                  #function to get age with given date
     return(age)
 
 
+class MissingAttributeError(LookupError):
+    """Raised by an attribute accessor when an intermediate segment of the
+    path is None or a list index is out of range"""
+
+
+ATTRIBUTE_PATH_SEGMENT=re.compile(r"([A-Za-z_][A-Za-z0-9_]*)((?:\[\d+\])*)(\(\))?$")
+
+
+@lru_cache(maxsize=None)
+def compile_attribute_path(path, json_resource=False):
+    """Parses a dotted attribute path such as
+    extension[0].extension[0].valueCoding.display or deceasedDateTime.date.date()
+    once and returns a function that reads that path from an object.
+
+    The returned accessor raises MissingAttributeError when a segment before
+    the last one is None or an index is out of range. The last segment is
+    returned as it is, even if it is None. Any other error (e.g. a misspelled
+    attribute name) is raised as usual.
+
+    Arguments:
+        path {str} -- attribute path, segments are name, name[i] or name()
+
+    Keyword Arguments:
+        json_resource {bool} -- read the path from resource json (dicts and lists) instead of fhirclient objects (default: {False})
+
+    Returns:
+        function -- accessor taking an object and returning the value at path
+    """
+    steps=[]
+    for segment in path.split('.'):
+        match=ATTRIBUTE_PATH_SEGMENT.match(segment)
+        if not match:
+            raise ValueError(f"Invalid attribute path segment '{segment}' in '{path}'")
+        name, indexes, call=match.groups()
+        steps.append(('attribute',name))
+        steps.extend(('index',int(index)) for index in re.findall(r"\d+",indexes))
+        if call:
+            steps.append(('call',None))
+
+    get_attribute=dict.get if json_resource else getattr   #absent json fields read as None like unset fhirclient attributes
+
+    def accessor(obj):
+        for kind, value in steps:
+            if obj is None:
+                raise MissingAttributeError(path)
+            if kind=='attribute':
+                obj=get_attribute(obj,value)
+            elif kind=='index':
+                if value>=len(obj):
+                    raise MissingAttributeError(path)
+                obj=obj[value]
+            else:
+                obj=obj()
+        return obj
+    return accessor
+
+
+MISSING=object()        #value of an attribute path whose intermediate segment is absent
+
+
+def get_attribute_values(resource_object, *paths):
+    """Yields a tuple of the values at paths for every object, MISSING where
+    a path raises MissingAttributeError. Reads the columns directly when
+    resource_object is a FhirColumnTable."""
+    if isinstance(resource_object,FhirColumnTable):
+        yield from zip(*[resource_object.decode(path) for path in paths])
+        return
+    accessors=[compile_attribute_path(path) for path in paths]                  #paths are parsed once, not for every object
+    for obj in resource_object:
+        values=[]
+        for accessor in accessors:
+            try:
+                values.append(accessor(obj))
+            except MissingAttributeError:
+                values.append(MISSING)
+        yield tuple(values)
+
+
 def get_resource_data(resource_object,attribute1,attribute2,attribute3="age"):  #getting resource data with given attributes
     data={}
-    for obj in resource_object:
-        if eval(f"obj.{attribute1}") not in data.keys():                        #checking if attribute already exist in dictionary 
-            data[eval(f"obj.{attribute1}")]=[]
-        try:
-            if (isinstance(eval(f"obj.{attribute2}"),date)):                    #if resource data is of date instance
-                if(attribute3.lower()=="age"):                                  #if user wants to know age
-                    data[eval(f"obj.{attribute1}")].append(get_age(eval(f"obj.{attribute2}")))  #insterting a value in a key
-                if(attribute3.lower()=="dead_or_not"):
-                    if(hasattr(obj,attribute2.split('.',1)[0])):
-                        data[eval(f"obj.{attribute1}")].append('True')
-            elif isinstance(eval(f"obj.{attribute2}"),str):                        #if resource data is of string format
-                data[eval(f"obj.{attribute1}")].append(eval(f"obj.{attribute2}"))
-        except:
-            data[eval(f"obj.{attribute1}")].append('False')
+    for key, value in get_attribute_values(resource_object,attribute1,attribute2):
+        if key is MISSING:
+            raise MissingAttributeError(attribute1)
+        if key not in data:                                                     #checking if attribute already exist in dictionary 
+            data[key]=[]
+        if value is MISSING:
+            data[key].append('False')
+            continue
+        if (isinstance(value,date)):                                            #if resource data is of date instance
+            if(attribute3.lower()=="age"):                                      #if user wants to know age
+                data[key].append(get_age(value))                                #insterting a value in a key
+            if(attribute3.lower()=="dead_or_not"):                              #the value was read, so the resource has the attribute
+                data[key].append('True')
+        elif isinstance(value,str):                                             #if resource data is of string format
+            data[key].append(value)
     return data
 
 def get_observation_resource_data(resource_object,attribute1,attribute2,resources): #getting resource data from observation object
     data={}
-    for obj in resource_object:
-        if(eval(f"obj.{attribute1}") in resources):
-            if eval(f"obj.{attribute1}") not in data.keys():
-                data[eval(f"obj.{attribute1}")]=[]
-            try:
-                if eval(f"obj.{attribute1}")=='55284-4':
-                    data[eval(f"obj.{attribute1}")].append(obj.component[0].valueQuantity.value)
-                else:
-                    data[eval(f"obj.{attribute1}")].append(eval(f"obj.{attribute2}"))
-            except:
-                pass
+    for key, value, component_value in get_attribute_values(resource_object,attribute1,attribute2,"component[0].valueQuantity.value"):
+        if key is MISSING:
+            raise MissingAttributeError(attribute1)
+        if(key in resources):
+            if key not in data:
+                data[key]=[]
+            if key=='55284-4':                                                  #blood pressure is stored in its first component
+                value=component_value
+            if value is not MISSING:
+                data[key].append(value)
     return data
 
 
-def plot_age_by_gender(bundle_path, figure_name='q1_age_by_gender.png'):
-    """17 points for correctness, 3 Points for Style and Efficiency
-    See https://briankolowitz.github.io/data-focused-python/individual-project/project-description.html
-    Save the figure to a PNG file with the specified figure_name
-    Note : you CANNOT use Numpy or Pandas
-    Note : you MUST ONLY use matplotlib
-    
+OBSERVATION_JOIN_TOLERANCE=24*60*60     #seconds between two observations of a patient that are still paired by join_observations
+OBSERVATION_COMPONENT_CODES=['55284-4'] #observations whose value is stored in their first component, e.g. blood pressure
+
+
+def get_observation_columns(bundle_path, codes, workers=1, chunk_size=1):
+    """Reads the observations with a code in codes into typed NumPy columns,
+    one row per observation with a patient, an effectiveDateTime and a value.
+    The value of OBSERVATION_COMPONENT_CODES is read from the first component.
+
+    The columns are read straight from the arrays of a FhirColumnStore, from
+    the objects of a FhirCorpus or from the bundle files, streaming only the
+    Observation entries and never building fhirclient objects.
+
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+        codes {list} -- LOINC codes of the observations to read
+
+    Keyword Arguments:
+        workers {int} -- number of worker processes reading bundle files (default: {1})
+        chunk_size {int} -- number of files sent to a worker at a time (default: {1})
+
+    Returns:
+        dict -- 'patient' int32 codes into 'patients', the sorted subject references,
+        'code' int32 codes into codes, 'effective' int64 UTC epoch seconds and 'value' float64
+    """
+    import numpy as np
+    if isinstance(bundle_path,FhirColumnStore):
+        return get_observation_columns_from_table(bundle_path.get_objects('Observation'),codes)
+    if isinstance(bundle_path,FhirCorpus):
+        rows=get_observation_rows(get_attribute_values(bundle_path.get_objects('Observation'),"subject.reference","code.coding[0].code",
+                                                       "effectiveDateTime.date","valueQuantity.value","component[0].valueQuantity.value"),codes)
+    else:
+        list_of_all_files=get_fhir_file_list(bundle_path)
+        if not list_of_all_files:
+            return 0
+        get_rows=partial(get_observation_rows_from_file,codes=codes)
+        rows=[row for file_rows in map_bundle_files(get_rows,list_of_all_files,workers,chunk_size) for row in file_rows]
+
+    patients=sorted(set(row[0] for row in rows))
+    patient_codes={patient:code for code, patient in enumerate(patients)}
+    return {'patient':np.array([patient_codes[row[0]] for row in rows],dtype=np.int32),'patients':patients,
+            'code':np.array([row[1] for row in rows],dtype=np.int32),
+            'effective':np.array([row[2] for row in rows],dtype=np.int64),
+            'value':np.array([row[3] for row in rows],dtype=np.float64)}
+
+
+def get_observation_rows(values, codes):
+    """Turns (subject reference, code, effective datetime, value, component
+    value) tuples into (subject reference, code index, epoch seconds, value)
+    rows for the observations of codes, dropping those without a patient,
+    time or value"""
+    code_index={code:index for index, code in enumerate(codes)}
+    rows=[]
+    for patient_ref, code, effective, value, component_value in values:
+        index=code_index.get(code)
+        if index is None:
+            continue
+        if code in OBSERVATION_COMPONENT_CODES:
+            value=component_value
+        if not isinstance(patient_ref,str) or not isinstance(effective,date) or not isinstance(value,(int,float)):
+            continue
+        if not isinstance(effective,datetime):      #a date alone is read as its midnight
+            effective=datetime.combine(effective,datetime.min.time())
+        if effective.tzinfo is None:                #times without a zone are taken as UTC, as in the column store
+            effective=effective.replace(tzinfo=timezone.utc)
+        rows.append((patient_ref,index,int(effective.timestamp()),value))
+    return rows
+
+
+def get_observation_rows_from_file(fhir_bundle_path, codes):
+    """Rows of get_observation_rows for a single bundle file, read from the
+    streamed Observation entries"""
+    accessors=[compile_attribute_path(path,True) for path in ["subject.reference","code.coding[0].code","effectiveDateTime",
+                                                              "valueQuantity.value","component[0].valueQuantity.value"]]
+    def get_values():
+        for entry in iter_bundle_entries(fhir_bundle_path,['Observation']):
+            values=[]
+            for accessor in accessors:
+                try:
+                    values.append(accessor(entry['resource']))
+                except MissingAttributeError:
+                    values.append(MISSING)
+            if isinstance(values[2],str):
+                values[2]=datetime.fromisoformat(values[2].replace('Z','+00:00'))
+            yield values
+    rows=get_observation_rows(get_values(),codes)
+    STATS.keep('Observation',len(rows))
+    return rows
+
+
+def get_observation_columns_from_table(table, codes):
+    """Columns of get_observation_columns read from the arrays of the
+    Observation FhirColumnTable without decoding single values"""
+    import numpy as np
+    dictionary=table.dictionary('code')
+    code_map=np.full(len(dictionary)+2,-1,dtype=np.int32)          #store codes -2 and -1 land on the last two entries
+    for index, code in enumerate(codes):
+        if code in dictionary:
+            code_map[dictionary.index(code)]=index
+    code=code_map[np.asarray(table.column('code'))]
+    component=np.isin(code,[codes.index(component_code) for component_code in OBSERVATION_COMPONENT_CODES if component_code in codes])
+    value=np.where(component,table.column('component_value'),table.column('value'))
+    effective=np.asarray(table.column('effective'))
+    patient=np.asarray(table.column('patient'))
+    keep=(code>=0)&(patient>=0)&~np.isnat(effective)&~np.isnan(value)
+    patient=patient[keep]
+    patients, patient=np.unique(np.array(table.dictionary('patient'),dtype=object)[patient],return_inverse=True)     #sorted references as for the other sources
+    return {'patient':patient.astype(np.int32),'patients':list(patients),'code':code[keep],
+            'effective':effective[keep].astype(np.int64),'value':value[keep].astype(np.float64)}
+
+
+def join_observations(columns, left_code, right_code, tolerance=OBSERVATION_JOIN_TOLERANCE, direction='nearest'):
+    """As-of join of two observation codes per patient. Every left_code
+    observation is paired with the right_code observation of the same patient
+    closest in time, looking back, forward or both ways, as long as they are
+    at most tolerance seconds apart. Left observations without a partner are
+    dropped, a right observation may be paired more than once.
+
+    Both sides are sorted once by (patient, time) and the patients are laid
+    out one after another on a single time axis, so all partners are found by
+    one vectorized searchsorted over the right side.
+
+    Arguments:
+        columns {dict} -- observation columns as returned by get_observation_columns
+        left_code {int} -- index of the left observation code in the codes read
+        right_code {int} -- index of the right observation code in the codes read
+
+    Keyword Arguments:
+        tolerance {int} -- largest time difference in seconds, None for any (default: {OBSERVATION_JOIN_TOLERANCE})
+        direction {str} -- 'backward' pairs earlier or equal, 'forward' later or equal
+        and 'nearest' the closest right observation, earlier on a tie (default: {'nearest'})
+
+    Returns:
+        dict -- 'patient' int32 codes into 'patients', 'left_effective' and 'right_effective'
+        datetime64[s], 'left_value' and 'right_value' float64, in (patient, left time) order
+    """
+    import numpy as np
+    if direction not in ('backward','forward','nearest'):
+        raise ValueError(f"direction must be 'backward', 'forward' or 'nearest', not '{direction}'")
+    patient=columns['patient'].astype(np.int64)
+    effective=columns['effective']
+    sides=[]
+    for code in (left_code,right_code):
+        rows=np.flatnonzero(columns['code']==code)
+        rows=rows[np.lexsort((effective[rows],patient[rows]))]       #sorted by patient, then time
+        sides.append(rows)
+    left, right=sides
+
+    start=effective.min() if len(effective) else 0
+    span=(effective.max()-start if len(effective) else 0)+(tolerance or 0)+1    #patients further apart than any time difference
+    left_key=patient[left]*span+(effective[left]-start)
+    right_key=patient[right]*span+(effective[right]-start)
+
+    backward=np.searchsorted(right_key,left_key,side='right')-1              #last right observation at or before the left one
+    forward=np.searchsorted(right_key,left_key,side='left')                  #first right observation at or after it
+    backward_distance=np.full(len(left),np.iinfo(np.int64).max)
+    forward_distance=np.full(len(left),np.iinfo(np.int64).max)
+    found=backward>=0
+    found[found]=patient[right[backward[found]]]==patient[left[found]]
+    backward_distance[found]=left_key[found]-right_key[backward[found]]
+    found=forward<len(right)
+    found[found]=patient[right[forward[found]]]==patient[left[found]]
+    forward_distance[found]=right_key[forward[found]]-left_key[found]
+    if direction=='backward':
+        forward_distance[:]=np.iinfo(np.int64).max
+    elif direction=='forward':
+        backward_distance[:]=np.iinfo(np.int64).max
+
+    use_backward=backward_distance<=forward_distance
+    partner=np.where(use_backward,backward,forward)
+    distance=np.where(use_backward,backward_distance,forward_distance)
+    limit=np.iinfo(np.int64).max-1 if tolerance is None else tolerance
+    matched=distance<=limit
+    left=left[matched]
+    right=right[partner[matched]]
+    return {'patient':columns['patient'][left],'patients':columns['patients'],
+            'left_effective':effective[left].astype('datetime64[s]'),'right_effective':effective[right].astype('datetime64[s]'),
+            'left_value':columns['value'][left],'right_value':columns['value'][right]}
+
+
+def get_age_by_gender_data(bundle_path):
+    """Patient ages by gender, the data of plot_age_by_gender
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     patients=get_fhir_object_list(bundle_path)                      #get all patients object
-    data=get_resource_data(patients,"gender","birthDate.date","age")#get required resource data to plots
-    
-    #plot the required data
-    plt.suptitle("Patient age by gender")
+    return get_resource_data(patients,"gender","birthDate.date","age")
+
+def draw_age_by_gender(fig, data):
+    fig.suptitle("Patient age by gender")
     
-    s1=plt.subplot(1,2,1)
+    s1=fig.add_subplot(1,2,1)
     s1.yaxis.tick_right()
     s1.set_yticklabels([])
-    plt.hist(data['male'],bins=20,color='#8b0000',orientation='horizontal')
-    plt.gca().invert_xaxis()
-    plt.xlabel("Count")
+    s1.hist(data['male'],bins=20,color='#8b0000',orientation='horizontal')
+    s1.invert_xaxis()
+    s1.set_xlabel("Count")
     s1.title.set_text("Male")
     
-    s2=plt.subplot(1,2,2)
-    plt.hist(data['female'],bins=20,color='#00008b',orientation='horizontal')
-    plt.xlabel("Count")
+    s2=fig.add_subplot(1,2,2)
+    s2.hist(data['female'],bins=20,color='#00008b',orientation='horizontal')
+    s2.set_xlabel("Count")
     s2.title.set_text("Female")
-       
-    plt.savefig(figure_name, facecolor='grey')
-    plt.show()
 
-def plot_by_gender_and_race(bundle_path, figure_name='q2_by_gender_and_race.png'):
+def plot_age_by_gender(bundle_path, figure_name='q1_age_by_gender.png'):
     """17 points for correctness, 3 Points for Style and Efficiency
     See https://briankolowitz.github.io/data-focused-python/individual-project/project-description.html
     Save the figure to a PNG file with the specified figure_name
@@ -133,38 +733,47 @@ def plot_by_gender_and_race(bundle_path, figure_name='q2_by_gender_and_race.png'
     Note : you MUST ONLY use matplotlib
     
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    show_figure(draw_age_by_gender,get_age_by_gender_data(bundle_path),figure_name)
+
+def draw_gender_bar_chart(fig, data):
+    """Draws male and female bars side by side for every label
+
+    Arguments:
+        fig {matplotlib.figure.Figure} -- figure to draw on
+        data {dict} -- 'title', x 'labels' and the 'male' and 'female' counts per label
     """
-    patients=get_fhir_object_list(bundle_path)                                                  #get all patients object
-    data=get_resource_data(patients,"gender","extension[0].extension[0].valueCoding.display")   #get required data from patient object
-    
-    #plot the required data
-    male_x=sorted(list(set(data['male'])))
-    female_x=sorted(list(set(data['female'])))
-    
-    male_y=[data['male'].count(x) for x in male_x]
-    female_y=[data['female'].count(x) for x in female_x]    
-    
     width=0.2
-    x_labels=[ '\n'.join(wrap(l, 20)) for l in male_x ]
-    xm = [x for x in range(len(male_x))]
+    xm = [x for x in range(len(data['labels']))]
     xf = [x+width for x in xm]
     xpo= [x+width/2 for x in xm]
     
-    ax = plt.subplot()
-    ax.bar(xm, male_y, width, color='#8b0000', label='Male')
-    ax.bar(xf, female_y, width, color='#00008b', label='Female')
+    ax = fig.add_subplot()
+    ax.bar(xm, data['male'], width, color='#8b0000', label='Male')
+    ax.bar(xf, data['female'], width, color='#00008b', label='Female')
     
     ax.set_ylabel('Number of Patients')
-    ax.set_xticklabels(x_labels)
+    ax.set_xticklabels(data['labels'])
     ax.set_xticks(xpo)
-    ax.set_title('Patients by Gender and Race')
+    ax.set_title(data['title'])
     ax.legend()
 
-    plt.savefig(figure_name, facecolor='grey')
-    plt.show()
+def get_by_gender_and_race_data(bundle_path):
+    """Patient counts by gender and race, the data of plot_by_gender_and_race
 
-def plot_by_gender_and_birth_country(bundle_path, figure_name='q3_by_gender_and_birth_country.png'):
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    patients=get_fhir_object_list(bundle_path)                                                  #get all patients object
+    data=get_resource_data(patients,"gender","extension[0].extension[0].valueCoding.display")   #get required data from patient object
+    
+    male_x=sorted(list(set(data['male'])))
+    female_x=sorted(list(set(data['female'])))
+    return {'title':'Patients by Gender and Race','labels':[ '\n'.join(wrap(l, 20)) for l in male_x ],
+            'male':[data['male'].count(x) for x in male_x],'female':[data['female'].count(x) for x in female_x]}
+
+def plot_by_gender_and_race(bundle_path, figure_name='q2_by_gender_and_race.png'):
     """17 points for correctness, 3 Points for Style and Efficiency
     See https://briankolowitz.github.io/data-focused-python/individual-project/project-description.html
     Save the figure to a PNG file with the specified figure_name
@@ -172,40 +781,24 @@ def plot_by_gender_and_birth_country(bundle_path, figure_name='q3_by_gender_and_
     Note : you MUST ONLY use matplotlib
     
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    show_figure(draw_gender_bar_chart,get_by_gender_and_race_data(bundle_path),figure_name)
+
+def get_by_gender_and_birth_country_data(bundle_path):
+    """Patient counts by gender and birth country, the data of plot_by_gender_and_birth_country
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     patients=get_fhir_object_list(bundle_path)                                      #get all patients object
     data=get_resource_data(patients,"gender","extension[4].valueAddress.country")   #get all required data
     
-    #plot required data
-    male_x=set(data['male'])
-    female_x=set(data['female'])
-    
-    total_x=sorted(list(male_x.union(female_x)))
-    
-    male_y=[data['male'].count(x) for x in total_x]
-    female_y=[data['female'].count(x) for x in total_x]    
-    
-    width=0.2
-    x_labels=total_x
-    xm = [x for x in range(len(total_x))]
-    xf = [x+width for x in xm]
-    xpo= [x+width/2 for x in xm]
-    
-    ax = plt.subplot()
-    ax.bar(xm, male_y, width, color='#8b0000', label='Male')
-    ax.bar(xf, female_y, width, color='#00008b', label='Female')
-    
-    ax.set_ylabel('Number of Patients')
-    ax.set_xticklabels(x_labels)
-    ax.set_xticks(xpo)
-    ax.set_title('Patients by Gender and Birth_Country')
-    ax.legend()
+    total_x=sorted(list(set(data['male']).union(set(data['female']))))
+    return {'title':'Patients by Gender and Birth_Country','labels':total_x,
+            'male':[data['male'].count(x) for x in total_x],'female':[data['female'].count(x) for x in total_x]}
 
-    plt.savefig(figure_name,  facecolor='grey')
-    plt.show()
-
-def plot_by_gender_and_mortality(bundle_path, figure_name='q4_by_gender_and_mortality.png'):
+def plot_by_gender_and_birth_country(bundle_path, figure_name='q3_by_gender_and_birth_country.png'):
     """17 points for correctness, 3 Points for Style and Efficiency
     See https://briankolowitz.github.io/data-focused-python/individual-project/project-description.html
     Save the figure to a PNG file with the specified figure_name
@@ -213,66 +806,93 @@ def plot_by_gender_and_mortality(bundle_path, figure_name='q4_by_gender_and_mort
     Note : you MUST ONLY use matplotlib
     
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    show_figure(draw_gender_bar_chart,get_by_gender_and_birth_country_data(bundle_path),figure_name)
+
+def get_by_gender_and_mortality_data(bundle_path):
+    """Patient counts by gender and deceased, the data of plot_by_gender_and_mortality
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     patients=get_fhir_object_list(bundle_path)                                              #get all patients object
     data=get_resource_data(patients,"gender","deceasedDateTime.date.date()","dead_or_not")  #get all required data
     
-    #plot required data
     male_x=sorted(list(set(data['male'])))
     female_x=sorted(list(set(data['female'])))
-    
-    male_y=[data['male'].count(x) for x in male_x]
-    female_y=[data['female'].count(x) for x in female_x]    
-    
-    width=0.2
-    x_labels=male_x
-    xm = [x for x in range(len(male_x))]
-    xf = [x+width for x in xm]
-    xpo= [x+width/2 for x in xm]
-    
-    ax = plt.subplot()
-    ax.bar(xm, male_y, width, color='#8b0000', label='Male')
-    ax.bar(xf, female_y, width, color='#00008b', label='Female')
-    
-    ax.set_ylabel('Number of Patients')
-    ax.set_xticklabels(x_labels)
-    ax.set_xticks(xpo)
-    ax.set_title('Patients by Gender and Deceased')
-    ax.legend()
+    return {'title':'Patients by Gender and Deceased','labels':male_x,
+            'male':[data['male'].count(x) for x in male_x],'female':[data['female'].count(x) for x in female_x]}
 
-    plt.savefig(figure_name,  facecolor='grey')
-    plt.show()
-
-def plot_condition_comorbidity_matrix(bundle_path, figure_name='q5_condition_comorbidity_matrix.png'):
-    """5 Points
-    Plot the condition comorbidity matrix showing the top conditions.
+def plot_by_gender_and_mortality(bundle_path, figure_name='q4_by_gender_and_mortality.png'):
+    """17 points for correctness, 3 Points for Style and Efficiency
     See https://briankolowitz.github.io/data-focused-python/individual-project/project-description.html
     Save the figure to a PNG file with the specified figure_name
+    Note : you CANNOT use Numpy or Pandas
+    Note : you MUST ONLY use matplotlib
+    
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    show_figure(draw_gender_bar_chart,get_by_gender_and_mortality_data(bundle_path),figure_name)
+
+def get_condition_comorbidity_matrix(conditions, top_n=15):
+    """Counts how many patients have each pair of conditions, for the top_n
+    most frequent conditions.
+
+    Patients and condition names are integer encoded, a sparse
+    patient x condition incidence matrix is built and the counts come from a
+    single sparse product of the top_n columns with themselves. The diagonal
+    holds the number of patients having the condition.
 
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        conditions {list or FhirColumnTable} -- fhirclient Condition objects or the Condition table of a FhirColumnStore
+
+    Keyword Arguments:
+        top_n {int} -- number of most frequent conditions to keep (default: {15})
+
+    Returns:
+        pandas.DataFrame -- top_n x top_n co-occurrence counts labelled with the condition names
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+    patient_refs, displays=[], []
+    for display, patient_ref in get_attribute_values(conditions,"code.coding[0].display","subject.reference"):
+        if not isinstance(display,str):         #absent coding or a coding without display
+            continue
+        if patient_ref is MISSING:
+            raise MissingAttributeError("subject.reference")
+        patient_refs.append(patient_ref)
+        displays.append(display)
+
+    patient_codes, _=pd.factorize(pd.Series(patient_refs,dtype=object))            #integer encoding of patients and conditions
+    condition_codes, condition_names=pd.factorize(pd.Series(displays,dtype=object))
+    incidence=sparse.csr_matrix((np.ones(len(patient_codes),dtype=np.int32),(patient_codes,condition_codes)),
+                                shape=(len(set(patient_codes)),len(condition_names)))
+    incidence.data[:]=1                                                             #a condition recorded twice for a patient counts once
+
+    frequency=np.asarray(incidence.sum(axis=0)).ravel()
+    top=np.argsort(-frequency,kind='stable')[:top_n]                                #most frequent conditions first
+    top_incidence=incidence[:,top]
+    counts=(top_incidence.T@top_incidence).toarray()
+    names=list(condition_names[top])
+    return pd.DataFrame(counts,index=names,columns=names)
+
+
+def get_condition_comorbidity_data(bundle_path):
+    """Co-occurrence counts of the 15 most frequent conditions, the data of plot_condition_comorbidity_matrix
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     conditions=get_fhir_object_list(bundle_path,object_name="Condition")
-    patient_dict_conditions=get_resource_data(conditions,"subject.reference","code.coding[0].display","subject_ref")
-    for index, condition in enumerate(patient_dict_conditions.values()):
-        column_names=sorted(list(set(condition)))
-        row_names=sorted(list(set(condition)))
-        if index==0:
-            matrix=np.ones((len(condition),len(condition)),dtype=np.int32)
-            df=pd.DataFrame(matrix,columns=column_names,index=row_names)
-        else:
-            for row in row_names:
-                for col in column_names:
-                    if col not in df.index:
-                        df.loc[col]=0   
-                        df[col]=0
-                    element=df.loc[row][col]
-                    element+=1
-                    df.loc[row][col]=element
-    df=df.iloc[0:15,0:15]
-           
-    fig, ax = plt.subplots()
+    return get_condition_comorbidity_matrix(conditions,top_n=15)
+
+def draw_condition_comorbidity_matrix(fig, df):
+    import numpy as np
+    import matplotlib.ticker as ticker
+    ax = fig.add_subplot()
     fig.set_size_inches(10, 10)
     matrix=ax.matshow(df, interpolation='nearest')
     
@@ -286,20 +906,26 @@ def plot_condition_comorbidity_matrix(bundle_path, figure_name='q5_condition_com
     ax.xaxis.set_major_locator(ticker.MultipleLocator(1))
     ax.yaxis.set_major_locator(ticker.MultipleLocator(1))
     ax.set_title('Condition Comorbidity')
-    plt.xlabel('Condition')
-    plt.ylabel('Condition')   
-    
-    plt.savefig(figure_name,  facecolor='grey')
-    plt.show()
-
+    ax.set_xlabel('Condition')
+    ax.set_ylabel('Condition')   
 
-def plot_challenge_question_1(bundle_path, figure_name='q6_challenge_question_1.png'):
+def plot_condition_comorbidity_matrix(bundle_path, figure_name='q5_condition_comorbidity_matrix.png'):
     """5 Points
-    Plot anything you want that uses at least 2 FHIR resources
+    Plot the condition comorbidity matrix showing the top conditions.
+    See https://briankolowitz.github.io/data-focused-python/individual-project/project-description.html
     Save the figure to a PNG file with the specified figure_name
 
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    show_figure(draw_condition_comorbidity_matrix,get_condition_comorbidity_data(bundle_path),figure_name)
+
+
+def get_challenge_question_1_data(bundle_path):
+    """Patient counts by gender and marital status, the data of plot_challenge_question_1
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     patients=get_fhir_object_list(bundle_path)                                      #get all patients object
     data=get_resource_data(patients,"gender","maritalStatus.coding[0].display")     #get required data from object
@@ -315,89 +941,217 @@ def plot_challenge_question_1(bundle_path, figure_name='q6_challenge_question_1.
     data['female']=['Divorced' if w=='D' else w for w in data['female']]
     data['male']=['Divorced' if w=='D' else w for w in data['female']]
     
-    #plot the required data
-    male_x=set(data['male'])
-    female_x=set(data['female'])
-    
-    total_x=sorted(list(male_x.union(female_x)))
-    
-    male_y=[data['male'].count(x) for x in total_x]
-    female_y=[data['female'].count(x) for x in total_x]    
-    
-    width=0.2
-    x_labels=total_x
-    xm = [x for x in range(len(total_x))]
-    xf = [x+width for x in xm]
-    xpo= [x+width/2 for x in xm]
-    
-    ax = plt.subplot()
-    ax.bar(xm, male_y, width, color='#8b0000', label='Male')
-    ax.bar(xf, female_y, width, color='#00008b', label='Female')
-    
-    ax.set_ylabel('Number of Patients')
-    ax.set_xticklabels(x_labels)
-    ax.set_xticks(xpo)
-    ax.set_title('Patients by Gender and Marital_Status')
-    ax.legend()
+    total_x=sorted(list(set(data['male']).union(set(data['female']))))
+    return {'title':'Patients by Gender and Marital_Status','labels':total_x,
+            'male':[data['male'].count(x) for x in total_x],'female':[data['female'].count(x) for x in total_x]}
+
+def plot_challenge_question_1(bundle_path, figure_name='q6_challenge_question_1.png'):
+    """5 Points
+    Plot anything you want that uses at least 2 FHIR resources
+    Save the figure to a PNG file with the specified figure_name
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    show_figure(draw_gender_bar_chart,get_challenge_question_1_data(bundle_path),figure_name)
+
+def get_challenge_question_2_data(bundle_path):
+    """Total cholesterol measurements paired with the blood pressure of the same
+    patient taken closest to them, one row per pair, the data of plot_challenge_question_2
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    import pandas as pd
+    columns=get_observation_columns(bundle_path,['2093-3','55284-4'])     #cholesterol and blood pressure only
+    pairs=join_observations(columns,0,1)            #each cholesterol measurement with the blood pressure taken closest to it
+    return pd.DataFrame({'Total Cholesterol':pairs['left_value'],'Total Blood Pressure':pairs['right_value']})
+
+def draw_challenge_question_2(fig, pairs):
+    import seaborn as sns
+    sns.regplot(data=pairs, x='Total Cholesterol', y='Total Blood Pressure', seed=0, ax=fig.add_subplot())   #fixed seed for the bootstrapped confidence band
 
-    plt.savefig(figure_name,  facecolor='grey')
-    plt.show()
-    
 def plot_challenge_question_2(bundle_path, figure_name='q7_challenge_question_2.png'):
     """5 Points
     Plot anything you want that uses at least 2 FHIR resources
     Save the figure to a PNG file with the specified figure_name
 
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     #plotting scatter plot Total Blood Pressure Vs Total Cholesterol
-    observations=get_fhir_object_list(bundle_path,object_name="Observation")   #get all required observation objects
-    observation_dict=get_observation_resource_data(observations,"code.coding[0].code","valueQuantity.value",['2093-3','55284-4']) #get required data
-    
-    if(len(observation_dict['55284-4']) > len(observation_dict['2093-3'])):
-        observation_dict['55284-4']=observation_dict['55284-4'][:len(observation_dict['2093-3'])]
-    else:
-        observation_dict['2093-3']=observation_dict['2093-3'][:len(observation_dict['55284-4'])]
-    
-    observation_dict['Total Blood Pressure']=observation_dict.pop('55284-4')
-    observation_dict['Total Cholesterol']=observation_dict.pop('2093-3')
-    
-    #plot the required data
-    df = pd.DataFrame.from_dict(observation_dict, orient='index')
-    df.index.rename('Observation', inplace=True)
+    show_figure(draw_challenge_question_2,get_challenge_question_2_data(bundle_path),figure_name)
+
+def get_challenge_question_3_data(bundle_path):
+    """Body mass index, body weight and body height values, the data of plot_challenge_question_3
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+    """
+    observations=get_fhir_object_list(bundle_path,object_name="Observation")
+    return get_observation_resource_data(observations,"code.coding[0].code","valueQuantity.value",['39156-5','29463-7','8302-2'])
+
+def draw_challenge_question_3(fig, observation_dict):
+    ax=fig.add_subplot()
+    box1=ax.boxplot(observation_dict.values(),notch=True,vert=True,patch_artist=True)
+    for patch, color in zip(box1['boxes'], ['lightgreen','lightblue','yellow']):
+        patch.set_facecolor(color)
+    ax.set_xticks(range(1, len(observation_dict) + 1))
+    ax.set_xticklabels(['Body Mass index','Body Weight','Body Height'])
 
-    stacked = df.stack().reset_index()
-    stacked.rename(columns={0: 'Value'}, inplace=True)
-    
-    sns.swarmplot(data=stacked, x='Observation', y='Value', hue='Observation')
-    
-    plt.savefig(figure_name,  facecolor='grey')
-    plt.show()
-    
 def plot_challenge_question_3(bundle_path, figure_name='q8_challenge_question_3.png'):
     """5 Points
     Plot anything you want that uses at least 3 FHIR resources
     Save the figure to a PNG file with the specified figure_name
 
     Arguments:
-        bundle_path {str} -- path to Synthea generated FHIR bundles
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
     """
     #plotting box plot for Body Mass Index, Body Weight and Body Weight
-    observations=get_fhir_object_list(bundle_path,object_name="Observation")
-    observation_dict=get_observation_resource_data(observations,"code.coding[0].code","valueQuantity.value",['39156-5','29463-7','8302-2'])
-    
-    labels, data = [*zip(*observation_dict.items())]  
-    labels, data = observation_dict.keys(), observation_dict.values()
-    
-    #plot required data
-    box1=plt.boxplot(data,notch=True,vert=True,patch_artist=True)
-    for patch, color in zip(box1['boxes'], ['lightgreen','lightblue','yellow']):
-        patch.set_facecolor(color)
-    plt.xticks(range(1, len(labels) + 1), ['Body Mass index','Body Weight','Body Height'])
-    
-    plt.savefig(figure_name,  facecolor='grey')
-    plt.show()    
+    show_figure(draw_challenge_question_3,get_challenge_question_3_data(bundle_path),figure_name)
+
+
+def show_figure(draw_function, data, figure_name):
+    """Draws data on a new pyplot figure, saves it and shows it
+
+    Arguments:
+        draw_function {function} -- draw_* function taking the figure and the data
+        data {object} -- data returned by the matching get_*_data function
+        figure_name {str} -- PNG file name
+    """
+    import matplotlib.pyplot as plt
+    fig=plt.figure()
+    draw_function(fig,data)
+    fig.savefig(figure_name, facecolor='grey')
+    plt.show()
+    plt.close(fig)
+
+def render_figure(draw_function, data, figure_name):
+    """Draws data on its own Figure with the Agg canvas and saves it, pyplot
+    and its global state are not used so it runs headless in any process
+
+    Arguments:
+        draw_function {function} -- draw_* function taking the figure and the data
+        data {object} -- data returned by the matching get_*_data function
+        figure_name {str} -- PNG file name
+
+    Returns:
+        str -- figure_name
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig=Figure()
+    FigureCanvasAgg(fig)
+    draw_function(fig,data)
+    fig.savefig(figure_name, facecolor='grey')
+    return figure_name
+
+#figure file name, function extracting its data and function drawing it
+FIGURE_OBJECT_NAMES=['Patient','Condition','Observation']     #resource types the figures read, the corpus keeps only these
+FIGURES=[('q1_age_by_gender.png',get_age_by_gender_data,draw_age_by_gender),
+         ('q2_by_gender_and_race.png',get_by_gender_and_race_data,draw_gender_bar_chart),
+         ('q3_by_gender_and_birth_country.png',get_by_gender_and_birth_country_data,draw_gender_bar_chart),
+         ('q4_by_gender_and_mortality.png',get_by_gender_and_mortality_data,draw_gender_bar_chart),
+         ('q5_condition_comorbidity_matrix.png',get_condition_comorbidity_data,draw_condition_comorbidity_matrix),
+         ('q6_challenge_question_1.png',get_challenge_question_1_data,draw_gender_bar_chart),
+         ('q7_challenge_question_2.png',get_challenge_question_2_data,draw_challenge_question_2),
+         ('q8_challenge_question_3.png',get_challenge_question_3_data,draw_challenge_question_3)]
+
+def render_all_figures(bundle_path, output_dir='.', workers=None):
+    """Headless batch mode, writes every figure of FIGURES without plt.show().
+    The data is extracted here from one parsed corpus and each figure is
+    drawn in a worker process as soon as its data is ready, so the run takes
+    about the extraction plus the slowest single figure.
+
+    Arguments:
+        bundle_path {str, FhirCorpus or FhirColumnStore} -- path to Synthea generated FHIR bundles, an already parsed FhirCorpus or a compiled FhirColumnStore
+
+    Keyword Arguments:
+        output_dir {str} -- directory of the PNG files (default: {'.'})
+        workers {int} -- rendering processes, one per figure up to the cpu count when None (default: {None})
+
+    Returns:
+        list -- paths of the written PNG files
+    """
+    if not isinstance(bundle_path,(FhirCorpus,FhirColumnStore)):
+        bundle_path=FhirCorpus(bundle_path,FIGURE_OBJECT_NAMES)             #parse once for all figures
+    os.makedirs(output_dir,exist_ok=True)
+    workers=workers or min(len(FIGURES),multiprocessing.cpu_count())
+    if workers==1:
+        return [render_figure(draw_function,get_data(bundle_path),os.path.join(output_dir,figure_name))
+                for figure_name, get_data, draw_function in FIGURES]
+    with multiprocessing.Pool(workers) as pool:
+        results=[pool.apply_async(render_figure,(draw_function,get_data(bundle_path),os.path.join(output_dir,figure_name)))
+                 for figure_name, get_data, draw_function in FIGURES]
+        return [result.get() for result in results]
+
+
+def add_extended_arguments(parser):
+    """Options of the batch and column store modes. Defaults are set in
+    get_extended_args, so a parser with only these options shows which
+    of them were given."""
+    parser.add_argument('--batch', action='store_true', help='render every figure headless with the Agg backend in worker processes, without showing them')
+    parser.add_argument('-o', '--output-dir', help='directory of the PNG files in batch mode')
+    parser.add_argument('-w', '--workers', type=int, help='rendering processes in batch mode, one per figure by default, and bundle readers otherwise, one by default')
+    parser.add_argument('--compile', action='store_true', help='only compile the bundles into the memory mapped column store, rebuilt when the directory changed')
+    parser.add_argument('--column-store', action='store_true', help='draw the figures from the column store, compiling it first when needed')
+    parser.add_argument('--store-dir', help='directory of the column store, one per bundle directory under %s by default' % DEFAULT_STORE_ROOT)
+
+
+def is_extended_command_line(argv):
+    """A command line with only the bundle path is drawn by the __main__
+    block of the assignment, any other one by main()"""
+    if '-h' in argv or '--help' in argv:
+        return True
+    parser = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    add_extended_arguments(parser)
+    return bool(vars(parser.parse_known_args(argv)[0]))
+
+
+def get_extended_args(argv=None):
+    parser = argparse.ArgumentParser(description='Plots of Synthea generated FHIR bundles')
+    parser.add_argument('bundle_path', help='directory of the FHIR bundles')
+    add_extended_arguments(parser)
+    parser.set_defaults(batch=False, output_dir='.', compile=False, column_store=False)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point of the command line with batch rendering and the column
+    store, see get_extended_args. Without --batch the figures are shown
+    one after the other from a single parsed FhirCorpus.
+
+    Keyword Arguments:
+        argv {list} -- command line arguments, sys.argv[1:] when None (default: {None})
+    """
+    args = get_extended_args(argv)
+    if args.compile or args.column_store:
+        bundle_path = compile_fhir_store(args.bundle_path, args.store_dir, args.workers or 1)
+        if args.compile or not bundle_path:
+            print(bundle_path.store_dir if bundle_path else "No column store was written.")
+            return
+    else:
+        bundle_path = args.bundle_path
+
+    if args.batch:
+        for figure_name in render_all_figures(bundle_path, args.output_dir, args.workers):
+            print(figure_name)
+    else:
+        if not isinstance(bundle_path, FhirColumnStore):
+            bundle_path = FhirCorpus(bundle_path, FIGURE_OBJECT_NAMES, args.workers or 1)
+        plot_age_by_gender(bundle_path)
+        plot_by_gender_and_race(bundle_path)
+        plot_by_gender_and_birth_country(bundle_path)
+        plot_by_gender_and_mortality(bundle_path)
+        plot_condition_comorbidity_matrix(bundle_path)
+        plot_challenge_question_1(bundle_path)
+        plot_challenge_question_2(bundle_path)
+        plot_challenge_question_3(bundle_path)
+
+
+if __name__ == "__main__" and is_extended_command_line(sys.argv[1:]):
+    main()
+    sys.exit(0)
 
 # do not modify below this line
 
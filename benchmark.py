@@ -0,0 +1,513 @@
+#Benchmark suite for the assignment03, assignment04 and claims extraction pipelines
+'''
+Generates Synthea shaped data locally (no Synthea or network needed), times
+and memory profiles every pipeline stage and stores the results as a JSON
+baseline. A later run can be compared with a baseline to flag regressions.
+
+python benchmark.py run --patients 1000 10000 --output bench/baseline.json
+python benchmark.py compare bench/baseline.json bench/current.json --threshold 0.2
+python benchmark.py startup     fails when a light entry point loads a heavy module
+python benchmark.py stream      fails when streamed bundle entries differ from json.load
+'''
+import os
+import sys
+import csv
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import importlib.util
+from datetime import datetime
+
+import assignment03
+import assignment04
+import fhir_stream
+
+spec=importlib.util.spec_from_file_location("data_extraction",os.path.join(os.path.dirname(os.path.abspath(__file__)),"Data extraction.py"))
+data_extraction=importlib.util.module_from_spec(spec)
+sys.modules["data_extraction"]=data_extraction      #its functions are pickled by name for the worker processes
+spec.loader.exec_module(data_extraction)
+
+
+CONDITIONS=[('44054006','Diabetes'),('38341003','Hypertension'),('195662009','Acute viral pharyngitis (disorder)'),
+            ('10509002','Acute bronchitis (disorder)'),('15777000','Prediabetes'),('162864005','Body mass index 30+ - obesity (finding)'),
+            ('59621000','Essential hypertension'),('40055000','Chronic sinusitis (disorder)'),('444814009','Viral sinusitis (disorder)'),
+            ('233678006','Childhood asthma'),('271737000','Anemia (disorder)'),('55822004','Hyperlipidemia'),
+            ('65363002','Otitis media'),('713197008','Recurrent rectal polyp'),('19169002','Miscarriage in first trimester'),
+            ('368581000119106','Neuropathy due to type 2 diabetes mellitus (disorder)'),('73595000','Stress (finding)')]
+OBSERVATIONS=[('8302-2','Body Height',150,190,'cm'),('29463-7','Body Weight',50,110,'kg'),('39156-5','Body Mass Index',18,38,'kg/m2'),
+              ('2093-3','Total Cholesterol',150,260,'mg/dL'),('72514-3','Pain severity',0,10,'{score}')]
+ENCOUNTERS=[('185349003','Encounter for check up (procedure)'),('185345009','Encounter for symptom'),('162673000','General examination of patient (procedure)'),
+            ('50849002','Emergency room admission (procedure)'),('424441002','Prenatal initial visit'),('698314001','Consultation for treatment')]
+MEDICATIONS=[('314076','lisinopril 10 MG Oral Tablet'),('860975','24 HR Metformin hydrochloride 500 MG Extended Release Oral Tablet'),
+             ('197361','Amlodipine 5 MG Oral Tablet'),('310798','Hydrochlorothiazide 25 MG Oral Tablet'),('834061','Penicillin V Potassium 250 MG Oral Tablet'),
+             ('313782','Acetaminophen 325 MG Oral Tablet'),('895994','120 ACTUAT Fluticasone propionate 0.044 MG/ACTUAT Metered Dose Inhaler'),
+             ('308136','amLODIPine 2.5 MG Oral Tablet'),('749762','Seasonique 91 Day Pack'),('1049221','Acetaminophen 325 MG / Oxycodone Hydrochloride 5 MG Oral Tablet')]
+RACES=['White','Black or African American','Asian','American Indian or Alaska Native','Other']
+COUNTRIES=['US','US','US','US','MX','CA','IN','CN','DE']
+MARITAL_STATUS=['M','S','D','W']
+
+#entry points that must start without the heavy dependencies, they are imported on first use
+STARTUP_COMMANDS=[('startup[import assignment04]',['-c','import assignment04']),
+                  ('startup[import Data extraction]',['-c','import runpy; runpy.run_path("Data extraction.py",run_name="data_extraction")']),
+                  ('startup[Data extraction.py --help]',['Data extraction.py','--help'])]
+HEAVY_MODULES=['numpy','pandas','scipy','matplotlib','seaborn','fhirclient','progressbar']
+#read sizes the streamed entries are checked with, the small ones cut nearly every value at a block boundary
+STREAM_READ_SIZES=[1,7,256,fhir_stream.READ_SIZE]
+
+
+def get_timestamp(rng, first_year=2000, last_year=2019):
+    return "%d-%02d-%02dT%02d:%02d:%02d-05:00"%(rng.randint(first_year,last_year),rng.randint(1,12),rng.randint(1,28),rng.randint(0,23),rng.randint(0,59),rng.randint(0,59))
+
+
+def get_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def get_entry(resource):
+    return {'fullUrl':'urn:uuid:'+resource['id'],'resource':resource,'request':{'method':'POST','url':resource['resourceType']}}
+
+
+def generate_fhir_bundle(rng):
+    """Returns one Synthea shaped transaction bundle with a patient and its
+    conditions, encounters, observations and claims"""
+    patient_id=get_uuid(rng)
+    reference='urn:uuid:'+patient_id
+    patient={'resourceType':'Patient','id':patient_id,'gender':rng.choice(['male','female']),
+             'birthDate':"%d-%02d-%02d"%(rng.randint(1920,2018),rng.randint(1,12),rng.randint(1,28)),
+             'extension':[{'url':'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race','extension':[{'url':'ombCategory','valueCoding':{'system':'urn:oid:2.16.840.1.113883.6.238','code':'2106-3','display':rng.choice(RACES)}}]},
+                          {'url':'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity','extension':[{'url':'ombCategory','valueCoding':{'system':'urn:oid:2.16.840.1.113883.6.238','code':'2186-5','display':'Not Hispanic or Latino'}}]},
+                          {'url':'http://hl7.org/fhir/StructureDefinition/patient-mothersMaidenName','valueString':'Jane Doe'},
+                          {'url':'http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex','valueCode':'M'},
+                          {'url':'http://hl7.org/fhir/StructureDefinition/birthPlace','valueAddress':{'city':'Boston','state':'MA','country':rng.choice(COUNTRIES)}}],
+             'name':[{'use':'official','family':'Doe%d'%rng.randint(1,999),'given':['John%d'%rng.randint(1,999)]}],
+             'maritalStatus':{'coding':[{'system':'http://hl7.org/fhir/v3/MaritalStatus','code':rng.choice(MARITAL_STATUS)}]}}
+    if rng.random()<0.15:
+        patient['deceasedDateTime']=get_timestamp(rng,2015,2019)
+    entries=[get_entry(patient)]
+
+    for code, display in rng.sample(CONDITIONS,rng.randint(1,6)):
+        entries.append(get_entry({'resourceType':'Condition','id':get_uuid(rng),'clinicalStatus':'active','verificationStatus':'confirmed',
+                                  'code':{'coding':[{'system':'http://snomed.info/sct','code':code,'display':display}],'text':display},
+                                  'subject':{'reference':reference},'onsetDateTime':get_timestamp(rng)}))
+
+    for visit in range(rng.randint(2,8)):
+        encounter_id=get_uuid(rng)
+        timestamp=get_timestamp(rng)
+        code, display=rng.choice(ENCOUNTERS)
+        entries.append(get_entry({'resourceType':'Encounter','id':encounter_id,'status':'finished','class':{'code':'AMB'},
+                                  'type':[{'coding':[{'system':'http://snomed.info/sct','code':code,'display':display}],'text':display}],
+                                  'subject':{'reference':reference},'period':{'start':timestamp,'end':timestamp}}))
+        for code, display, low, high, unit in OBSERVATIONS:
+            entries.append(get_entry({'resourceType':'Observation','id':get_uuid(rng),'status':'final',
+                                      'code':{'coding':[{'system':'http://loinc.org','code':code,'display':display}],'text':display},
+                                      'subject':{'reference':reference},'context':{'reference':'urn:uuid:'+encounter_id},'effectiveDateTime':timestamp,
+                                      'valueQuantity':{'value':round(rng.uniform(low,high),1),'unit':unit,'system':'http://unitsofmeasure.org','code':unit}}))
+        entries.append(get_entry({'resourceType':'Observation','id':get_uuid(rng),'status':'final',
+                                  'code':{'coding':[{'system':'http://loinc.org','code':'55284-4','display':'Blood Pressure'}],'text':'Blood Pressure'},
+                                  'subject':{'reference':reference},'context':{'reference':'urn:uuid:'+encounter_id},'effectiveDateTime':timestamp,
+                                  'component':[{'code':{'coding':[{'system':'http://loinc.org','code':'8462-4','display':'Diastolic Blood Pressure'}]},'valueQuantity':{'value':round(rng.uniform(60,95),1),'unit':'mmHg'}},
+                                               {'code':{'coding':[{'system':'http://loinc.org','code':'8480-6','display':'Systolic Blood Pressure'}]},'valueQuantity':{'value':round(rng.uniform(100,150),1),'unit':'mmHg'}}]}))
+        entries.append(get_entry({'resourceType':'Procedure','id':get_uuid(rng),'status':'completed',
+                                  'code':{'coding':[{'system':'http://snomed.info/sct','code':'430193006','display':'Medication Reconciliation (procedure)'}]},
+                                  'subject':{'reference':reference},'context':{'reference':'urn:uuid:'+encounter_id},'performedPeriod':{'start':timestamp,'end':timestamp}}))
+        entries.append(get_entry({'resourceType':'Claim','id':get_uuid(rng),'status':'active','use':'complete',
+                                  'patient':{'reference':reference},'billablePeriod':{'start':timestamp,'end':timestamp},
+                                  'organization':{'reference':'urn:uuid:'+get_uuid(rng)},
+                                  'item':[{'sequence':1,'encounter':[{'reference':'urn:uuid:'+encounter_id}]}],
+                                  'total':{'value':round(rng.uniform(50,1500),2),'system':'urn:iso:std:iso:4217','code':'USD'}}))
+    return {'resourceType':'Bundle','type':'transaction','entry':entries}
+
+
+def generate_fhir_bundles(fhir_dir, patients, seed=12345):
+    """Writes one Synthea shaped FHIR bundle per patient into fhir_dir
+
+    Arguments:
+        fhir_dir {str} -- output directory
+        patients {int} -- number of patients (bundles)
+
+    Keyword Arguments:
+        seed {int} -- random seed, equal seeds give equal files (default: {12345})
+    """
+    rng=random.Random(seed)
+    os.makedirs(fhir_dir,exist_ok=True)
+    for index in range(patients):
+        with open(os.path.join(fhir_dir,"patient_%07d.json"%index),"w") as f:
+            json.dump(generate_fhir_bundle(rng),f)
+
+
+def generate_large_fhir_bundle(file_name, patients, seed=12345):
+    """Writes a single bundle holding the entries of many generated bundles,
+    shaped like the bundle of a long lived Synthea patient
+
+    Arguments:
+        file_name {str} -- bundle file
+        patients {int} -- number of generated bundles merged into it
+
+    Keyword Arguments:
+        seed {int} -- random seed, equal seeds give equal files (default: {12345})
+    """
+    rng=random.Random(seed)
+    entries=[entry for index in range(patients) for entry in generate_fhir_bundle(rng)['entry']]
+    with open(file_name,"w") as f:
+        json.dump({'resourceType':'Bundle','type':'transaction','entry':entries,'meta':{'lastUpdated':get_timestamp(rng)}},f,indent=1)
+
+
+def check_stream(work_dir=None, patients=200, seed=12345):
+    """Checks that iter_bundle_entries yields the same entries and bundle
+    members as json.load followed by the request url filter, for every
+    resource type and every STREAM_READ_SIZES, and that the streamed
+    load_bundle_json of both scripts returns the same bundle. Peak memory of
+    loading the Patient entry of a large bundle is recorded both ways.
+
+    Keyword Arguments:
+        work_dir {str} -- directory for the generated bundles, a temporary one when None (default: {None})
+        patients {int} -- generated bundles merged into the large bundle (default: {200})
+        seed {int} -- random seed of the generated data (default: {12345})
+
+    Returns:
+        dict -- name -> {'equal': bool} or {'peak_mb': float, 'seconds': float}
+    """
+    own_work_dir=work_dir is None
+    work_dir=tempfile.mkdtemp(prefix="health_care_stream_") if own_work_dir else os.path.abspath(work_dir)
+    results={}
+    try:
+        small_file=os.path.join(work_dir,"small_bundle.json")
+        large_file=os.path.join(work_dir,"large_bundle.json")
+        generate_large_fhir_bundle(small_file,2,seed)
+        generate_large_fhir_bundle(large_file,patients,seed)
+        for file_name in [small_file,large_file]:
+            with open(file_name) as f:
+                fhir_object=json.load(f)
+            for object_names in [None,['Patient'],['Observation'],['Claim','Condition'],['Missing']]:
+                expected=[entry for entry in fhir_object['entry'] if object_names is None or entry['request']['url'] in object_names]
+                read_sizes=STREAM_READ_SIZES if file_name==small_file else STREAM_READ_SIZES[-2:]
+                for read_size in read_sizes:
+                    bundle=dict()
+                    entries=list(fhir_stream.iter_bundle_entries(file_name,object_names,bundle,read_size))
+                    bundle['entry']=entries
+                    name="stream[%s,%s,read_size=%d]"%(os.path.basename(file_name),",".join(object_names or ['all']),read_size)
+                    results[name]={'equal':bundle==fhir_object if object_names is None else entries==expected and bundle==dict(fhir_object,entry=expected)}
+            for module in [assignment04,data_extraction]:
+                name="load_bundle_json[%s,%s]"%(module.__name__,os.path.basename(file_name))
+                loaded=module.load_bundle_json(file_name,['Observation','Claim'])
+                results[name]={'equal':loaded==dict(fhir_object,entry=[entry for entry in fhir_object['entry'] if entry['request']['url'] in ['Observation','Claim']])}
+            del fhir_object
+
+        def load_json():
+            with open(large_file) as f:
+                return [entry for entry in json.load(f)['entry'] if entry['request']['url']=='Patient']
+        for name, load in [('peak[json.load,Patient]',load_json),
+                           ('peak[iter_bundle_entries,Patient]',lambda: list(fhir_stream.iter_bundle_entries(large_file,['Patient'])))]:
+            results[name]=run_stage(lambda: None,lambda inputs: load())
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir,ignore_errors=True)
+    return results
+
+
+def generate_csv_tables(csv_dir, patients, seed=12345):
+    """Writes Synthea shaped patients.csv, encounters.csv and medications.csv
+    into csv_dir
+
+    Arguments:
+        csv_dir {str} -- output directory
+        patients {int} -- number of patients
+
+    Keyword Arguments:
+        seed {int} -- random seed, equal seeds give equal files (default: {12345})
+    """
+    rng=random.Random(seed)
+    os.makedirs(csv_dir,exist_ok=True)
+    with open(os.path.join(csv_dir,"patients.csv"),"w",newline="") as patients_file, \
+         open(os.path.join(csv_dir,"encounters.csv"),"w",newline="") as encounters_file, \
+         open(os.path.join(csv_dir,"medications.csv"),"w",newline="") as medications_file:
+        patient_writer=csv.writer(patients_file)
+        encounter_writer=csv.writer(encounters_file)
+        medication_writer=csv.writer(medications_file)
+        patient_writer.writerow(['Id','BIRTHDATE','DEATHDATE','SSN','DRIVERS','PASSPORT','PREFIX','FIRST','LAST','SUFFIX','MAIDEN','MARITAL','RACE','ETHNICITY','GENDER','BIRTHPLACE','ADDRESS'])
+        encounter_writer.writerow(['Id','START','STOP','PATIENT','CODE','DESCRIPTION','COST','REASONCODE','REASONDESCRIPTION'])
+        medication_writer.writerow(['START','STOP','PATIENT','ENCOUNTER','CODE','DESCRIPTION','COST','DISPENSES','TOTALCOST','REASONCODE','REASONDESCRIPTION'])
+        for index in range(patients):
+            patient_id=get_uuid(rng)
+            patient_writer.writerow([patient_id,"%d-%02d-%02d"%(rng.randint(1920,2018),rng.randint(1,12),rng.randint(1,28)),'',
+                                     '999-%02d-%04d'%(rng.randint(10,99),rng.randint(1000,9999)),'S9999%04d'%rng.randint(0,9999),'',
+                                     'Mr.','John%d'%rng.randint(1,999),'Doe%d'%rng.randint(1,999),'','',rng.choice(MARITAL_STATUS),
+                                     rng.choice(RACES).lower(),'nonhispanic',rng.choice('MF'),'Boston Massachusetts US','1 Main Street'])
+            for visit in range(rng.randint(2,40)):
+                encounter_id=get_uuid(rng)
+                start=get_timestamp(rng)
+                code, description=rng.choice(ENCOUNTERS)
+                encounter_writer.writerow([encounter_id,start,start,patient_id,code,description,'129.16','',''])
+                for prescription in range(rng.choice([0,0,1,1,2,4])):
+                    code, description=rng.choice(MEDICATIONS)
+                    medication_writer.writerow([start,rng.choice(['',start]),patient_id,encounter_id,code,description,'263.49','1','263.49','',''])
+
+
+def run_stage(setup, stage, memory=True):
+    """Times stage(inputs) where inputs=setup() is built untimed. With memory
+    a second, traced run records the peak memory allocated by the stage."""
+    inputs=setup()
+    start=time.perf_counter()
+    stage(inputs)
+    seconds=time.perf_counter()-start
+    result={'seconds':round(seconds,4)}
+    if memory:
+        inputs=setup()
+        tracemalloc.start()
+        stage(inputs)
+        result['peak_mb']=round(tracemalloc.get_traced_memory()[1]/(1024*1024),3)
+        tracemalloc.stop()
+    return result
+
+
+def check_startup(repeat=3):
+    """Runs every STARTUP_COMMANDS entry in a fresh interpreter with -X importtime
+
+    Keyword Arguments:
+        repeat {int} -- runs per command, the fastest one is kept (default: {3})
+
+    Returns:
+        dict -- name -> {'seconds': wall time, 'heavy_modules': HEAVY_MODULES it imported}
+    """
+    repo_dir=os.path.dirname(os.path.abspath(__file__))
+    results={}
+    for name, arguments in STARTUP_COMMANDS:
+        timings=[]
+        for i in range(repeat):
+            start=time.perf_counter()
+            completed=subprocess.run([sys.executable,'-X','importtime']+arguments,cwd=repo_dir,
+                                     stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,universal_newlines=True,check=True)
+            timings.append(time.perf_counter()-start)
+        imported=set(line.split('|')[-1].strip().split('.')[0] for line in completed.stderr.splitlines() if line.startswith('import time:'))
+        results[name]={'seconds':round(min(timings),4),'heavy_modules':[module for module in HEAVY_MODULES if module in imported]}
+    return results
+
+
+def get_stages(csv_dir, fhir_dir, work_dir):
+    """Returns the (name, setup, stage) triples benchmarked for one dataset"""
+    patients_file=os.path.join(csv_dir,"patients.csv")
+    encounters_file=os.path.join(csv_dir,"encounters.csv")
+    medications_file=os.path.join(csv_dir,"medications.csv")
+
+    def nothing():
+        return None
+
+    def patients_only():
+        return assignment03.create_patient_dictionary(patients_file)
+
+    def patients_with_encounters():
+        patients=assignment03.create_patient_dictionary(patients_file)
+        assignment03.add_encounters_to_patients(patients,encounters_file)
+        return patients
+
+    def all_patients():
+        patients=patients_with_encounters()
+        assignment03.add_medications_to_patients(patients,medications_file)
+        return patients
+
+    database_file=os.path.join(work_dir,"assignment03.sqlite3")
+    def load_database(inputs=None):
+        patients=assignment03.create_patient_database(patients_file,database_file)
+        assignment03.add_encounters_to_patients(patients,encounters_file)
+        assignment03.add_medications_to_patients(patients,medications_file)
+        return patients
+
+    def new_output_dir():
+        output_dir=tempfile.mkdtemp(dir=work_dir)      #parse_claims_into_csv asks before replacing a file
+        return output_dir
+
+    def compiled_store_dir():
+        store_dir=os.path.join(work_dir,"column_store")
+        assignment04.compile_fhir_store(fhir_dir,store_dir)
+        return store_dir
+
+    corpus=[]
+    def fhir_corpus():
+        if not corpus:
+            corpus.append(assignment04.FhirCorpus(fhir_dir))
+        return corpus[0]
+
+    stages=[
+        ('create_patient_dictionary',nothing,lambda inputs: assignment03.create_patient_dictionary(patients_file)),
+        ('add_encounters_to_patients',patients_only,lambda patients: assignment03.add_encounters_to_patients(patients,encounters_file)),
+        ('add_medications_to_patients',patients_with_encounters,lambda patients: assignment03.add_medications_to_patients(patients,medications_file)),
+        ('add_medications_to_patients[workers=4]',patients_with_encounters,lambda patients: assignment03.add_medications_to_patients(patients,medications_file,workers=4)),
+        ('problem1',all_patients,assignment03.problem1),
+        ('problem2',all_patients,assignment03.problem2),
+        ('write_ndjson',all_patients,lambda patients: assignment03.write_ndjson(os.path.join(work_dir,"assignment03.ndjson"),patients)),
+        ('write_ndjson_files[workers=4,gzip]',all_patients,lambda patients: assignment03.write_ndjson_files(os.path.join(work_dir,"assignment03.ndjson"),patients,workers=4,compress=True)),
+        ('load_patient_database',nothing,load_database),
+        ('problem1[sqlite]',load_database,assignment03.problem1),
+        ('problem2[sqlite]',load_database,assignment03.problem2),
+        ('write_ndjson[sqlite]',load_database,lambda patients: assignment03.write_ndjson(os.path.join(work_dir,"assignment03_sqlite.ndjson"),patients)),
+        ('parse_claims_into_csv',new_output_dir,lambda output_dir: data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv')),
+        ('parse_claims_into_csv[workers=2]',new_output_dir,lambda output_dir: data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv',workers=2)),
+        ('get_fhir_object_list[Patient]',nothing,lambda inputs: assignment04.get_fhir_object_list(fhir_dir,'Patient')),
+        ('get_fhir_object_list[Condition]',nothing,lambda inputs: assignment04.get_fhir_object_list(fhir_dir,'Condition')),
+        ('get_fhir_object_list[Observation]',nothing,lambda inputs: assignment04.get_fhir_object_list(fhir_dir,'Observation')),
+        ('FhirCorpus',nothing,lambda inputs: assignment04.FhirCorpus(fhir_dir)),
+        ('compile_fhir_store',new_output_dir,lambda output_dir: assignment04.compile_fhir_store(fhir_dir,os.path.join(output_dir,"column_store"))),
+        ('compile_fhir_store[warm]',compiled_store_dir,lambda store_dir: assignment04.compile_fhir_store(fhir_dir,store_dir)),
+        ('join_observations[store]',compiled_store_dir,lambda store_dir: assignment04.join_observations(
+            assignment04.get_observation_columns(assignment04.FhirColumnStore(store_dir),['2093-3','55284-4']),0,1)),
+        ('render_all_figures[workers=1]',fhir_corpus,lambda corpus: assignment04.render_all_figures(corpus,os.path.join(work_dir,"figures"),workers=1)),
+    ]
+    plots=['plot_age_by_gender','plot_by_gender_and_race','plot_by_gender_and_birth_country','plot_by_gender_and_mortality',
+           'plot_condition_comorbidity_matrix','plot_challenge_question_1','plot_challenge_question_2','plot_challenge_question_3']
+    for plot, (figure_name, get_data, draw_function) in zip(plots,assignment04.FIGURES):
+        stages.append((plot,fhir_corpus,get_data))      #rendering disabled, only the data the plot_* function would draw
+    return stages
+
+
+def run_benchmarks(sizes, work_dir=None, stage_names=None, memory=True, seed=12345):
+    """Generates a dataset for every size and benchmarks every stage on it
+
+    Arguments:
+        sizes {list} -- numbers of patients
+
+    Keyword Arguments:
+        work_dir {str} -- directory for generated data and outputs, a temporary one when None (default: {None})
+        stage_names {list} -- only run these stages, all when None (default: {None})
+        memory {bool} -- also record peak memory of every stage (default: {True})
+        seed {int} -- random seed of the generated data (default: {12345})
+
+    Returns:
+        dict -- benchmark results, see write_results
+    """
+    own_work_dir=work_dir is None
+    work_dir=tempfile.mkdtemp(prefix="health_care_benchmark_") if own_work_dir else os.path.abspath(work_dir)
+    results={'meta':{'created':datetime.now().isoformat(timespec='seconds'),'python':platform.python_version(),
+                     'platform':platform.platform(),'seed':seed,'memory':memory},'results':{}}
+    try:
+        for name, result in check_startup().items():
+            if stage_names and name not in stage_names:
+                continue
+            results['results'].setdefault('startup',{})[name]={'seconds':result['seconds']}
+            print("%17s %-36s %s"%('',name,result))
+        for size in sizes:
+            data_dir=os.path.join(work_dir,"data_%d"%size)
+            csv_dir=os.path.join(data_dir,"csv")
+            fhir_dir=os.path.join(data_dir,"fhir")
+            if not os.path.exists(os.path.join(csv_dir,"medications.csv")):    #generated data is reused by later runs with the same work_dir
+                print("Generating csv tables for %d patients"%size)
+                generate_csv_tables(csv_dir,size,seed)
+            if not os.path.isdir(fhir_dir) or len(os.listdir(fhir_dir))!=size:
+                print("Generating fhir bundles for %d patients"%size)
+                shutil.rmtree(fhir_dir,ignore_errors=True)
+                generate_fhir_bundles(fhir_dir,size,seed)
+            output_dir=os.path.join(data_dir,"out")
+            os.makedirs(output_dir,exist_ok=True)
+
+            size_results=results['results'][str(size)]={}
+            for name, setup, stage in get_stages(csv_dir,fhir_dir,output_dir):
+                if stage_names and name not in stage_names:
+                    continue
+                size_results[name]=run_stage(setup,stage,memory)
+                print("%8d patients  %-36s %s"%(size,name,size_results[name]))
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir,ignore_errors=True)
+    return results
+
+
+def write_results(results, output_file):
+    output_dir=os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir,exist_ok=True)
+    with open(output_file,"w") as f:
+        json.dump(results,f,indent=1,sort_keys=True)
+
+
+def compare_results(baseline, current, threshold=0.2, min_seconds=0.05):
+    """Compares two benchmark result files stage by stage
+
+    Arguments:
+        baseline {dict} -- results of the baseline run
+        current {dict} -- results of the run to check
+
+    Keyword Arguments:
+        threshold {float} -- allowed relative increase of time and peak memory (default: {0.2})
+        min_seconds {float} -- time differences below this are treated as noise (default: {0.05})
+
+    Returns:
+        list -- (size, stage, metric, baseline value, current value) of every regression
+    """
+    regressions=[]
+    for size, stages in current['results'].items():
+        for name, result in stages.items():
+            base=baseline['results'].get(size,{}).get(name)
+            if base is None:
+                continue
+            for metric in ['seconds','peak_mb']:
+                if metric not in base or metric not in result:
+                    continue
+                if metric=='seconds' and result[metric]-base[metric]<min_seconds:
+                    continue
+                if result[metric]>base[metric]*(1+threshold):
+                    regressions.append((size,name,metric,base[metric],result[metric]))
+    return regressions
+
+
+def get_parsed_args():
+    parser=argparse.ArgumentParser(description="Benchmark every pipeline stage on generated Synthea shaped data")
+    commands=parser.add_subparsers(dest="command",required=True)
+    run=commands.add_parser("run",help="run the benchmarks and write a JSON result file")
+    run.add_argument("--patients",type=int,nargs='+',default=[1000],help="dataset sizes in patients e.g. 1000 10000 100000")
+    run.add_argument("--output",default="bench/results.json",help="JSON file the results are written to")
+    run.add_argument("--work-dir",default=None,help="directory for generated data, kept and reused between runs")
+    run.add_argument("--stages",nargs='+',default=None,help="only run these stages")
+    run.add_argument("--no-memory",action="store_true",help="skip the traced run that records peak memory")
+    run.add_argument("--seed",type=int,default=12345,help="random seed of the generated data")
+    run.add_argument("--baseline",default=None,help="compare the results with this baseline file once done")
+    run.add_argument("--threshold",type=float,default=0.2,help="allowed relative increase before a stage is flagged")
+    commands.add_parser("startup",help="check that the light entry points start without the heavy dependencies")
+    stream=commands.add_parser("stream",help="check that streamed bundle entries equal the json.load ones and compare their peak memory")
+    stream.add_argument("--patients",type=int,default=200,help="generated bundles merged into the large bundle")
+    stream.add_argument("--work-dir",default=None,help="directory for the generated bundles")
+    compare=commands.add_parser("compare",help="compare a result file with a baseline")
+    compare.add_argument("baseline",help="baseline JSON file")
+    compare.add_argument("current",help="JSON file to check")
+    compare.add_argument("--threshold",type=float,default=0.2,help="allowed relative increase before a stage is flagged")
+    return parser.parse_args()
+
+
+def report_regressions(baseline, current, threshold):
+    regressions=compare_results(baseline,current,threshold)
+    for size, name, metric, base, value in regressions:
+        print("REGRESSION %8s patients  %-36s %-8s %10.3f -> %10.3f (%+.0f%%)"%(size,name,metric,base,value,(value/base-1)*100 if base else float('inf')))
+    if not regressions:
+        print("No regressions above %.0f%%"%(threshold*100))
+    return 1 if regressions else 0
+
+
+if __name__=="__main__":
+    parsed_args=get_parsed_args()
+    if parsed_args.command=="run":
+        results=run_benchmarks(parsed_args.patients,parsed_args.work_dir,parsed_args.stages,not parsed_args.no_memory,parsed_args.seed)
+        write_results(results,parsed_args.output)
+        print("Results written to",parsed_args.output)
+        if parsed_args.baseline:
+            with open(parsed_args.baseline) as f:
+                sys.exit(report_regressions(json.load(f),results,parsed_args.threshold))
+    elif parsed_args.command=="startup":
+        startup=check_startup()
+        for name, result in startup.items():
+            print("%-36s %8.3fs  %s"%(name,result['seconds'],"heavy modules imported: "+", ".join(result['heavy_modules']) if result['heavy_modules'] else "ok"))
+        sys.exit(1 if any(result['heavy_modules'] for result in startup.values()) else 0)
+    elif parsed_args.command=="stream":
+        stream=check_stream(parsed_args.work_dir,parsed_args.patients)
+        for name, result in stream.items():
+            print("%-60s %s"%(name,result if 'equal' not in result else "ok" if result['equal'] else "DIFFERENT"))
+        sys.exit(0 if all(result.get('equal',True) for result in stream.values()) else 1)
+    else:
+        with open(parsed_args.baseline) as f:
+            baseline=json.load(f)
+        with open(parsed_args.current) as f:
+            current=json.load(f)
+        sys.exit(report_regressions(baseline,current,parsed_args.threshold))
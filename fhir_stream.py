@@ -0,0 +1,184 @@
+#Streaming reader for the entries of large FHIR bundle files
+'''
+Used by assignment04.py and Data extraction.py, which also share
+load_bundle_json and map_bundle_files from here. json.load builds the whole
+bundle before a single entry can be looked at, so a bundle of tens of MB
+sits in memory at once. iter_bundle_entries reads the file in blocks and
+decodes entry[] one element at a time, keeping only the entries whose
+request url is one of the wanted resource types. Peak memory is then one
+entry plus one read block rather than the whole bundle.
+
+for entry in iter_bundle_entries('bundle.json',['Observation']):
+    resource=entry['resource']
+'''
+import os
+import re
+import json
+import multiprocessing
+from functools import partial
+from instrumentation import STATS, run_with_stats
+
+WHITESPACE=re.compile(r'[ \t\n\r]*')
+READ_SIZE=1<<16
+
+
+class JsonStream:
+    """Text of a json file read in blocks of read_size characters, with a
+    position that the values are decoded from. Consumed text is dropped from
+    the buffer, so only the value being decoded is held in memory."""
+
+    def __init__(self, f, read_size=READ_SIZE):
+        self.f=f
+        self.read_size=read_size
+        self.buffer=''
+        self.position=0
+        self.eof=False
+        self.decoder=json.JSONDecoder()
+
+    def read(self, size):
+        """Appends at least size more characters to the buffer unless the file
+        ends first, returns False once there is nothing left to read"""
+        if self.eof:
+            return False
+        with STATS.timer('read'):
+            data=self.f.read(max(size,self.read_size))
+        if not data:
+            self.eof=True
+            return False
+        if self.position:
+            self.buffer=self.buffer[self.position:]     #dropping what is already decoded
+            self.position=0
+        self.buffer+=data
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, '' at the end of the file"""
+        while True:
+            self.position=WHITESPACE.match(self.buffer,self.position).end()
+            if self.position<len(self.buffer) or not self.read(self.read_size):
+                return self.buffer[self.position:self.position+1]
+
+    def expect(self, characters):
+        character=self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError("Expecting one of %r"%characters,self.buffer,self.position)
+        self.position+=1
+        return character
+
+    def decode(self):
+        """Decodes the json value at the position. A value cut off by the end
+        of the buffer is decoded again once more of the file is read, the read
+        size doubling each time so a large value is not decoded many times."""
+        self.peek()
+        size=self.read_size
+        while True:
+            try:
+                with STATS.timer('json_load'):
+                    value, end=self.decoder.raw_decode(self.buffer,self.position)
+                if end<len(self.buffer) or self.eof:    #a number at the end of the buffer may go on in the next block
+                    self.position=end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read(size)
+            size*=2
+
+
+def iter_bundle_entries(fhir_bundle_path, object_names=None, bundle=None, read_size=READ_SIZE):
+    """Yields the entries of a fhir bundle file one at a time without loading
+    the whole bundle. The members of the bundle other than entry are decoded
+    whole and stored in bundle, those after entry only once every entry was
+    yielded.
+
+    Arguments:
+        fhir_bundle_path {String} -- path to a fhir bundle
+
+    Keyword Arguments:
+        object_names {list} -- request urls of the entries to yield, all entries are yielded when None (default: {None})
+        bundle {dict} -- receives the other members of the bundle, e.g. resourceType and type (default: {None})
+        read_size {int} -- number of characters read from the file at a time (default: {READ_SIZE})
+    """
+    bundle=dict() if bundle is None else bundle
+    with open(fhir_bundle_path,'r',encoding='utf-8-sig') as f:    #utf-8-sig also reads files starting with a byte order mark
+        STATS.count('files')
+        STATS.count('bytes_read',os.fstat(f.fileno()).st_size)
+        stream=JsonStream(f,read_size)
+        stream.expect('{')
+        if stream.peek()=='}':
+            return
+        while True:
+            key=stream.decode()
+            stream.expect(':')
+            if key=='entry' and stream.peek()=='[':
+                stream.expect('[')
+                if stream.peek()!=']':
+                    while True:
+                        entry=stream.decode()
+                        STATS.count('entries_seen')
+                        if object_names is None or entry.get('request',{}).get('url') in object_names:
+                            yield entry
+                        if stream.expect(',]')==']':
+                            break
+                else:
+                    stream.expect(']')
+            else:
+                bundle[key]=stream.decode()
+            if stream.expect(',}')=='}':
+                return
+
+
+def load_bundle_json(fhir_bundle_path, object_names=None):
+    """Reads a fhir bundle file as json and keeps only the entries whose
+    request url is one of object_names. The entries are then streamed with
+    iter_bundle_entries, so the whole bundle is never in memory at once
+
+    Arguments:
+        fhir_bundle_path {String} -- path to a fhir bundle
+
+    Keyword Arguments:
+        object_names {list} -- resource types to keep, all entries are kept when None (default: {None})
+
+    Returns:
+        dict -- bundle json
+    """
+    if object_names is not None:            #streaming the entries, only the kept ones are ever in memory together
+        fhir_object=dict()
+        fhir_object['entry']=list(iter_bundle_entries(fhir_bundle_path,object_names,fhir_object))
+        return fhir_object
+    with STATS.timer('read'):
+        with open(fhir_bundle_path,'rb') as f:
+            data=f.read()
+    STATS.count('files')
+    STATS.count('bytes_read',len(data))
+    with STATS.timer('json_load'):
+        fhir_object=json.loads(data)        #loading bundle object
+    STATS.count('entries_seen',len(fhir_object.get('entry',[])))
+    return fhir_object
+
+
+def map_bundle_files(function, list_of_all_files, workers=1, chunk_size=1):
+    """Applies function to every bundle file and yields the results in the
+    order of list_of_all_files. With more than one worker the files are
+    handed out to a process pool chunk_size files at a time, so only the
+    extracted results are sent back to this process.
+
+    Arguments:
+        function {callable} -- picklable function taking a bundle file path
+        list_of_all_files {list} -- bundle file paths
+
+    Keyword Arguments:
+        workers {int} -- number of worker processes, 1 parses in this process (default: {1})
+        chunk_size {int} -- number of files sent to a worker at a time (default: {1})
+    """
+    if workers is None or workers>1:
+        with multiprocessing.Pool(workers) as pool:
+            if not STATS.enabled:
+                yield from pool.imap(function,list_of_all_files,chunksize=chunk_size)   #imap keeps the input order
+                return
+            for result, worker_stats in pool.imap(partial(run_with_stats,function),list_of_all_files,chunksize=chunk_size):
+                STATS.merge(worker_stats)       #counters of the workers are sent back with their results
+                yield result
+    else:
+        for file in list_of_all_files:
+            yield function(file)
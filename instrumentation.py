@@ -0,0 +1,156 @@
+#Opt-in counters and timers for the FHIR ingest path
+'''
+Used by assignment04.py and Data extraction.py. Nothing is recorded until
+STATS.enable() is called, either directly, through the --stats option of
+Data extraction.py or by setting environment variables before the run:
+
+FHIR_INGEST_STATS=stats.json      write the summary JSON to this file ('-' prints it)
+FHIR_INGEST_PROFILE=json_load     run cProfile over this stage only
+FHIR_INGEST_PROFILE_FILE=out.prof pstats file for the profile, printed when not given
+FHIR_INGEST_TRACEMALLOC=0         do not record peak memory
+
+Stages timed: read (disk reads), json_load, bundle (fhirclient objects),
+filter (selecting resources by type) and write (csv writing).
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import pstats
+import tracemalloc
+import multiprocessing
+from contextlib import contextmanager
+
+
+class IngestStats:
+    """Counters, per stage timers and peak memory of one run. Counters of
+    process pool workers are sent back with the results and merged."""
+
+    def __init__(self):
+        self.enabled=False
+        self.output_file=None
+        self.profile_stage=None
+        self.profile_file=None
+        self.trace_memory=False
+        self.profiler=None
+        self.reset()
+
+    def reset(self):
+        self.counters=dict()
+        self.kept=dict()            #resources kept per resource type
+        self.seconds=dict()
+        self.started=time.perf_counter()
+
+    def enable(self, output_file='-', profile_stage=None, profile_file=None, trace_memory=True):
+        """Starts recording and writes the summary when the run ends
+
+        Keyword Arguments:
+            output_file {str} -- summary JSON file, '-' prints it, None does not write it (default: {'-'})
+            profile_stage {str} -- stage run under cProfile (default: {None})
+            profile_file {str} -- pstats output of the profile, printed when None (default: {None})
+            trace_memory {bool} -- record peak memory with tracemalloc (default: {True})
+        """
+        first_time=not self.enabled
+        self.enabled=True
+        self.output_file=output_file
+        self.profile_stage=profile_stage
+        self.profile_file=profile_file
+        self.trace_memory=trace_memory
+        self.reset()
+        if profile_stage:
+            self.profiler=cProfile.Profile()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if first_time:
+            atexit.register(self.finish)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name]=self.counters.get(name,0)+value
+
+    def keep(self, object_name, value=1):
+        if self.enabled:
+            self.kept[object_name]=self.kept.get(object_name,0)+value
+
+    @contextmanager
+    def timer(self, stage):
+        if not self.enabled:
+            yield
+            return
+        profiling=self.profiler is not None and stage==self.profile_stage
+        if profiling:
+            self.profiler.enable()
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage]=self.seconds.get(stage,0.0)+time.perf_counter()-start
+            if profiling:
+                self.profiler.disable()
+
+    def export(self):
+        return {'counters':self.counters,'kept':self.kept,'seconds':self.seconds}
+
+    def merge(self, exported):
+        for name, value in exported['counters'].items():
+            self.counters[name]=self.counters.get(name,0)+value
+        for name, value in exported['kept'].items():
+            self.kept[name]=self.kept.get(name,0)+value
+        for name, value in exported['seconds'].items():     #worker seconds add up to cpu seconds, not wall clock
+            self.seconds[name]=self.seconds.get(name,0.0)+value
+
+    def summary(self):
+        summary={'files':self.counters.get('files',0),'bytes_read':self.counters.get('bytes_read',0),
+                 'entries_seen':self.counters.get('entries_seen',0),'resources_kept':dict(sorted(self.kept.items())),
+                 'rows_written':self.counters.get('rows_written',0),
+                 'seconds':{stage:round(value,6) for stage, value in sorted(self.seconds.items())},
+                 'parse_seconds':round(self.seconds.get('json_load',0.0)+self.seconds.get('bundle',0.0),6),
+                 'write_seconds':round(self.seconds.get('write',0.0),6),
+                 'wall_seconds':round(time.perf_counter()-self.started,6)}
+        if self.trace_memory and tracemalloc.is_tracing():
+            summary['peak_memory_mb']=round(tracemalloc.get_traced_memory()[1]/(1024*1024),3)
+        if self.profile_stage:
+            summary['profiled_stage']=self.profile_stage
+        return summary
+
+    def finish(self):
+        """Writes the summary JSON and the profile, called once at exit"""
+        if not self.enabled:
+            return
+        summary=self.summary()
+        if self.output_file=='-':
+            print(json.dumps(summary,indent=1))
+        elif self.output_file:
+            with open(self.output_file,'w') as f:
+                json.dump(summary,f,indent=1)
+        if self.profiler is not None:
+            if not self.profiler.getstats():
+                print("Stage %s did not run in this process, profile it with a single worker."%self.profile_stage,file=sys.stderr)
+            elif self.profile_file:
+                self.profiler.dump_stats(self.profile_file)
+            else:
+                pstats.Stats(self.profiler,stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+        self.enabled=False
+
+
+def run_with_stats(function, argument):
+    """Runs function(argument) in a process pool worker with recording on and
+    returns the result together with the worker counters"""
+    if tracemalloc.is_tracing():                #inherited from a forked parent, memory is only traced there
+        tracemalloc.stop()
+    STATS.profiler=None
+    STATS.enabled=True
+    STATS.reset()
+    result=function(argument)
+    exported=STATS.export()
+    STATS.enabled=False
+    return result, exported
+
+
+STATS=IngestStats()
+
+if os.environ.get('FHIR_INGEST_STATS') and multiprocessing.parent_process() is None:   #pool workers report through run_with_stats
+    STATS.enable(os.environ['FHIR_INGEST_STATS'],os.environ.get('FHIR_INGEST_PROFILE'),
+                 os.environ.get('FHIR_INGEST_PROFILE_FILE'),os.environ.get('FHIR_INGEST_TRACEMALLOC','1')!='0')
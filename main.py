@@ -1,11 +1,10 @@
 '''
 Requirement 1
-File path-: ./src/main/resources/synthea.properties
-open the file synthea.properties and change following properties to true
-exporter.ccda.export = true
-exporter.fhir.export = true
-exporter.csv.export = true
-exporter.text.export = true
+synthea.properties (./src/main/resources/synthea.properties) does not need to be edited.
+The exporters are chosen per run with --exporters, default fhir,csv, e.g.
+python main.py ... --exporters fhir csv ccda text
+and passed to Synthea as --exporter.*.export overrides, next to --exporter.baseDirectory for the data folder, e.g.
+run_synthea --exporter.fhir.export true --exporter.csv.export true --exporter.ccda.export false ...
 
 Requirement 2
 Running follwoing command
@@ -17,7 +16,16 @@ result will get saved in output folder
 import argparse
 import os
 import sys
+import csv
+import time
+import glob
+import json
+import shutil
+import signal
+import hashlib
+import tempfile
 import subprocess
+from decimal import Decimal
 
 ##Clearning the terminal
 def clear_terminal():
@@ -63,6 +71,21 @@ def parsing_argument():
         parser.add_argument("--city",nargs='*',default=["\"Pittsburgh\""],help="city to use when generating data")
     except:
         print("Please enter valid City. Make sure you enter City name in double or single quote. Eg. \"San Diego\"")
+    try:
+        parser.add_argument("--shards", type=int, default=1, help="number of Synthea processes generating the population in parallel, each with its own seed")
+    except:
+        print("Please enter numeric number of shards.")
+    try:
+        parser.add_argument("--exporters",nargs='+',choices=sorted(EXPORTER_PROPERTIES),default=DEFAULT_EXPORTERS,help="formats Synthea writes for this run, all others are switched off")
+    except:
+        print("Please enter valid exporters. Eg. fhir csv")
+    try:
+        default_cache_dir=os.path.join(os.path.expanduser("~"),".cache","synthea_datasets")
+        parser.add_argument("--cache-dir",default=default_cache_dir,help="directory of the cache of generated datasets")
+        parser.add_argument("--cache-size",type=int,default=5120,help="size limit of the dataset cache in MB, least recently used datasets are removed first")
+        parser.add_argument("--no-cache",action="store_true",help="always run Synthea, do not read or fill the dataset cache")
+    except:
+        print("Please enter valid cache directory and numeric cache size.")
 
     args = parser.parse_args()    
     return args
@@ -81,53 +104,370 @@ def getting_path_for_synthea(script):
     else:
         print("The path you have specified does not exist. Please enter valid path where synthea is installed.")
 
-##setting path to output the data generated from Synthea commond##
-def setting_path_for_data_dir(script,data_path):
-    path_for_synthea_dir, existing_dir=getting_path_for_synthea(script)
-    path_for_synthea_property=os.path.join(path_for_synthea_dir,'src','main','resources')
-    existing_dir=os.getcwd()
-    os.chdir(path_for_synthea_property)
-    newline=os.linesep
-    new_data_path=os.path.abspath(data_path)
-    
+##Exporters Synthea can write and the property switching each of them on
+EXPORTER_PROPERTIES={"fhir":"exporter.fhir.export","fhir_stu3":"exporter.fhir_stu3.export","fhir_dstu2":"exporter.fhir_dstu2.export",
+                     "ccda":"exporter.ccda.export","csv":"exporter.csv.export","text":"exporter.text.export"}
+#fhir bundles are read by assignment04.py and Data extraction.py, csv tables by assignment03.py
+DEFAULT_EXPORTERS=["fhir","csv"]
+
+
+##Per run overrides of synthea.properties: output directory and exporters, the shared file is never changed
+def get_synthea_overrides(output_dir,exporters=DEFAULT_EXPORTERS):
+    output_dir="/".join(os.path.abspath(output_dir).split(os.path.sep))
+    overrides=" --exporter.baseDirectory \"%s/\""%(output_dir)
+    for exporter, exporter_property in sorted(EXPORTER_PROPERTIES.items()):
+        overrides+=" --%s %s"%(exporter_property,"true" if exporter in exporters else "false")
+    return overrides
+
+
+##Building Synthea command
+def get_synthea_command(population,seed,state,city,output_dir,exporters=DEFAULT_EXPORTERS):
     if(sys.platform=='win32'):
-        new_data_path="/".join(data_path.split(os.path.sep))+"/"+newline
+        synthea_run_cmd=".\\run_synthea.bat"+" -p %d -s %s %s %s"%(population,seed,state,city)
     else:
-        new_data_path=data_path+"/"+newline
-    
-    with open('synthea.properties',"r") as f:
-        lines=f.readlines()
-    
-        lines[0]="exporter.baseDirectory = "+new_data_path
-
-    with open('synthea.properties',"w") as f:
-        f.writelines(lines)
-    os.chdir(existing_dir)
+        synthea_run_cmd="./run_synthea"+" -p %d -s %s %s %s"%(population,seed,state,city)
+    return synthea_run_cmd+get_synthea_overrides(output_dir,exporters)
 
 
 ##Running Synthea command
-def run_synthea(script,data_dir,population,seed,state,city):
+def run_synthea(script,data_dir,population,seed,state,city,exporters=DEFAULT_EXPORTERS):
     path_for_synthea_dir, existing_dir=getting_path_for_synthea(script)
     os.chdir(path_for_synthea_dir)
     #running synthea command
-    if(sys.platform=='win32'):
-        synthea_run_cmd=".\\run_synthea.bat"+" -p %d -s %s %s %s"%(population,seed,state,city)
-    else:
-        synthea_run_cmd="./run_synthea"+" -p %d -s %s %s %s"%(population,seed,state,city)
+    synthea_run_cmd=get_synthea_command(population,seed,state,city,data_dir,exporters)
     try:
         process=subprocess.Popen(synthea_run_cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
         stdout, stderr = process.communicate()
         status = process.wait()
         if(status):
             print("Error occured! Because of one of the following reason.\n1)State and city are not correct combination.\n2)You have not entered the argument correctly.\n3)Please follow the proper format.")
+            return 0
         else:
             print("Process completed successfully!")
+            return 1
     except:
         print("Seems like Synthea is not installed in your machine. Please install synthea and try to run the command.")
+        return 0
     finally:
         os.chdir(existing_dir)
 
 
+##Splitting population and seed between shards
+def get_shard_plan(population,seed,shards):
+    shards=max(1,min(shards,population))
+    plan=[]
+    for index in range(shards):
+        shard_population=population//shards+(1 if index<population%shards else 0)
+        plan.append((shard_population,get_shard_seed(seed,index,shards)))
+    return plan
+
+
+##Seed of a shard, a hash of the given seed and the shard number so that no shard shares its seed with a shard or an unsharded run of another seed
+def get_shard_seed(seed,index,shards):
+    if shards==1:
+        return seed
+    digest=hashlib.sha256(("%d:%d"%(seed,index)).encode("utf8")).digest()
+    return int.from_bytes(digest[:8],"big")>>1         #non negative java long
+
+
+##Running Synthea in parallel shards
+def run_synthea_sharded(script,data_dir,population,seed,state,city,shards,exporters=DEFAULT_EXPORTERS):
+    path_for_synthea_dir, existing_dir=getting_path_for_synthea(script)
+    shard_root=os.path.join(os.path.abspath(data_dir),".shards")
+    shutil.rmtree(shard_root,ignore_errors=True)
+    processes=[]
+    try:
+        for index,(shard_population,shard_seed) in enumerate(get_shard_plan(population,seed,shards)):
+            shard_dir=os.path.join(shard_root,"shard_%d"%index)
+            os.makedirs(shard_dir)
+            log_file=open(os.path.join(shard_dir,"synthea.log"),"w")     #log file instead of pipe so a busy shard never blocks on output
+            synthea_run_cmd=get_synthea_command(shard_population,shard_seed,state,city,os.path.join(shard_dir,"output"),exporters)
+            process=subprocess.Popen(synthea_run_cmd,shell=True,cwd=path_for_synthea_dir,stdout=log_file,stderr=subprocess.STDOUT,
+                                     start_new_session=True)     #own process group, so the java process under the shell can be stopped with it
+            processes.append((process,shard_dir,log_file))
+    except:
+        print("Seems like Synthea is not installed in your machine. Please install synthea and try to run the command.")
+        stop_shards(processes)
+        shutil.rmtree(shard_root,ignore_errors=True)
+        return 0
+
+    failed_shard=None
+    pending=list(processes)
+    while pending and failed_shard is None:
+        for process in list(pending):
+            status=process[0].poll()
+            if status is None:
+                continue
+            pending.remove(process)
+            if status:
+                failed_shard=process[1]
+        time.sleep(0.5)
+    stop_shards(processes)              #also the leftovers of shards whose shell already exited
+    for process in processes:
+        process[2].close()
+
+    if failed_shard is not None:
+        with open(os.path.join(failed_shard,"synthea.log")) as f:
+            print(f.read()[-2000:])                 #tail of the failing shard log
+        print("Error occured in one of the Synthea shards, no data was merged. Because of one of the following reason.\n1)State and city are not correct combination.\n2)You have not entered the argument correctly.\n3)Please follow the proper format.")
+        shutil.rmtree(shard_root,ignore_errors=True)
+        return 0
+
+    merge_shard_outputs([os.path.join(process[1],"output") for process in processes],data_dir)
+    shutil.rmtree(shard_root,ignore_errors=True)
+    print("Process completed successfully!")
+    return 1
+
+
+##Stopping shards still running, with every process they started, and waiting until they are gone
+def stop_shards(processes,timeout=30):
+    for process in processes:
+        stop_process_group(process[0],signal.SIGTERM)
+    deadline=time.time()+timeout
+    for process in processes:
+        while is_process_group_running(process[0]) and time.time()<deadline:
+            time.sleep(0.1)
+        if is_process_group_running(process[0]):
+            stop_process_group(process[0],signal.SIGKILL if hasattr(signal,"SIGKILL") else signal.SIGTERM)
+        process[0].wait()
+
+
+##Sending a signal to the process group of a shard, the shard shell only where there are no process groups
+def stop_process_group(process,signal_number):
+    try:
+        if hasattr(os,"killpg"):
+            os.killpg(process.pid,signal_number)
+        elif process.poll() is None:
+            process.terminate()
+    except ProcessLookupError:
+        pass
+
+
+def is_process_group_running(process):
+    if not hasattr(os,"killpg"):
+        return process.poll() is None
+    process.poll()                      #reaping the shell, a zombie group leader would keep the group alive
+    try:
+        os.killpg(process.pid,0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+##Csv tables every shard writes in full, e.g. the same hospitals, with the columns counting their use by the shard's patients
+REFERENCE_TABLES={"organizations.csv":["REVENUE","UTILIZATION"],"providers.csv":["ENCOUNTERS","PROCEDURES","UTILIZATION"],
+                  "payers.csv":["AMOUNT_COVERED","AMOUNT_UNCOVERED","REVENUE","COVERED_ENCOUNTERS","UNCOVERED_ENCOUNTERS","COVERED_MEDICATIONS","UNCOVERED_MEDICATIONS",
+                                "COVERED_PROCEDURES","UNCOVERED_PROCEDURES","COVERED_IMMUNIZATIONS","UNCOVERED_IMMUNIZATIONS","UNIQUE_CUSTOMERS","MEMBER_MONTHS"]}
+#usage columns that are averages over the shard's patients, with the column they are weighted by
+AVERAGED_COLUMNS={"QOLS_AVG":"UNIQUE_CUSTOMERS"}
+
+
+##Adding the rows of a shard's reference table to rows by Id, the usage columns of a repeated Id are summed or averaged
+def add_reference_rows(source,rows,usage_columns):
+    with open(source,newline="",encoding="utf8") as f:
+        reader=csv.DictReader(f)
+        for row in reader:
+            existing=rows.setdefault(row["Id"],row)
+            if existing is row:
+                continue
+            for column, weight_column in AVERAGED_COLUMNS.items():     #before the weights are summed
+                if existing.get(column) and row.get(column) and existing.get(weight_column) and row.get(weight_column):
+                    weight=Decimal(existing[weight_column])+Decimal(row[weight_column])
+                    if weight:
+                        existing[column]=str(float((Decimal(existing[column])*Decimal(existing[weight_column])+Decimal(row[column])*Decimal(row[weight_column]))/weight))
+            for column in usage_columns:
+                if existing.get(column) and row.get(column):
+                    existing[column]=str(Decimal(existing[column])+Decimal(row[column]))   #exact sum of the decimal strings
+    return reader.fieldnames
+
+
+##Merging the output directories of the shards into the data directory
+def merge_shard_outputs(shard_dirs,data_dir):
+    written_csv=set()
+    reference_rows=dict()
+    reference_fields=dict()
+    for index,shard_dir in enumerate(shard_dirs):
+        if not os.path.isdir(shard_dir):
+            continue
+        for export_name in sorted(os.listdir(shard_dir)):
+            export_dir=os.path.join(shard_dir,export_name)
+            if not os.path.isdir(export_dir):
+                continue
+            target_dir=os.path.join(data_dir,export_name)
+            os.makedirs(target_dir,exist_ok=True)
+            for file_name in sorted(os.listdir(export_dir)):
+                source=os.path.join(export_dir,file_name)
+                target=os.path.join(target_dir,file_name)
+                if export_name=="csv" and file_name in REFERENCE_TABLES:    #one row per Id, not one per shard
+                    fieldnames=add_reference_rows(source,reference_rows.setdefault(target,dict()),REFERENCE_TABLES[file_name])
+                    if fieldnames:
+                        reference_fields.setdefault(target,fieldnames)      #header of the first shard
+                elif export_name=="csv":        #csv tables are concatenated, header kept from the first shard only
+                    with open(source,"rb") as src, open(target,"ab" if target in written_csv else "wb") as dst:
+                        if target in written_csv:
+                            src.readline()
+                        shutil.copyfileobj(src,dst)
+                    written_csv.add(target)
+                else:
+                    if os.path.exists(target):  #e.g. hospital and practitioner bundles exist once per shard
+                        target=os.path.join(target_dir,"shard%d_%s"%(index,file_name))
+                    shutil.move(source,target)
+    for target, fieldnames in reference_fields.items():
+        with open(target,"w",newline="",encoding="utf8") as f:
+            writer=csv.DictWriter(f,fieldnames,lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(reference_rows[target].values())
+
+
+##Generating a dataset into data_dir, sharded or with a single Synthea process
+def generate_dataset(args,data_dir):
+    if(args.shards>1):
+        return run_synthea_sharded(args.script,data_dir,args.population,args.seed,args.state,args.city,args.shards,args.exporters)  #every shard gets its own output directory, merged into data_dir at the end
+    return run_synthea(args.script,data_dir,args.population,args.seed,args.state,args.city,args.exporters)   #running the synthea command with provided arguments from user
+
+
+##Getting version of Synthea for the cache key, None when it can not be told
+def get_synthea_version(script):
+    path_for_synthea_dir, existing_dir=getting_path_for_synthea(script)
+    try:
+        head=subprocess.check_output(["git","rev-parse","HEAD"],cwd=path_for_synthea_dir,stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        head=None
+    if head:
+        changes=get_git_changes(path_for_synthea_dir)
+        return head+"+"+changes if changes else head    #uncommitted changes are part of the version
+    build_files=sorted(glob.glob(os.path.join(path_for_synthea_dir,"build","libs","*.jar")))   #not a git checkout, the built jars tell the version instead
+    if not build_files:
+        build_files=[os.path.join(path_for_synthea_dir,"build.gradle")]+sorted(os.path.join(root,file_name) for root, dirs, files in os.walk(os.path.join(path_for_synthea_dir,"src","main")) for file_name in files)
+    build_files=[file_name for file_name in build_files if os.path.isfile(file_name)]
+    if not build_files:
+        return None
+    digest=hashlib.sha256()
+    add_files_to_digest(digest,path_for_synthea_dir,build_files)
+    return "sha256:"+digest.hexdigest()
+
+
+##Adding the relative path and the content of every file to a digest
+def add_files_to_digest(digest,base_dir,file_names):
+    for file_name in file_names:
+        digest.update(os.path.relpath(file_name,base_dir).encode("utf8"))
+        with open(file_name,"rb") as f:
+            for block in iter(lambda: f.read(1<<20),b""):
+                digest.update(block)
+
+
+##Getting a digest of the uncommitted changes of a git checkout, modified and untracked files, "" when it is clean
+def get_git_changes(git_dir):
+    status=subprocess.check_output(["git","status","--porcelain","-z"],cwd=git_dir,stderr=subprocess.DEVNULL)
+    if not status:
+        return ""
+    digest=hashlib.sha256(status)
+    digest.update(subprocess.check_output(["git","diff","HEAD","--binary"],cwd=git_dir,stderr=subprocess.DEVNULL))
+    untracked=subprocess.check_output(["git","ls-files","--others","--exclude-standard","-z"],cwd=git_dir,stderr=subprocess.DEVNULL)
+    untracked=[os.path.join(git_dir,file_name) for file_name in sorted(untracked.decode("utf8").split("\0")) if file_name]
+    add_files_to_digest(digest,git_dir,[file_name for file_name in untracked if os.path.isfile(file_name)])
+    return "sha256:"+digest.hexdigest()
+
+
+##Getting a digest of the whole synthea.properties for the cache key, every generate.* or exporter.* setting changes the data
+def get_synthea_settings(script):
+    path_for_synthea_dir, existing_dir=getting_path_for_synthea(script)
+    try:
+        with open(os.path.join(path_for_synthea_dir,'src','main','resources','synthea.properties'),"rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except:
+        return None
+
+
+##Everything the generated data depends on. Synthea is seeded, so equal keys mean equal datasets. None when the Synthea version is not known
+def get_cache_key(args):
+    synthea_version=get_synthea_version(args.script)
+    if synthea_version is None:
+        return None, None
+    key_fields={"seed":args.seed,"population":args.population,"state":args.state,"city":args.city,"shards":args.shards,
+                "exporters":sorted(set(args.exporters)),"synthea_settings":get_synthea_settings(args.script),"synthea_version":synthea_version}
+    key=hashlib.sha256(json.dumps(key_fields,sort_keys=True).encode("utf8")).hexdigest()
+    return key, key_fields
+
+
+##Copying every file of a cached dataset into data_dir. Not hard links, Synthea and merge_shard_outputs rewrite the files of data_dir in place, which would change the cached copy too
+def restore_cached_dataset(cache_dir,key,data_dir):
+    entry_dir=os.path.join(cache_dir,key)
+    if not os.path.isdir(entry_dir):
+        return 0
+    os.utime(os.path.join(entry_dir,"cache_entry.json"))   #last use time for the LRU eviction
+    for root, dirs, files in os.walk(entry_dir):
+        for file_name in files:
+            source=os.path.join(root,file_name)
+            if source==os.path.join(entry_dir,"cache_entry.json"):
+                continue
+            target=os.path.join(data_dir,os.path.relpath(source,entry_dir))
+            os.makedirs(os.path.dirname(target),exist_ok=True)
+            if os.path.lexists(target):
+                os.remove(target)
+            shutil.copy2(source,target)
+    return 1
+
+
+##Adding a generated dataset to the cache
+def store_cached_dataset(cache_dir,key,key_fields,dataset_dir):
+    with open(os.path.join(dataset_dir,"cache_entry.json"),"w") as f:
+        json.dump(key_fields,f,indent=1)
+    entry_dir=os.path.join(cache_dir,key)
+    try:
+        os.replace(dataset_dir,entry_dir)       #entry appears complete or not at all
+    except OSError:
+        if not os.path.isdir(entry_dir):
+            raise
+        shutil.rmtree(dataset_dir,ignore_errors=True)   #a concurrent run stored the same dataset first, keeping its entry
+
+
+##Getting size of a directory in bytes
+def get_directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root,file_name)) for root, dirs, files in os.walk(directory) for file_name in files)
+
+
+##Removing least recently used datasets until the cache fits into cache_size MB
+def evict_cached_datasets(cache_dir,cache_size,keep_key=None):
+    entries=[]
+    for key in os.listdir(cache_dir):
+        entry_file=os.path.join(cache_dir,key,"cache_entry.json")
+        if os.path.exists(entry_file):
+            entries.append((os.path.getmtime(entry_file),key,get_directory_size(os.path.join(cache_dir,key))))
+    total_size=sum(entry[2] for entry in entries)
+    for last_used, key, size in sorted(entries):
+        if total_size<=cache_size*1024*1024:
+            break
+        if key==keep_key:
+            continue
+        shutil.rmtree(os.path.join(cache_dir,key),ignore_errors=True)
+        total_size-=size
+
+
+##Serving the dataset from the cache, generating and caching it on a miss
+def generate_cached_dataset(args):
+    key, key_fields=get_cache_key(args)
+    if key is None:
+        print("Synthea version is not known, neither a git checkout nor built, so the dataset is not cached.")
+        return generate_dataset(args,args.data)
+    if restore_cached_dataset(args.cache_dir,key,args.data):
+        print("Dataset served from the cache at",os.path.join(args.cache_dir,key))
+        return 1
+    os.makedirs(args.cache_dir,exist_ok=True)
+    staging_dir=tempfile.mkdtemp(prefix=".staging-",dir=args.cache_dir)     #own directory per run, concurrent runs of the same key do not share it
+    try:
+        if not generate_dataset(args,staging_dir):
+            return 0
+        store_cached_dataset(args.cache_dir,key,key_fields,staging_dir)
+    finally:
+        shutil.rmtree(staging_dir,ignore_errors=True)   #already moved into the cache when stored
+    restore_cached_dataset(args.cache_dir,key,args.data)
+    evict_cached_datasets(args.cache_dir,args.cache_size,keep_key=key)
+    return 1
+
+
 def main():
     clear_terminal()
     args=parsing_argument()             #getting the argument from above defined function
@@ -137,8 +477,10 @@ def main():
     args.state="\"{}\"".format(args.state)
     args.city="\"{}\"".format(args.city)
 
-    setting_path_for_data_dir(args.script,args.data)    #setting the data_dir file path if user has provided new file path
-    run_synthea(args.script,args.data,args.population,args.seed,args.state,args.city)   #running the synthea command with provided arguments from user
+    if(args.no_cache):
+        generate_dataset(args,args.data)
+    else:
+        generate_cached_dataset(args)       #same seed, population, place and settings give the same dataset, so it is generated only once
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import csv
+
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))     #the scripts are imported from the repository root
+
+
+#small synthea shaped export: a repeated patient Id, a second description of a code in one
+#encounter, a medication pointing at another patient's encounter and one of an unknown patient
+PATIENTS=[['A','1950-01-01','Ann','Old','F'],['B','1960-02-02','Bob','Smith','M'],
+          ['A','1951-01-01','Ann','New','F'],['C','1970-03-03','Cid','Jones','M']]
+ENCOUNTERS=[['e1','2010-01-01T00:00:00Z','2010-01-01T01:00:00Z','A','1','Check up'],
+            ['e2','2011-01-01T00:00:00Z','2011-01-01T01:00:00Z','B','2','Symptom'],
+            ['e3','2012-01-01T00:00:00Z','2012-01-01T01:00:00Z','C','3','Emergency'],
+            ['e4','2013-01-01T00:00:00Z','2013-01-01T01:00:00Z','A','2','Symptom']]
+MEDICATIONS=[['2010-01-01T00:00:00Z','','B','e1','10','Drug X'],
+             ['2010-01-01T00:00:00Z','','A','e1','10','Drug A'],
+             ['2010-01-01T00:00:00Z','','A','e1','10','Drug A again'],
+             ['2013-01-01T00:00:00Z','2013-02-01T00:00:00Z','A','e4','20','Drug B'],
+             ['2011-01-01T00:00:00Z','','B','e2','20','Drug B'],
+             ['2011-01-01T00:00:00Z','','B','e1','40','Drug D'],
+             ['2012-01-01T00:00:00Z','','C','e3','30','Drug C'],
+             ['2012-01-01T00:00:00Z','','Z','e3','50','Drug E']]
+
+
+def write_csv(path, header, rows):
+    with open(path,'w',newline='') as f:
+        writer=csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return str(path)
+
+
+@pytest.fixture
+def csv_files(tmp_path):
+    """(patients, encounters, medications) csv files of the small export"""
+    return (write_csv(tmp_path/'patients.csv',['Id','BIRTHDATE','FIRST','LAST','GENDER'],PATIENTS),
+            write_csv(tmp_path/'encounters.csv',['Id','START','STOP','PATIENT','CODE','DESCRIPTION'],ENCOUNTERS),
+            write_csv(tmp_path/'medications.csv',['START','STOP','PATIENT','ENCOUNTER','CODE','DESCRIPTION'],MEDICATIONS))
@@ -0,0 +1,38 @@
+import os
+
+import benchmark
+
+
+def test_benchmark_stages_with_worker_processes(tmp_path):
+    csv_dir=str(tmp_path/'csv')
+    fhir_dir=str(tmp_path/'fhir')
+    output_dir=str(tmp_path/'out')
+    benchmark.generate_csv_tables(csv_dir,5)
+    benchmark.generate_fhir_bundles(fhir_dir,5)
+    os.makedirs(output_dir)
+    stages={name:(setup,stage) for name, setup, stage in benchmark.get_stages(csv_dir,fhir_dir,output_dir)}
+    results=dict()
+    for name in ['parse_claims_into_csv','parse_claims_into_csv[workers=2]','add_medications_to_patients[workers=4]','write_ndjson_files[workers=4,gzip]']:
+        results[name]=benchmark.run_stage(*stages[name],memory=False)
+        assert results[name]['seconds']>=0
+    claims=[]
+    for claims_dir in sorted(os.listdir(output_dir)):          #one output directory per parse_claims_into_csv run
+        if not os.path.isdir(os.path.join(output_dir,claims_dir)):
+            continue
+        with open(os.path.join(output_dir,claims_dir,'claims.csv')) as f:
+            claims.append(f.read())
+    assert len(claims)==2 and claims[0]==claims[1]
+
+
+def test_plot_stages_do_not_render(tmp_path):
+    csv_dir=str(tmp_path/'csv')
+    fhir_dir=str(tmp_path/'fhir')
+    work_dir=str(tmp_path/'work')
+    benchmark.generate_fhir_bundles(fhir_dir,60)
+    os.makedirs(work_dir)
+    stages={name:(setup,stage) for name, setup, stage in benchmark.get_stages(csv_dir,fhir_dir,work_dir)}
+    for name in [name for name in stages if name.startswith('plot_')]:
+        benchmark.run_stage(*stages[name],memory=False)
+    assert os.listdir(work_dir)==[]
+    benchmark.run_stage(*stages['render_all_figures[workers=1]'],memory=False)
+    assert len(os.listdir(os.path.join(work_dir,'figures')))==8
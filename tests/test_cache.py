@@ -0,0 +1,54 @@
+import os
+from types import SimpleNamespace
+
+import main
+
+
+def get_args(tmp_path, seed):
+    synthea_dir=tmp_path/'synthea'
+    os.makedirs(synthea_dir/'build'/'libs',exist_ok=True)
+    (synthea_dir/'build'/'libs'/'synthea.jar').write_text('jar')    #not a git checkout, keyed by the built jar
+    return SimpleNamespace(script=str(synthea_dir/'run_synthea'),data=str(tmp_path/'data'),seed=seed,population=10,state='"Pennsylvania"',
+                           city='"Pittsburgh"',shards=1,exporters=['csv'],cache_dir=str(tmp_path/'cache'),cache_size=100)
+
+
+def fake_generate_dataset(args, data_dir):
+    os.makedirs(os.path.join(data_dir,'csv'),exist_ok=True)
+    with open(os.path.join(data_dir,'csv','patients.csv'),'w') as f:    #truncated in place, as Synthea does
+        f.write('Id\nseed-%d\n'%args.seed)
+    return 1
+
+
+def read_tree(directory):
+    files={}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            with open(os.path.join(root,name)) as f:
+                files[os.path.relpath(os.path.join(root,name),directory)]=f.read()
+    return files
+
+
+def test_regenerating_without_cache_leaves_cache_entry_unchanged(tmp_path, monkeypatch):
+    monkeypatch.setattr(main,'generate_dataset',fake_generate_dataset)
+    args=get_args(tmp_path,1)
+    os.makedirs(args.data)
+    assert main.generate_cached_dataset(args)
+    assert main.generate_cached_dataset(args)          #served from the cache into --data
+    key, key_fields=main.get_cache_key(args)
+    entry_dir=os.path.join(args.cache_dir,key)
+    cached=read_tree(entry_dir)
+    assert cached['csv/patients.csv']=='Id\nseed-1\n'
+
+    main.generate_dataset(get_args(tmp_path,99),args.data)     #--no-cache run writing over the restored files
+    assert read_tree(args.data)['csv/patients.csv']=='Id\nseed-99\n'
+    assert read_tree(entry_dir)==cached
+
+
+def test_cache_key_changes_with_any_synthea_setting(tmp_path):
+    args=get_args(tmp_path,1)
+    properties=tmp_path/'synthea'/'src'/'main'/'resources'/'synthea.properties'
+    os.makedirs(properties.parent)
+    properties.write_text('exporter.csv.export = true\ngenerate.only_alive_patients = false\n')
+    key, key_fields=main.get_cache_key(args)
+    properties.write_text('exporter.csv.export = true\ngenerate.only_alive_patients = true\n')
+    assert main.get_cache_key(args)[0]!=key
@@ -0,0 +1,91 @@
+import os
+import csv
+import json
+import shutil
+
+import pytest
+
+import benchmark
+from benchmark import data_extraction
+
+
+def copy_bundles(source_dir, fhir_dir, file_names):
+    os.makedirs(fhir_dir,exist_ok=True)
+    for file_name in file_names:
+        shutil.copy2(os.path.join(source_dir,file_name),os.path.join(fhir_dir,file_name))
+
+
+def read_outputs(output_dir):
+    with open(os.path.join(output_dir,'claims.csv'),newline='') as f:
+        claims=f.read()
+    with open(os.path.join(output_dir,'claims.csv.rollup.json')) as f:
+        rollup=json.load(f)
+    return claims, rollup
+
+
+def full_run(tmp_path, source_dir, file_names):
+    fhir_dir=str(tmp_path/'full_fhir')
+    output_dir=str(tmp_path/'full_out')
+    copy_bundles(source_dir,fhir_dir,file_names)
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv')==1
+    return read_outputs(output_dir)
+
+
+@pytest.fixture
+def bundles(tmp_path):
+    source_dir=str(tmp_path/'source')
+    benchmark.generate_fhir_bundles(source_dir,6)
+    return source_dir, sorted(os.listdir(source_dir))
+
+
+def test_incremental_run_after_adding_a_bundle(tmp_path, bundles):
+    source_dir, file_names=bundles
+    fhir_dir=str(tmp_path/'fhir')
+    output_dir=str(tmp_path/'out')
+    copy_bundles(source_dir,fhir_dir,file_names[:-1])
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv')==1
+    copy_bundles(source_dir,fhir_dir,file_names[-1:])
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv',incremental=True)==1     #appends the rows and merges the saved rollup
+    assert read_outputs(output_dir)==full_run(tmp_path,source_dir,file_names)
+    manifest=data_extraction.load_manifest(data_extraction.get_manifest_path(output_dir,'claims.csv'))
+    assert [bundle['path'] for bundle in manifest['bundles']]==file_names
+
+
+def test_incremental_run_after_removing_a_bundle(tmp_path, bundles):
+    source_dir, file_names=bundles
+    fhir_dir=str(tmp_path/'fhir')
+    output_dir=str(tmp_path/'out')
+    copy_bundles(source_dir,fhir_dir,file_names)
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv')==1
+    os.remove(os.path.join(fhir_dir,file_names[2]))
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv',incremental=True)==1     #rewrites the csv file and rebuilds the rollup
+    kept_names=file_names[:2]+file_names[3:]
+    assert read_outputs(output_dir)==full_run(tmp_path,source_dir,kept_names)
+    manifest=data_extraction.load_manifest(data_extraction.get_manifest_path(output_dir,'claims.csv'))
+    assert [bundle['path'] for bundle in manifest['bundles']]==kept_names
+
+
+def test_incremental_run_after_adding_a_bundle_in_between(tmp_path, bundles):
+    source_dir, file_names=bundles
+    fhir_dir=str(tmp_path/'fhir')
+    output_dir=str(tmp_path/'out')
+    copy_bundles(source_dir,fhir_dir,file_names[:2]+file_names[3:])
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv')==1
+    copy_bundles(source_dir,fhir_dir,file_names[2:3])
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv',incremental=True)==1
+    claims, rollup=read_outputs(output_dir)
+    full_claims, full_rollup=full_run(tmp_path,source_dir,file_names)
+    assert rollup==full_rollup
+    assert sorted(csv.reader(claims.splitlines()))==sorted(csv.reader(full_claims.splitlines()))   #new rows are appended, not put in file order
+
+
+def test_incremental_run_with_unchanged_bundles_keeps_outputs(tmp_path, bundles):
+    source_dir, file_names=bundles
+    fhir_dir=str(tmp_path/'fhir')
+    output_dir=str(tmp_path/'out')
+    copy_bundles(source_dir,fhir_dir,file_names)
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv')==1
+    before=read_outputs(output_dir)
+    os.utime(os.path.join(fhir_dir,file_names[0]))                                                  #touched, the content hash still matches
+    assert data_extraction.parse_claims_into_csv(fhir_dir,output_dir,'claims.csv',incremental=True)==1
+    assert read_outputs(output_dir)==before
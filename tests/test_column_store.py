@@ -0,0 +1,25 @@
+import os
+import multiprocessing
+
+import assignment04
+import benchmark
+
+
+def compile_store(arguments):
+    bundle_path, store_dir=arguments
+    store=assignment04.compile_fhir_store(bundle_path,store_dir)
+    return store.manifest['signature'], len(store.get_objects('Patient'))
+
+
+def test_concurrent_compiles_leave_one_complete_store(tmp_path):
+    bundle_path=str(tmp_path/'fhir')
+    store_dir=str(tmp_path/'store')
+    benchmark.generate_fhir_bundles(bundle_path,6)
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        results=pool.map(compile_store,[(bundle_path,store_dir)]*8)
+    assert len(set(results))==1 and results[0][1]==6
+
+    benchmark.generate_fhir_bundles(bundle_path,8)     #adds two bundles, the store is rebuilt and swapped in
+    signature, patients=compile_store((bundle_path,store_dir))
+    assert signature!=results[0][0] and patients==8
+    assert sorted(os.listdir(str(tmp_path)))==['fhir','store']     #no build or old directory is left
@@ -0,0 +1,16 @@
+from types import SimpleNamespace
+
+import assignment04
+
+
+def get_condition(patient_ref, display):
+    coding=SimpleNamespace(display=display)
+    return SimpleNamespace(code=SimpleNamespace(coding=[coding]),subject=SimpleNamespace(reference=patient_ref))
+
+
+def test_conditions_without_display_are_skipped():
+    conditions=[get_condition('p1','Diabetes'),get_condition('p1','Hypertension'),get_condition('p2','Diabetes'),get_condition('p2',None)]
+    matrix=assignment04.get_condition_comorbidity_matrix(conditions)
+    assert list(matrix.index)==['Diabetes','Hypertension']
+    assert matrix.loc['Diabetes','Diabetes']==2
+    assert matrix.loc['Diabetes','Hypertension']==1
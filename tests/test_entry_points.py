@@ -0,0 +1,31 @@
+import pytest
+
+import assignment04
+from benchmark import data_extraction
+
+
+@pytest.mark.parametrize('argv',[[],['-f','data/fhir/'],['-f','data/fhir/','-o','out/'],['--fhir=data/fhir/','--output=out/']])
+def test_plain_command_line_is_left_to_the_original_entry_point(argv):
+    assert not data_extraction.is_extended_command_line(argv)
+
+
+@pytest.mark.parametrize('argv',[['--help'],['-w','4'],['-w4'],['--workers=4'],['-f','data/fhir/','--incremental'],
+                                 ['--stats','-'],['--parse-mode','dict'],['--chunk-size','8','-o','out/']])
+def test_new_options_use_the_extended_entry_point(argv):
+    assert data_extraction.is_extended_command_line(argv)
+
+
+def test_extended_defaults_match_parse_claims_into_csv():
+    args=data_extraction.get_extended_args(['-f','bundles'])
+    assert (args.fhir,args.output,args.workers,args.chunk_size,args.incremental,args.parse_mode,args.stats)==('bundles','out/',1,1,False,'filtered',None)
+
+
+@pytest.mark.parametrize('argv',[['data/fhir'],['--batch','data/fhir'],['data/fhir','-o','figures'],['data/fhir','-w2'],
+                                 ['data/fhir','--compile'],['data/fhir','--column-store','--store-dir','store'],['-h']])
+def test_assignment04_uses_the_extended_entry_point_for_new_options(argv):
+    assert assignment04.is_extended_command_line(argv)==(argv!=['data/fhir'])
+
+
+def test_assignment04_extended_defaults():
+    args=assignment04.get_extended_args(['data/fhir'])
+    assert (args.bundle_path,args.batch,args.output_dir,args.workers,args.compile,args.column_store,args.store_dir)==('data/fhir',False,'.',None,False,False,None)
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+import pytest
+
+import assignment04
+
+
+def get_columns(rng, rows):
+    patient=[rng.randrange(5) for row in range(rows)]
+    return {'patient':np.array(patient,dtype=np.int32),'patients':['urn:uuid:%d'%index for index in range(5)],
+            'code':np.array([rng.randrange(3) for row in range(rows)],dtype=np.int32),    #code 2 is neither side
+            'effective':np.array([rng.randrange(-20,20) for row in range(rows)],dtype=np.int64),   #few times, many ties
+            'value':np.arange(rows,dtype=np.float64)}
+
+
+def naive_join(columns, left_code, right_code, tolerance, direction):
+    """Pairs every left row with a right row of the same patient by looping over the rows"""
+    rows=range(len(columns['code']))
+    left=sorted((row for row in rows if columns['code'][row]==left_code),key=lambda row: (columns['patient'][row],columns['effective'][row],row))
+    pairs=[]
+    for left_row in left:
+        patient, time=columns['patient'][left_row], columns['effective'][left_row]
+        right=[row for row in rows if columns['code'][row]==right_code and columns['patient'][row]==patient]
+        earlier=[row for row in right if columns['effective'][row]<=time]
+        later=[row for row in right if columns['effective'][row]>=time]
+        candidates=[]
+        if earlier and direction in ('backward','nearest'):     #latest earlier one, the last in row order on equal times
+            backward=max(earlier,key=lambda row: (columns['effective'][row],row))
+            candidates.append((time-columns['effective'][backward],0,backward))
+        if later and direction in ('forward','nearest'):        #earliest later one, the first in row order on equal times
+            forward=min(later,key=lambda row: (columns['effective'][row],row))
+            candidates.append((columns['effective'][forward]-time,1,forward))
+        if candidates:
+            distance, side, right_row=min(candidates)           #backward wins a tie
+            if tolerance is None or distance<=tolerance:
+                pairs.append((left_row,right_row))
+    return pairs
+
+
+@pytest.mark.parametrize('direction',['backward','forward','nearest'])
+@pytest.mark.parametrize('tolerance',[None,0,3])
+@pytest.mark.parametrize('seed',range(5))
+def test_join_observations_matches_naive_loop(direction, tolerance, seed):
+    columns=get_columns(random.Random(seed),200)
+    joined=assignment04.join_observations(columns,0,1,tolerance,direction)
+    pairs=naive_join(columns,0,1,tolerance,direction)
+    assert joined['patient'].tolist()==[columns['patient'][left] for left, right in pairs]
+    assert joined['left_value'].tolist()==[float(left) for left, right in pairs]     #value is the row number
+    assert joined['right_value'].tolist()==[float(right) for left, right in pairs]
+    assert joined['left_effective'].astype(np.int64).tolist()==[columns['effective'][left] for left, right in pairs]
+    assert joined['right_effective'].astype(np.int64).tolist()==[columns['effective'][right] for left, right in pairs]
+
+
+def test_join_observations_edges():
+    columns={'patient':np.array([0,0,1,1,1],dtype=np.int32),'patients':['a','b'],'code':np.array([0,1,1,0,0],dtype=np.int32),
+             'effective':np.array([5,10,0,-100,100],dtype=np.int64),'value':np.arange(5,dtype=np.float64)}
+    backward=assignment04.join_observations(columns,0,1,None,'backward')
+    assert backward['left_value'].tolist()==[4.0]            #patient 0's left is before its first right, patient 1's right is never used for patient 0
+    forward=assignment04.join_observations(columns,0,1,None,'forward')
+    assert forward['left_value'].tolist()==[0.0,3.0] and forward['right_value'].tolist()==[1.0,2.0]
+    empty=assignment04.join_observations({key:value[:0] if key!='patients' else value for key, value in columns.items()},0,1)
+    assert len(empty['left_value'])==0
@@ -0,0 +1,51 @@
+import csv
+import os
+
+import main
+
+
+PAYERS_HEADER=['Id','NAME','AMOUNT_COVERED','REVENUE','UNIQUE_CUSTOMERS','QOLS_AVG','MEMBER_MONTHS']
+
+
+def write_shard(shard_dir, index):
+    os.makedirs(os.path.join(shard_dir,'csv'))
+    tables={'payers.csv':[PAYERS_HEADER,['p1','Medicare','100.50','10',str(index+1),'0.5' if index==0 else '0.8','12'],['p2','NO_INSURANCE','0.0','0','0','0.0','0']],
+            'organizations.csv':[['Id','NAME','REVENUE','UTILIZATION'],['o1','Hospital, A','100.10',str(index+1)]],
+            'providers.csv':[['Id','ORGANIZATION','NAME','ENCOUNTERS','PROCEDURES'],['d1','o1','Dr','3','0']],
+            'patients.csv':[['Id','FIRST'],['patient%d'%index,'Ann']]}
+    for file_name, rows in tables.items():
+        with open(os.path.join(shard_dir,'csv',file_name),'w',newline='') as f:
+            csv.writer(f).writerows(rows)
+
+
+def read_rows(path):
+    with open(path,newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_reference_tables_have_one_row_per_id(tmp_path):
+    shard_dirs=[str(tmp_path/('shard_%d'%index)) for index in range(3)]
+    for index, shard_dir in enumerate(shard_dirs):
+        write_shard(shard_dir,index)
+    main.merge_shard_outputs(shard_dirs,str(tmp_path/'data'))
+    csv_dir=tmp_path/'data'/'csv'
+
+    payers=read_rows(csv_dir/'payers.csv')
+    assert [payer['Id'] for payer in payers]==['p1','p2']
+    assert payers[0]['AMOUNT_COVERED']=='301.50' and payers[0]['UNIQUE_CUSTOMERS']=='6' and payers[0]['MEMBER_MONTHS']=='36'
+    assert abs(float(payers[0]['QOLS_AVG'])-(0.5*1+0.8*2+0.8*3)/6)<1e-12   #weighted by the customers of each shard
+    assert payers[1]['QOLS_AVG']=='0.0'
+    organizations=read_rows(csv_dir/'organizations.csv')
+    assert [(row['Id'],row['NAME'],row['REVENUE'],row['UTILIZATION']) for row in organizations]==[('o1','Hospital, A','300.30','6')]
+    assert [row['ENCOUNTERS'] for row in read_rows(csv_dir/'providers.csv')]==['9']
+    assert [row['Id'] for row in read_rows(csv_dir/'patients.csv')]==['patient0','patient1','patient2']    #other tables are concatenated
+
+
+def test_shard_seeds_do_not_overlap_between_runs():
+    seeds=dict()
+    for seed in range(50):
+        for shards in [1,2,4]:
+            for index, (population, shard_seed) in enumerate(main.get_shard_plan(100,seed,shards)):
+                seeds.setdefault(shard_seed,set()).add(seed)
+    assert all(len(runs)==1 for runs in seeds.values())     #a shard seed belongs to a single --seed
+    assert sum(population for population, shard_seed in main.get_shard_plan(101,7,4))==101
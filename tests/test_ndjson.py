@@ -0,0 +1,53 @@
+import gzip
+import json
+import multiprocessing
+
+import pytest
+
+import assignment03
+import benchmark
+
+
+def load(create, csv_dir):
+    patients=create(str(csv_dir/'patients.csv'))
+    assignment03.add_encounters_to_patients(patients,str(csv_dir/'encounters.csv'))
+    assignment03.add_medications_to_patients(patients,str(csv_dir/'medications.csv'))
+    return patients
+
+
+@pytest.fixture(scope='module')
+def csv_dir(tmp_path_factory):
+    csv_dir=tmp_path_factory.mktemp('csv')
+    benchmark.generate_csv_tables(str(csv_dir),60)
+    return csv_dir
+
+
+@pytest.mark.parametrize('backend',['dictionary','store','database'])
+@pytest.mark.parametrize('workers',[1,2])
+@pytest.mark.parametrize('shards',[1,3])
+def test_gzip_shards_decompress_to_write_ndjson(csv_dir, tmp_path, backend, workers, shards):
+    create={'dictionary':assignment03.create_patient_dictionary,'store':assignment03.create_patient_store,
+            'database':lambda file_name: assignment03.create_patient_database(file_name,str(tmp_path/'patients.sqlite3'))}[backend]
+    patients=load(create,csv_dir)
+    assignment03.write_ndjson(str(tmp_path/'expected.ndjson'),patients)
+    with open(str(tmp_path/'expected.ndjson'),'rb') as f:
+        expected=f.read().splitlines(keepends=True)
+    file_names=assignment03.write_ndjson_files(str(tmp_path/'patients.ndjson'),patients,workers=workers,batch_size=7,compress=True,shards=shards)
+    assert len(file_names)==shards
+    for shard, file_name in enumerate(file_names):
+        with gzip.open(file_name,'rb') as f:
+            lines=f.read()
+        assert lines==b''.join(line for line in expected if shards==1 or assignment03.get_patient_shard(json.loads(line)['Id'],shards)==shard)
+
+
+@pytest.mark.parametrize('backend',['store','database'])
+def test_spawned_workers(csv_dir, tmp_path, monkeypatch, backend):
+    get_context=multiprocessing.get_context
+    monkeypatch.setattr(multiprocessing,'get_context',lambda method=None: get_context('spawn'))     #as on Windows and macOS
+    create={'store':assignment03.create_patient_store,
+            'database':lambda file_name: assignment03.create_patient_database(file_name,str(tmp_path/'patients.sqlite3'))}[backend]
+    patients=load(create,csv_dir)
+    assignment03.write_ndjson(str(tmp_path/'expected.ndjson'),patients)
+    file_names=assignment03.write_ndjson_files(str(tmp_path/'patients.ndjson'),patients,workers=2,batch_size=7,compress=True)
+    with gzip.open(file_names[0],'rb') as f, open(str(tmp_path/'expected.ndjson'),'rb') as expected:
+        assert f.read()==expected.read()
@@ -0,0 +1,54 @@
+import gc
+import tracemalloc
+
+import assignment03
+import benchmark
+
+
+def load(create, csv_files):
+    patients_file, encounters_file, medications_file=csv_files
+    patients=create(patients_file)
+    assignment03.add_encounters_to_patients(patients,encounters_file)
+    assignment03.add_medications_to_patients(patients,medications_file)
+    return patients
+
+
+def test_store_with_duplicate_patient_id_matches_dictionary(csv_files):
+    expected=load(assignment03.create_patient_dictionary,csv_files)
+    store=load(assignment03.create_patient_store,csv_files)
+    assert list(store)==list(expected)==['A','B','C']
+    for patient_id in expected:
+        assert store[patient_id]==expected[patient_id]
+    assert store['A']['LAST']=='New'                #last values of a repeated Id, first position
+    assert list(store['C']['ENCOUNTERS'])==['e3']
+    assert list(store['C']['MEDICATIONS'])==['30']
+
+
+def test_database_with_duplicate_patient_id_matches_dictionary(csv_files, tmp_path):
+    expected=load(assignment03.create_patient_dictionary,csv_files)
+    database=load(lambda file_name: assignment03.create_patient_database(file_name,str(tmp_path/'patients.sqlite3')),csv_files)
+    assert sorted(database)==sorted(expected)
+    for patient_id in expected:
+        assert database[patient_id]==expected[patient_id]
+
+
+def get_traced_size(load):
+    gc.collect()
+    tracemalloc.start()
+    patients=load()
+    size=tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, patients
+
+
+def test_store_uses_a_fifth_of_the_dictionary_memory(tmp_path):
+    benchmark.generate_csv_tables(str(tmp_path),500)
+    def load(create):
+        patients=create(str(tmp_path/'patients.csv'))
+        assignment03.add_encounters_to_patients(patients,str(tmp_path/'encounters.csv'))
+        assignment03.add_medications_to_patients(patients,str(tmp_path/'medications.csv'))
+        return patients
+    dictionary_size, expected=get_traced_size(lambda: load(assignment03.create_patient_dictionary))
+    store_size, store=get_traced_size(lambda: load(assignment03.create_patient_store))
+    assert dictionary_size>=5*store_size
+    assert all(store[patient_id]==expected[patient_id] for patient_id in expected)
@@ -0,0 +1,41 @@
+import pytest
+
+import assignment03
+
+
+def scan_problem2(patients):
+    """problem2 as it scanned every patient before the encounter_medications index"""
+    set_of_description=set()
+    for row in patients:
+        if 'ENCOUNTERS' in patients[row].keys() and 'MEDICATIONS' in patients[row].keys():
+            encounterid_list=patients[row]['ENCOUNTERS'].keys()
+            for medication_id in patients[row]['MEDICATIONS'].keys():
+                medications=patients[row]['MEDICATIONS'][medication_id]
+                for medication_encounter_id in [medication['ENCOUNTER'] for medication in medications]:
+                    if medication_encounter_id in encounterid_list:
+                        encounter_description=patients[row]['ENCOUNTERS'][medication_encounter_id]['DESCRIPTION']
+                        medication_description=[medication['DESCRIPTION'] for medication in medications if medication['ENCOUNTER']==medication_encounter_id][0]
+                        set_of_description.add((encounter_description,medication_description))
+    return list(set_of_description)
+
+
+def load(create, csv_files):
+    patients_file, encounters_file, medications_file=csv_files
+    patients=create(patients_file)
+    assignment03.add_encounters_to_patients(patients,encounters_file)
+    assignment03.add_medications_to_patients(patients,medications_file)
+    return patients
+
+
+@pytest.mark.parametrize('backend',['dictionary','store','database'])
+def test_problem2_matches_scan(csv_files, tmp_path, backend):
+    create={'dictionary':assignment03.create_patient_dictionary,'store':assignment03.create_patient_store,
+            'database':lambda file_name: assignment03.create_patient_database(file_name,str(tmp_path/'patients.sqlite3'))}[backend]
+    patients=load(create,csv_files)
+    assert sorted(assignment03.problem2(patients))==sorted(scan_problem2(patients))==[('Check up','Drug A'),('Emergency','Drug C'),('Symptom','Drug B')]
+
+
+def test_problem2_skips_removed_patients(csv_files):
+    patients=load(assignment03.create_patient_dictionary,csv_files)
+    del patients['A']                           #its encounters are still in the encounter_medications index
+    assert sorted(assignment03.problem2(patients))==sorted(scan_problem2(patients))==[('Emergency','Drug C'),('Symptom','Drug B')]
@@ -0,0 +1,26 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+REPO_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES=['numpy','pandas','scipy','matplotlib','seaborn','fhirclient','progressbar']
+CHECK_MODULES="import sys; print(' '.join(name for name in %r if name in sys.modules))"%HEAVY_MODULES
+
+
+@pytest.mark.parametrize('code',['import assignment04',
+                                 'import runpy; runpy.run_path("Data extraction.py",run_name="data_extraction")',
+                                 'import assignment03',
+                                 'import fhir_stream'])
+def test_import_does_not_load_heavy_modules(code):
+    completed=subprocess.run([sys.executable,'-c',code+'; '+CHECK_MODULES],cwd=REPO_DIR,capture_output=True,universal_newlines=True,check=True)
+    assert completed.stdout.split()==[]
+
+
+def test_help_does_not_load_heavy_modules():
+    completed=subprocess.run([sys.executable,'-X','importtime','Data extraction.py','--help'],cwd=REPO_DIR,
+                             capture_output=True,universal_newlines=True,check=True)
+    imported={line.split('|')[-1].strip().split('.')[0] for line in completed.stderr.splitlines() if line.startswith('import time:')}
+    assert imported.isdisjoint(HEAVY_MODULES)
@@ -0,0 +1,57 @@
+import json
+import random
+
+import pytest
+
+import fhir_stream
+from fhir_stream import iter_bundle_entries, load_bundle_json
+
+
+def get_entry(resource_type, index, rng):
+    resource={'resourceType':resource_type,'id':'%s-%d'%(resource_type,index),'text':'café "quoted" \\ line\nbreak ✓',
+              'valueQuantity':{'value':round(rng.uniform(-1e6,1e6),rng.randint(0,6)),'unit':'mg'},
+              'component':[{'value':rng.randint(0,10**12)} for i in range(rng.randint(0,3))],'flag':rng.choice([True,False,None])}
+    return {'fullUrl':'urn:uuid:%d'%index,'resource':resource,'request':{'method':'POST','url':resource_type}}
+
+
+@pytest.fixture
+def bundle_file(tmp_path):
+    rng=random.Random(7)
+    entries=[get_entry(rng.choice(['Patient','Condition','Observation','Claim']),index,rng) for index in range(300)]
+    entries.append({'fullUrl':'urn:uuid:no-request','resource':{'resourceType':'Basic'}})
+    bundle={'resourceType':'Bundle','type':'transaction','entry':entries,'total':12345}
+    file_name=tmp_path/'bundle.json'
+    file_name.write_text(json.dumps(bundle,indent=1,ensure_ascii=False),encoding='utf-8')
+    return str(file_name)
+
+
+def load_expected(file_name, object_names):
+    with open(file_name,encoding='utf-8') as f:
+        bundle=json.load(f)
+    entries=[entry for entry in bundle['entry'] if object_names is None or entry.get('request',{}).get('url') in object_names]
+    return dict(bundle,entry=entries)
+
+
+@pytest.mark.parametrize('object_names',[None,['Patient'],['Observation','Claim'],['Missing']])
+@pytest.mark.parametrize('read_size',[1,7,256,fhir_stream.READ_SIZE])
+def test_streamed_entries_equal_json_load(bundle_file, object_names, read_size):
+    bundle=dict()
+    entries=list(iter_bundle_entries(bundle_file,object_names,bundle,read_size))
+    assert dict(bundle,entry=entries)==load_expected(bundle_file,object_names)
+
+
+def test_load_bundle_json_equals_json_load(bundle_file):
+    assert load_bundle_json(bundle_file,['Condition'])==load_expected(bundle_file,['Condition'])
+    assert load_bundle_json(bundle_file)==load_expected(bundle_file,None)
+
+
+def test_empty_bundle_and_truncated_file(tmp_path):
+    empty=tmp_path/'empty.json'
+    empty.write_text('{ "resourceType": "Bundle", "entry": [] }')
+    bundle=dict()
+    assert list(iter_bundle_entries(str(empty),None,bundle))==[]
+    assert bundle=={'resourceType':'Bundle'}
+    truncated=tmp_path/'truncated.json'
+    truncated.write_text('{"entry": [{"resource": {"id": 1}}, {"resource": ')
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_bundle_entries(str(truncated),None,read_size=8))